@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Corporate action adjustments: split/dividend adjusted bars from the raw
+TRADES bars, no ADJUSTED_LAST download.
+
+Adjustment events of the symbol: (time, priceFactor, volumeFactor) - the
+prices of all the bars before `time` are multiplied by priceFactor, the volumes
+by volumeFactor (2:1 split: 0.5 and 2, dividend: 1 - dividend / close, 1).
+The events are derived once from the raw and ADJUSTED_LAST bars of the same
+period: the adjusted / raw close ratio is constant between the events and
+steps at every event. They could be set by hand (addSplit(), addDividend())
+or loaded from the JSON file:
+    {"AAPL": {"start": 1356998400, "asOf": 1515110400, "derivedAt": 1515196800,
+              "events": [[1407168000, 0.142857, 7.0], ...]}}
+start, asOf -- the period the events were derived from (start null - from the
+               beginning). The bars before start are not adjusted from TRADES;
+               the events after asOf (up to derivedAt) are one event at asOf.
+derivedAt   -- when the events were derived. ADJUSTED_LAST is adjusted up to
+               the download time: within maxAge after derivedAt the events serve
+               the later bars too and a new split or dividend is not seen - the
+               bars are adjusted as of the derivation. Then the events are
+               derived again from the next ADJUSTED_LAST download.
+The pool workers share the file: every save merges in what the others saved.
+'''
+
+#region import
+import os
+import sys
+import json
+import time
+import logging
+
+import numpy as np
+#endregion import
+
+PRICE_FIELDS = ('open', 'high', 'low', 'close', 'average')
+
+# Relative change of the adjusted/raw ratio which is an event, not the price rounding
+TOLERANCE = 1e-3
+
+def factors(times, events):
+    """(price, volume) cumulative factors of the bars: product of the later events"""
+    if not events:
+        ones = np.ones(len(times))
+        return ones, ones
+    events = np.array(events, dtype=np.float64).reshape(-1, 3)
+    # Suffix products: factor of the events from k on, 1 after the last one
+    price = np.append(np.cumprod(events[::-1, 1])[::-1], 1.)
+    volume = np.append(np.cumprod(events[::-1, 2])[::-1], 1.)
+    idx = np.searchsorted(events[:, 0], times, side='right')
+    return price[idx], volume[idx]
+
+def adjust(array, events):
+    """Raw BAR_DTYPE array -> adjusted copy"""
+    result = array.copy()
+    if not events or not len(array): return result
+    price, volume = factors(array['time'], events)
+    for name in PRICE_FIELDS: result[name] = array[name] * price
+    result['volume'] = np.rint(array['volume'] * volume)
+    return result
+
+def _segmentMedians(ratio, starts):
+    ends = np.append(starts[1:], len(ratio))
+    return np.array([np.nanmedian(ratio[s:e]) if e > s else np.nan
+                     for s, e in zip(starts, ends)])
+
+def deriveEvents(raw, adjusted, tolerance=TOLERANCE):
+    """
+    Raw and ADJUSTED_LAST BAR_DTYPE arrays of the same period -> events.
+    Best with the daily bars: one bar per day, any bar size works.
+    """
+    _, i, j = np.intersect1d(raw['time'], adjusted['time'], return_indices=True)
+    if not len(i): return []
+    t = raw['time'][i]
+    rawClose = raw['close'][i]
+    valid = rawClose > 0
+    t, i, j = t[valid], i[valid], j[valid]
+    if not len(t): return []
+    ratio = adjusted['close'][j] / raw['close'][i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volumeRatio = np.where(raw['volume'][i] > 0,
+                               adjusted['volume'][j] / raw['volume'][i], np.nan)
+
+    # Candidate steps, single bar outliers do not make their own segment
+    steps = np.flatnonzero(np.abs(ratio[1:] / ratio[:-1] - 1) > tolerance) + 1
+    starts = np.append(0, steps)
+    lengths = np.diff(np.append(starts, len(ratio)))
+    starts = starts[(lengths > 1) | (starts == 0)]
+    medians = _segmentMedians(ratio, starts)
+
+    # Neighbour segments with the same ratio are one segment
+    keep = [0]
+    for k in range(1, len(starts)):
+        if abs(medians[k] / medians[keep[-1]] - 1) > tolerance: keep.append(k)
+    starts = starts[keep]
+    medians = _segmentMedians(ratio, starts)
+    volumes = _segmentMedians(volumeRatio, starts)
+
+    def volumeFactor(before, after):
+        if np.isnan(before) or np.isnan(after) or after == 0: return 1.
+        f = before / after
+        return 1. if abs(f - 1) <= tolerance else float(f)
+
+    events = [(int(t[starts[k]]), float(medians[k - 1] / medians[k]),
+               volumeFactor(volumes[k - 1], volumes[k])) for k in range(1, len(starts))]
+    # Ratio of the last segment is not 1: events after the period end
+    if abs(medians[-1] - 1) > tolerance:
+        last = volumes[-1]
+        events.append((int(t[-1]) + 1, float(medians[-1]),
+                       1. if np.isnan(last) or abs(last - 1) <= tolerance else float(last)))
+    return events
+
+class AdjustmentTable:
+    """Per symbol adjustment events, kept in the JSON file"""
+    def __init__(self, fileName=None, maxAge=7*24*3600):
+        self.fileName = fileName
+        self.maxAge = maxAge
+        self.symbols = self._read()
+
+    def _read(self):
+        if not self.fileName or not os.path.exists(self.fileName): return {}
+        try:
+            with open(self.fileName) as f: return json.load(f)
+        except (OSError, ValueError):
+            logging.exception(f'Cannot read the adjustments {self.fileName}')
+            return {}
+
+    def events(self, symbol, start=None):
+        """
+        Events of the symbol for the bars from start (epoch) or None if it is
+        before the known period or the events are older than maxAge.
+        The bars after asOf are adjusted as of the derivation.
+        """
+        entry = self.symbols.get(symbol)
+        if entry is None: return None
+        known = entry.get('start')
+        if start is not None and known is not None and start < known: return None
+        if time.time() - entry.get('derivedAt', entry['asOf']) > self.maxAge: return None
+        return [tuple(event) for event in entry['events']]
+
+    def adjust(self, symbol, array):
+        """Adjusted copy of the symbol raw bars, None if the events are unknown"""
+        if not len(array): return None
+        events = self.events(symbol, int(array['time'][0]))
+        if events is None: return None
+        return adjust(array, events)
+
+    def setEvents(self, symbol, events, asOf=None, start=None):
+        """Events known for [start, asOf] (None - from the beginning up to now)"""
+        now = int(time.time())
+        self.symbols[symbol] = {'start': None if start is None else int(start),
+                                'asOf': now if asOf is None else int(asOf),
+                                'derivedAt': now,
+                                'events': sorted([list(event) for event in events])}
+        self.save()
+
+    def derive(self, symbol, raw, adjusted, start=None, asOf=None):
+        """
+        Events of the symbol from its raw and ADJUSTED_LAST bars of [start, asOf).
+        The events after the period are one event at its end, so the events
+        are known for the period only.
+        """
+        events = deriveEvents(raw, adjusted)
+        logging.info(f'{symbol}: {len(events)} adjustment events')
+        self.setEvents(symbol, events, asOf, start)
+        return events
+
+    def addSplit(self, symbol, exDate, ratio):
+        """exDate -- epoch, ratio -- new shares per old share: 2 for 2:1 split"""
+        self._add(symbol, (exDate, 1. / ratio, float(ratio)))
+
+    def addDividend(self, symbol, exDate, amount, close):
+        """close -- the last raw close before the ex-date"""
+        self._add(symbol, (exDate, 1. - amount / close, 1.))
+
+    def _add(self, symbol, event):
+        entry = self.symbols.get(symbol)
+        events = [tuple(e) for e in entry['events']] if entry else []
+        self.setEvents(symbol, events + [event], entry['asOf'] if entry else None,
+                       entry.get('start') if entry else None)
+
+    def _merge(self, symbols):
+        """Take the symbols derived by the other processes since the load"""
+        for symbol, entry in symbols.items():
+            own = self.symbols.get(symbol)
+            if own is None or (entry.get('derivedAt', entry['asOf']) >
+                               own.get('derivedAt', own['asOf'])):
+                self.symbols[symbol] = entry
+
+    def save(self):
+        if not self.fileName: return
+        dirName = os.path.dirname(self.fileName)
+        if dirName: os.makedirs(dirName, exist_ok=True)
+        self._merge(self._read())
+        # Own temporary file: the processes do not write over each other's
+        tmpName = f'{self.fileName}.{os.getpid()}.tmp'
+        with open(tmpName, 'w') as f: json.dump(self.symbols, f, indent=1)
+        os.replace(tmpName, self.fileName)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+asyncio facade over the App.
+
+The App message loop runs in its own thread. Every fetch is posted to the loop,
+goes through the scheduler (pacing, concurrency) and is resolved back in the
+asyncio event loop:
+
+    async with AsyncClient(port=7497, clientId=1) as client:
+        bars = await client.fetch_bars('AAPL', '20180105', '1 W', '5 mins')
+        many = await asyncio.gather(*(client.fetch_bars(s, '20180105', '1 Y', '1 day')
+                                      for s in symbols))
+        async for batch in client.stream_bars('IBM', '20180105', '1 D', '1 min'):
+            ...
+
+Bars are numpy arrays of bars.BAR_DTYPE.
+
+stream_bars() yields the bars as the sink gets them: request by request for
+the single request job only. The store jobs and the multi-chunk backfill
+write the whole period to the sink when all the requests are done, so the
+batches come at the end, the same time fetch_bars() returns.
+'''
+
+#region import
+import sys
+import asyncio
+import logging
+import threading
+
+from config import config
+from main import App, makeSimpleContract
+from sinks import ArraySink
+from backfill import isNoData
+#endregion import
+
+class FetchError(Exception):
+    def __init__(self, name, errors):
+        Exception.__init__(self, f'{name}: ' + '; '.join(f'{code} {msg}' for _, code, msg in errors))
+        self.errors = errors
+
+class _Errors:
+    """tws2gui replacement: errors go to the log, the rest is ignored"""
+    def put(self, msg):
+        if msg.startswith('ERROR'): logging.warning(msg)
+
+class AsyncApp(App):
+    def __init__(self):
+        App.__init__(self, None, _Errors())
+        self.startedEvent = threading.Event()
+
+    def onStart(self):
+        App.onStart(self)
+        self.startedEvent.set()
+
+class AsyncClient:
+    def __init__(self, host='127.0.0.1', port=config.twsport, clientId=config.clientId):
+        self.host = host
+        self.port = port
+        self.clientId = clientId
+        self.app = None
+        self._thread = None
+        self._nJobs = 0
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def connect(self, timeout=10.):
+        loop = asyncio.get_running_loop()
+        app = self.app = AsyncApp()
+        await loop.run_in_executor(None, app.connect, self.host, self.port, self.clientId)
+        if not app.isConnected(): raise ConnectionError(f'Cannot connect to {self.host}:{self.port}')
+        self._thread = threading.Thread(target=app.run, name='App', daemon=True)
+        self._thread.start()
+        if not await loop.run_in_executor(None, app.startedEvent.wait, timeout):
+            raise ConnectionError('No nextValidId from TWS')
+
+    async def close(self):
+        if self.app is None: return
+        self.app.post('EXIT')
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        self.app.stopWriter()
+        self.app = None
+
+    def _submit(self, symbol, endDate, duration, barSize, barType, contract, sink, onError):
+        """onError(exception) -- in the App thread, the job cannot be made"""
+        self._nJobs += 1
+        name = f'{symbol}-{endDate}-{duration}-{barSize}-{barType}#{self._nJobs}'
+        if contract is None: contract = makeSimpleContract(symbol)
+
+        def submit(contract, head):
+            try:
+                job = self.app.makeJob(name, contract, endDate, duration, barSize, barType,
+                                       sink, head)
+            except Exception as e:
+                # Bad arguments (e.g. duration): nothing will close the sink
+                onError(e)
+                return
+            sink.job = job
+            self.app.submit(job)
+
+        def resolve():
+            try:
+                self.app.resolve(contract, barType, submit)
+            except Exception as e:
+                onError(e)
+        self.app.post(resolve)
+
+    @staticmethod
+    def _error(sink):
+        """Fetch failed: there are real errors and no data"""
+        job = sink.job
+        errors = [e for e in job.errors if not isNoData(e[1], e[2])]
+        if errors and not len(sink.array): return FetchError(job.name, errors)
+        return None
+
+    async def fetch_bars(self, symbol, endDate, duration, barSize, barType='TRADES',
+                         contract=None):
+        """Finished BAR_DTYPE array of the bars"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(sink):
+            if future.done(): return
+            error = self._error(sink)
+            if error: future.set_exception(error)
+            else: future.set_result(sink.array)
+
+        def fail(error):
+            if not future.done(): future.set_exception(error)
+
+        sink = ArraySink(onClose=lambda array: loop.call_soon_threadsafe(resolve, sink))
+        self._submit(symbol, endDate, duration, barSize, barType, contract, sink,
+                     lambda error: loop.call_soon_threadsafe(fail, error))
+        return await future
+
+    async def stream_bars(self, symbol, endDate, duration, barSize, barType='TRADES',
+                          contract=None, batchSize=1024):
+        """Async iterator over BAR_DTYPE arrays of the bars as they arrive"""
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue()
+
+        def onBatch(array): loop.call_soon_threadsafe(batches.put_nowait, array)
+        def onClose(array): loop.call_soon_threadsafe(batches.put_nowait, None)
+        def onError(error): loop.call_soon_threadsafe(batches.put_nowait, error)
+
+        sink = ArraySink(onClose=onClose, onBatch=onBatch, batchSize=batchSize)
+        self._submit(symbol, endDate, duration, barSize, barType, contract, sink, onError)
+        while True:
+            batch = await batches.get()
+            if batch is None: break
+            if isinstance(batch, Exception): raise batch
+            yield batch
+        error = self._error(sink)
+        if error: raise error
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Chunked backfill.
+
+TWS limits the duration of one historical data request depending on the bar
+size. A long period is split into the largest allowed chunks, the chunks are
+requested newest-to-oldest starting from the End Date and stitched back
+into one ordered output with the chunk boundaries de-duplicated.
+'''
+
+#region import
+import sys
+import math
+from datetime import timedelta
+
+from timeutils import (DAY, WEEK, barSizeSeconds, durationStart,
+                       parseEndDate, formatEndDate)
+from scheduler import HistRequest, Job
+from bars import mergeChunks
+#endregion import
+
+# TWS error for the request with no data in the period. The same code comes
+# with the other HMDS errors (e.g. no market data permissions): the text tells.
+NO_DATA = 162
+NO_DATA_TEXT = 'HMDS query returned no data'
+
+def isNoData(errorCode, errorString):
+    """The error is 'no data in the period', not a failure"""
+    return errorCode == NO_DATA and NO_DATA_TEXT.lower() in errorString.lower()
+
+# Max duration of one request for the bar size: (duration, chunk step in seconds)
+# Step is the shortest possible length of the duration,
+# i.e. neighbour chunks may overlap but never leave a gap.
+_maxChunk = {
+    '1 secs'  : ('1800 S' , 1800),
+    '5 secs'  : ('3600 S' , 3600),
+    '10 secs' : ('14400 S', 14400),
+    '15 secs' : ('14400 S', 14400),
+    '30 secs' : ('28800 S', 28800),
+    '1 min'   : ('1 W'    , WEEK),
+    '2 mins'  : ('1 W'    , WEEK),
+    '3 mins'  : ('1 W'    , WEEK),
+    '5 mins'  : ('1 W'    , WEEK),
+    '10 mins' : ('1 W'    , WEEK),
+    '15 mins' : ('1 W'    , WEEK),
+    '20 mins' : ('1 W'    , WEEK),
+    '30 mins' : ('1 M'    , 28*DAY),
+    '1 hour'  : ('1 M'    , 28*DAY),
+    '2 hours' : ('1 M'    , 28*DAY),
+    '3 hours' : ('1 M'    , 28*DAY),
+    '4 hours' : ('1 M'    , 28*DAY),
+    '8 hours' : ('1 M'    , 28*DAY),
+    '1 day'   : ('1 Y'    , 365*DAY),
+    '1 week'  : ('1 Y'    , 365*DAY),
+    '1 month' : ('1 Y'    , 365*DAY),
+}
+
+def maxChunk(barSize):
+    chunk = _maxChunk.get(barSize)
+    if chunk: return chunk
+    # Unknown bar size - fall back to the neighbour by the bar length
+    secs = barSizeSeconds(barSize)
+    return max((v for k, v in _maxChunk.items() if barSizeSeconds(k) <= secs),
+               key=lambda v: v[1], default=_maxChunk['1 secs'])
+
+def _remainder(secs, step):
+    if step < DAY: return f'{int(secs)} S'
+    return f'{math.ceil(secs / DAY)} D'
+
+def planChunks(endDate, duration, barSize, start=None):
+    """
+    Split the request into chunks.
+    Returns the list of (endDate, duration) pairs, newest first.
+    `start` (datetime) overrides the period start calculated from the duration,
+    duration could be None in this case.
+    """
+    end, tz = parseEndDate(endDate)
+    if start is None: start = durationStart(end, duration)
+    chunkDuration, step = maxChunk(barSize)
+
+    total = (end - start).total_seconds()
+    if total <= 0: return []
+    if total <= step:
+        if duration is None: duration = _remainder(total, step)
+        return [(formatEndDate(end, tz), duration)]
+
+    chunks = []
+    while total > 0:
+        chunks.append((formatEndDate(end, tz),
+                       chunkDuration if total >= step else _remainder(total, step)))
+        end -= timedelta(seconds=step)
+        total -= step
+    return chunks
+
+def barKey(date):
+    """Sortable key of the bar date: epoch seconds or 'yyyymmdd[ hh:mm:ss]'"""
+    if date.isdigit() and len(date) > 8: return int(date)
+    return ' '.join(date.split())
+
+class BackfillJob(Job):
+    """
+    Job for the chunked request.
+    Bars of every chunk are buffered and written to the sink
+    oldest-to-newest when all the chunks are done.
+    """
+    def __init__(self, name, requests, sink):
+        Job.__init__(self, name, requests, sink)
+        for i, request in enumerate(self.requests): request.chunk = i
+        self._chunks = [[] for _ in self.requests]
+        self._typed = False
+
+    def onBar(self, request, bar):
+        self._chunks[request.chunk].append(bar)
+
+    def onArray(self, request, array):
+        self._chunks[request.chunk] = array
+        self._typed = True
+
+    def onRequestEnd(self, request):
+        # Nothing to flush - bars are buffered until all the chunks are done
+        pass
+
+    def onRequestError(self, request, errorCode, errorString):
+        Job.onRequestError(self, request, errorCode, errorString)
+        # The chunk could fall on holidays - not an error for the whole job
+        return isNoData(errorCode, errorString)
+
+    def close(self):
+        if self._chunks is not None and self._typed:
+            array = mergeChunks(self._chunks)
+            self.nBars = len(array)
+            self.sink.writeArray(array, barSizeSeconds(self.requests[0].barSize) >= DAY)
+            self._chunks = None
+        elif self._chunks is not None:
+            last = None
+            write = self.sink.write
+            for chunk in reversed(self._chunks):
+                for bar in chunk:
+                    key = barKey(bar.date)
+                    if last is not None and key <= last: continue
+                    last = key
+                    self.nBars += 1
+                    write(bar)
+            self._chunks = None
+        Job.close(self)
+
+def makeJob(name, contract, endDate, duration, barSize, barType, sink, start=None, **kwargs):
+    """
+    Job for the request of any duration
+    start -- datetime, overrides the period start (e.g. the head timestamp)
+    """
+    chunks = planChunks(endDate, None if start else duration, barSize, start)
+    requests = [HistRequest(contract, chunkEnd, chunkDuration, barSize, barType, **kwargs)
+                for chunkEnd, chunkDuration in chunks]
+    if len(requests) <= 1: return Job(name, requests, sink)
+    return BackfillJob(name, requests, sink)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Typed bars: epoch timestamps, float64 prices, int64 volume and count.
+'''
+
+#region import
+import sys
+
+import numpy as np
+
+from timeutils import barEpoch
+#endregion import
+
+BAR_COLUMNS = (
+    ('time'   , '<i8'),
+    ('open'   , '<f8'),
+    ('high'   , '<f8'),
+    ('low'    , '<f8'),
+    ('close'  , '<f8'),
+    ('volume' , '<i8'),
+    ('count'  , '<i8'),
+    ('average', '<f8'),
+)
+
+BAR_DTYPE = np.dtype(list(BAR_COLUMNS))
+
+def barRow(bar):
+    return (barEpoch(bar.date), bar.open, bar.high, bar.low, bar.close,
+            int(bar.volume), bar.barCount, bar.average)
+
+def barsToArray(bars):
+    """List of BarData -> BAR_DTYPE array"""
+    return np.array([barRow(bar) for bar in bars], dtype=BAR_DTYPE)
+
+def parseBars(fields, count, width=8):
+    """
+    Raw HISTORICAL_DATA message fields (bytes) of `count` bars -> BAR_DTYPE array.
+    Every bar is `width` fields: date, open, high, low, close, volume, average,
+    [hasGaps,] barCount.
+    """
+    array = np.empty(count, dtype=BAR_DTYPE)
+    if not count: return array
+    raw = np.array(fields, dtype=bytes).reshape(count, width)
+
+    dates = raw[:, 0]
+    # formatDate=2: intraday bars have the epoch dates, daily ones still 'yyyymmdd'
+    if len(dates[0]) > 8 and dates[0].isdigit():
+        array['time'] = dates.astype(np.int64)
+    else:
+        array['time'] = [barEpoch(date.decode()) for date in dates]
+    for i, name in enumerate(('open', 'high', 'low', 'close'), 1):
+        array[name] = raw[:, i].astype(np.float64)
+    array['volume'] = raw[:, 5].astype(np.float64)  # Could be fractional for some data types
+    array['average'] = raw[:, 6].astype(np.float64)
+    array['count'] = raw[:, width - 1].astype(np.int64)
+    return array
+
+def mergeChunks(chunks):
+    """
+    BAR_DTYPE arrays of the chunks newest-to-oldest -> one array oldest-to-newest.
+    Bars overlapping the previous (older) chunk are dropped.
+    """
+    chunks = [chunk for chunk in reversed(chunks) if len(chunk)]
+    if not chunks: return np.empty(0, dtype=BAR_DTYPE)
+    array = np.concatenate(chunks)
+    t = array['time']
+    keep = np.empty(len(t), dtype=bool)
+    keep[0] = True
+    # Strictly after every bar before it
+    np.greater(t[1:], np.maximum.accumulate(t)[:-1], out=keep[1:])
+    return array if keep.all() else array[keep]
+
+class BarArray:
+    """Preallocated BAR_DTYPE (or any other dtype) array growing by doubling"""
+    def __init__(self, capacity=1024, dtype=BAR_DTYPE):
+        self._data = np.empty(max(capacity, 16), dtype=dtype)
+        self._size = 0
+
+    def __len__(self): return self._size
+
+    def extend(self, bars):
+        n = self._size + len(bars)
+        if n > len(self._data):
+            data = np.empty(max(n, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:n] = bars
+        self._size = n
+
+    @property
+    def array(self):
+        """Bars so far - view, no copy"""
+        return self._data[:self._size]
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Headless batch mode - no GUI, no tkinter.
+
+Usage: python batch.py jobs.csv|jobs.json [--host HOST] [--port PORT] [--clientId ID] [--repair]
+
+Job file is CSV with the header or JSON list of objects with the fields:
+    symbol, endDate, duration, barSize, barType, output[, format][, keepUpToDate]
+barType is TRADES by default, format is taken from the output file extension
+(.csv, .parquet, .ibz - chunked, no extension - npy).
+keepUpToDate (1/true/yes) - stream: endDate is ignored, the output is appended
+and updated until the batch is interrupted (Ctrl-C).
+barSize 'ticks' - historical ticks (barType TRADES, BID_ASK or MIDPOINT),
+the output is a directory with .npy file per column.
+On exit the summary is printed: bars fetched, bytes written and elapsed time per job.
+A job which cannot be made (bad parameters or output format) is reported as
+failed and the exit code is 1.
+'''
+
+#region import
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+
+from config import config
+from logutils import init_logger
+from main import App
+from sinks import FORMATS
+from wirelog import logName
+#endregion import
+
+#region Jobs
+#-----------------------------------------------------------------------------
+_fields = ('symbol', 'endDate', 'duration', 'barSize', 'barType', 'output', 'format',
+           'keepUpToDate')
+
+def _formatFromName(fileName):
+    ext = os.path.splitext(fileName)[1]
+    for fmt, (_, fmtExt) in FORMATS.items():
+        if fmtExt == ext: return fmt
+    return 'csv'
+
+def readJobs(fileName):
+    """Job file -> list of dicts"""
+    with open(fileName, newline='') as f:
+        if fileName.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for row in rows:
+        row = {k.strip(): str(v).strip() for k, v in row.items() if k and v not in (None, '')}
+        stream = row.get('keepUpToDate', '').lower() in ('1', 'true', 'yes')
+        missing = [k for k in ('symbol', 'endDate', 'duration', 'barSize', 'output')
+                   if k not in row and not (stream and k == 'endDate')]
+        if missing: raise ValueError(f'Job {row}: missing {", ".join(missing)}')
+        row['keepUpToDate'] = stream
+        row.setdefault('endDate', '')
+        row.setdefault('barType', 'TRADES')
+        row.setdefault('format', _formatFromName(row['output']))
+        jobs.append({k: row[k] for k in _fields})
+    return jobs
+
+def outputSize(fileName):
+    if os.path.isdir(fileName):
+        return sum(os.path.getsize(os.path.join(fileName, name)) for name in os.listdir(fileName))
+    return os.path.getsize(fileName) if os.path.exists(fileName) else 0
+#endregion Jobs
+
+class Console:
+    """tws2gui replacement: errors go to the console, the rest is ignored"""
+    def put(self, msg):
+        if msg.startswith('ERROR'): print(msg, file=sys.stderr)
+
+class BatchApp(App):
+    def __init__(self, jobs):
+        App.__init__(self, None, Console())
+        self.jobSpecs = jobs
+        self.jobs = []
+        self.failed = []    # (name, error) of the jobs which cannot be made
+        self._nDone = 0
+        self._started = False
+
+    def onStart(self):
+        App.onStart(self)
+        if self._started: return
+        self._started = True
+        if not self.jobSpecs:
+            self.exit()
+            return
+        # Jobs are submitted (see onSubmit) as soon as their contracts are resolved
+        for spec in self.jobSpecs:
+            if spec['barSize'] == 'ticks':
+                self.ticks(spec['symbol'], spec['endDate'], spec['duration'],
+                           spec['barType'], spec['output'])
+            elif spec.get('keepUpToDate'):
+                self.stream(spec['symbol'], spec['duration'], spec['barSize'],
+                            spec['barType'], spec['output'], spec['format'])
+            else:
+                self.save(spec['symbol'], spec['endDate'], spec['duration'],
+                          spec['barSize'], spec['barType'], spec['output'], spec['format'])
+
+    def onSubmit(self, job):
+        App.onSubmit(self, job)
+        self.jobs.append(job)
+
+    def onJobFinished(self, job):
+        App.onJobFinished(self, job)
+        self._specDone()
+
+    def onJobFailed(self, name, error):
+        App.onJobFailed(self, name, error)
+        self.failed.append((name, str(error)))
+        self._specDone()
+
+    def _specDone(self):
+        self._nDone += 1
+        if self._nDone == len(self.jobSpecs): self.exit()
+
+    def summary(self):
+        """Summary rows of the finished and the failed jobs"""
+        return ([jobSummary(job) for job in self.jobs] +
+                [(name, 0, 0, float('nan'), f'failed: {error}') for name, error in self.failed])
+
+def jobSummary(job):
+    """(name, bars, bytes, seconds, errors) of the job, errors is None if not finished"""
+    jobTime = job.doneAt - job.submittedAt if job.doneAt else float('nan')
+    return (job.name, job.nBars, outputSize(job.name), jobTime,
+            len(job.errors) if job.doneAt else None)
+
+def summaryOk(rows, nJobs):
+    """All the jobs are made and finished"""
+    return len(rows) == nJobs and all(isinstance(row[4], int) for row in rows)
+
+def printSummary(rows, elapsed):
+    print(f'{"Job":<60} {"Bars":>10} {"Bytes":>14} {"Time, s":>9}  Errors')
+    for name, nBars, size, jobTime, errors in rows:
+        print(f'{name:<60} {nBars:>10} {size:>14} {jobTime:>9.1f}  '
+              f'{"not finished" if errors is None else errors}')
+    print(f'Total: {len(rows)} jobs, {sum(row[1] for row in rows)} bars, '
+          f'{sum(row[2] for row in rows)} bytes, {elapsed:.1f}s')
+
+#region main
+#-------------------------------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(description='IB historical data batch download')
+    parser.add_argument('jobs', help='job file: .csv or .json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=config.twsport)
+    parser.add_argument('--clientId', type=int, default=config.clientId)
+    parser.add_argument('--repair', action='store_true',
+                        help='re-request the bars missing in the store (session calendar)')
+    args = parser.parse_args(args)
+    if args.repair: config.repair = True
+
+    init_logger('batch', logpath=config.logpath, loglevel=config.loglevel)
+
+    jobs = readJobs(args.jobs)
+    logging.info(f'Batch started: {len(jobs)} jobs')
+
+    started = time.monotonic()
+    app = BatchApp(jobs)
+    app.connect(args.host, args.port, clientId=args.clientId)
+    logging.info(f'Server version: {app.serverVersion()}, Connection time: {app.twsConnectionTime()}')
+    if config.recordpath and app.isConnected(): app.record(logName(config.recordpath, 'batch'))
+    app.run()
+    app.stopWriter()
+
+    rows = app.summary()
+    printSummary(rows, time.monotonic() - started)
+    logging.info('Batch stopped')
+    return 0 if summaryOk(rows, len(jobs)) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
+#endregion main
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Throughput benchmark against the fake TWS (faketws.py).
+
+Usage: python bench.py [--bars N] [--requests N] [--jobs N] [--format csv|npy|parquet]
+                       [--latency S] [--scenario single|concurrent|all]
+
+Scenarios:
+- single: one job, one request of --bars bars;
+- concurrent: --jobs jobs (different symbols) of --requests 1 min chunks each
+  (the longest 1 min request, see backfill.maxChunk).
+The request count differing from the expected one is reported and the exit
+code is 1: the scenario does not measure what it claims then.
+Every scenario runs in a fresh process with the pacing limits lifted and
+without the local store. The fake TWS always answers with --bars bars,
+overlapping bars of the neighbour chunks are received but written once.
+Reported: bars received/sec, per-request latency (sent -> end) and the peak RSS.
+'''
+
+#region import
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing as mp
+
+from config import config
+from faketws import FakeTws
+from sinks import FORMATS
+from backfill import maxChunk
+#endregion import
+
+def percentile(values, p):
+    if not values: return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+def peakRss():
+    """Peak resident set size of the process, MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+def runScenario(port, specs, results):
+    # Measure the loader, not the pacing rules
+    config.storepath = None
+    config.contractCache = None
+    config.maxInFlight = max(config.maxInFlight, len(specs))
+    config.pacingRequests = 1 << 30
+    config.pacingIdentical = 0
+    config.pacingPerContract = 1 << 30
+    config.loglevel = logging.WARNING
+
+    from logutils import init_logger
+    from batch import BatchApp
+    init_logger('bench', logpath=config.logpath, loglevel=config.loglevel)
+
+    app = BatchApp(specs)
+    started = time.monotonic()
+    app.connect('127.0.0.1', port, clientId=0)
+    app.run()
+    app.stopWriter()
+    elapsed = time.monotonic() - started
+
+    requests = [r for job in app.jobs for r in job.requests]
+    latencies = [r.doneAt - r.sentAt for r in requests if r.doneAt is not None]
+    results.put((sum(job.nReceived for job in app.jobs), len(requests), elapsed,
+                 latencies, peakRss()))
+
+def bench(name, port, specs, expected):
+    """expected -- requests the scenario must send. Returns True if it did"""
+    results = mp.Queue()
+    process = mp.Process(target=runScenario, name=name, args=(port, specs, results))
+    process.start()
+    nBars, nRequests, elapsed, latencies, rss = results.get()
+    process.join()
+
+    print(f'{name:<12} {len(specs):>5} {nRequests:>8} {nBars:>10} {nBars / elapsed:>12,.0f} '
+          f'{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 95) * 1000:>8.1f} '
+          f'{max(latencies, default=float("nan")) * 1000:>8.1f} {rss:>8.1f}')
+    if nRequests != expected:
+        print(f'{name}: {nRequests} requests sent, {expected} expected', file=sys.stderr)
+        return False
+    return True
+
+def makeSpecs(prefix, nJobs, duration, barSize, fmt, outdir):
+    ext = FORMATS[fmt][1]
+    return [{'symbol': f'{prefix}{i}', 'endDate': '20180105 00:00:00', 'duration': duration,
+             'barSize': barSize, 'barType': 'TRADES',
+             'output': os.path.join(outdir, f'{prefix}{i}{ext}'), 'format': fmt}
+            for i in range(nJobs)]
+
+#region main
+#-------------------------------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Historical data loader benchmark')
+    parser.add_argument('--bars', type=int, default=100000, help='bars per request')
+    parser.add_argument('--requests', type=int, default=5, help='requests per job (concurrent)')
+    parser.add_argument('--jobs', type=int, default=20, help='jobs (concurrent)')
+    parser.add_argument('--format', default='csv', choices=sorted(FORMATS))
+    parser.add_argument('--latency', type=float, default=0., help='fake TWS response delay, s')
+    parser.add_argument('--scenario', default='all', choices=('single', 'concurrent', 'all'))
+    args = parser.parse_args(args)
+
+    # The client runs in its own process, the server threads do not compete with it
+    server = FakeTws(barsPerRequest=args.bars, latency=args.latency).start()
+
+    outdir = tempfile.mkdtemp(prefix='bench')
+    print(f'{"Scenario":<12} {"Jobs":>5} {"Requests":>8} {"Bars":>10} {"Bars/s":>12} '
+          f'{"p50, ms":>8} {"p95, ms":>8} {"max, ms":>8} {"RSS, MB":>8}')
+    ok = True
+    try:
+        if args.scenario in ('single', 'all'):
+            ok &= bench('single', server.port,
+                        makeSpecs('SINGLE', 1, '1 D', '1 min', args.format, outdir), 1)
+        if args.scenario in ('concurrent', 'all'):
+            # Exactly --requests chunks of the longest 1 min request
+            duration = f'{args.requests * maxChunk("1 min")[1]} S'
+            ok &= bench('concurrent', server.port,
+                        makeSpecs('CONC', args.jobs, duration, '1 min', args.format, outdir),
+                        args.jobs * args.requests)
+    finally:
+        server.stop()
+        shutil.rmtree(outdir, ignore_errors=True)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
+#endregion main
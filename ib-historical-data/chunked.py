@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Chunked compressed bar file: time-ordered chunks of bars, every chunk
+compressed on its own, and the time index of the chunks at the end of the file.
+A range read decompresses only the chunks overlapping the range.
+
+File layout:
+    header  -- b'IBCHUNK1', uint32 length, JSON {"codec": ..., "columns": [[name, dtype]...]}
+    chunks  -- CHUNK_HEADER (b'CHNK', count, first time, last time, compressed size)
+               and the compressed columns: time as the deltas, the rest as is
+    index   -- INDEX_DTYPE record per chunk
+    trailer -- int64 index offset, int64 number of chunks, b'IBINDEX1'
+
+The index is rewritten on every flush, so the file is readable at any time.
+The next chunk after the flush cuts the index off first. The file with no
+index (crash) is recovered by the chunk headers scan.
+
+Codecs: zstd (zstandard) or lz4 (lz4) if installed, zlib otherwise.
+
+Usage: python chunked.py input.csv|input_npy_dir output.ibz [--codec zstd|lz4|zlib]
+'''
+
+#region import
+import os
+import sys
+import json
+import zlib
+import struct
+import argparse
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from bars import BAR_COLUMNS, BAR_DTYPE
+from timeutils import barEpoch
+#endregion import
+
+MAGIC = b'IBCHUNK1'
+INDEX_MAGIC = b'IBINDEX1'
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIqqI')   # magic, count, first time, last time, size
+TRAILER = struct.Struct('<qq8s')          # index offset, chunks, magic
+
+INDEX_DTYPE = np.dtype([('first', '<i8'), ('last', '<i8'), ('offset', '<i8'), ('count', '<i8')])
+
+CHUNK_SIZE = 8192   # Bars per chunk
+
+#region Codecs
+#-----------------------------------------------------------------------------
+def _codecs():
+    codecs = {}
+    if zstandard is not None:
+        codecs['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                          lambda data: zstandard.ZstdDecompressor().decompress(data))
+    if lz4 is not None:
+        codecs['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+    codecs['zlib'] = (lambda data: zlib.compress(data, 6), zlib.decompress)
+    return codecs
+
+CODECS = _codecs()
+
+# The fastest one installed
+DEFAULT_CODEC = next(iter(CODECS))
+
+def getCodec(name):
+    """(compress, decompress) of the codec"""
+    codec = CODECS.get(name)
+    if codec is None:
+        module = {'zstd': 'zstandard', 'lz4': 'lz4'}.get(name)
+        if module: raise RuntimeError(f'{name} codec requires {module}')
+        raise ValueError(f'Unknown codec: {name}')
+    return codec
+#endregion Codecs
+
+def _encode(array, columns):
+    """Array of the chunk -> bytes: column by column, time as the deltas"""
+    t = array['time']
+    parts = [np.diff(t, prepend=t[:1] * 0).astype('<i8').tobytes()]
+    parts += [np.ascontiguousarray(array[name], dtype=dtype).tobytes()
+              for name, dtype in columns if name != 'time']
+    return b''.join(parts)
+
+def _decode(data, count, columns, dtype):
+    array = np.empty(count, dtype=dtype)
+    pos = 0
+    for name, columnType in columns:
+        size = count * np.dtype(columnType).itemsize
+        values = np.frombuffer(data, dtype=columnType, count=count, offset=pos)
+        array[name] = np.cumsum(values) if name == 'time' else values
+        pos += size
+    return array
+
+def _readHeader(file, fileName):
+    magic = file.read(len(MAGIC))
+    if magic != MAGIC: raise ValueError(f'{fileName}: not a chunked bar file')
+    size, = struct.unpack('<I', file.read(4))
+    meta = json.loads(file.read(size))
+    return meta, file.tell()
+
+def _readIndex(file, dataStart):
+    """Index from the trailer or rebuilt by the scan: (index, end of the last chunk)"""
+    end = file.seek(0, os.SEEK_END)
+    if end - dataStart >= TRAILER.size:
+        file.seek(end - TRAILER.size)
+        offset, count, magic = TRAILER.unpack(file.read(TRAILER.size))
+        if (magic == INDEX_MAGIC and dataStart <= offset
+                and offset + count * INDEX_DTYPE.itemsize + TRAILER.size == end):
+            file.seek(offset)
+            index = np.frombuffer(file.read(count * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+            return index.copy(), offset
+
+    # No valid index: walk the chunk headers up to the first broken one
+    records = []
+    pos = dataStart
+    while pos + CHUNK_HEADER.size <= end:
+        file.seek(pos)
+        magic, count, first, last, size = CHUNK_HEADER.unpack(file.read(CHUNK_HEADER.size))
+        if magic != CHUNK_MAGIC or pos + CHUNK_HEADER.size + size > end: break
+        records.append((first, last, pos, count))
+        pos += CHUNK_HEADER.size + size
+    return np.array(records, dtype=INDEX_DTYPE), pos
+
+class ChunkedFile:
+    """
+    Reader of the chunked bar file
+    index -- INDEX_DTYPE array: first/last time, offset and bar count of every chunk
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._file = open(fileName, 'rb')
+        meta, dataStart = _readHeader(self._file, fileName)
+        self.codec = meta['codec']
+        self.columns = [tuple(column) for column in meta['columns']]
+        self.dtype = np.dtype(self.columns)
+        self._decompress = getCodec(self.codec)[1]
+        self.index, _ = _readIndex(self._file, dataStart)
+        self.nChunksRead = 0
+
+    def __len__(self): return int(self.index['count'].sum())
+
+    def __enter__(self): return self
+
+    def __exit__(self, *args): self.close()
+
+    @property
+    def timeRange(self):
+        """(first, last) bar time or None if empty"""
+        if not len(self.index): return None
+        return int(self.index['first'][0]), int(self.index['last'][-1])
+
+    def _chunk(self, i):
+        first, last, offset, count = self.index[i]
+        self._file.seek(offset)
+        _, _, _, _, size = CHUNK_HEADER.unpack(self._file.read(CHUNK_HEADER.size))
+        self.nChunksRead += 1
+        return _decode(self._decompress(self._file.read(size)), int(count),
+                       self.columns, self.dtype)
+
+    def read(self, start=None, end=None):
+        """Bars of [start, end) epoch seconds, everything by default"""
+        index = self.index
+        lo = 0 if start is None else int(np.searchsorted(index['last'], start))
+        hi = len(index) if end is None else int(np.searchsorted(index['first'], end))
+        parts = [self._chunk(i) for i in range(lo, hi)]
+        if not parts: return np.empty(0, dtype=self.dtype)
+        array = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        t = array['time']
+        return array[(0 if start is None else np.searchsorted(t, start)):
+                     (len(t) if end is None else np.searchsorted(t, end))]
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+class ChunkedWriter:
+    """
+    Writer of the chunked bar file, bars must come in the time order.
+    append -- continue the existing file (same columns and codec)
+    """
+    def __init__(self, fileName, columns=BAR_COLUMNS, codec=None, append=False):
+        self.fileName = fileName
+        self.columns = [tuple(column) for column in columns]
+        self.dtype = np.dtype(self.columns)
+        if append and os.path.exists(fileName) and os.path.getsize(fileName):
+            self._file = open(fileName, 'r+b')
+            meta, dataStart = _readHeader(self._file, fileName)
+            if [tuple(column) for column in meta['columns']] != self.columns:
+                raise ValueError(f'{fileName}: other columns, cannot append')
+            self.codec = meta['codec']
+            index, end = _readIndex(self._file, dataStart)
+            self._index = list(index.tolist())
+            self._file.seek(end)
+            self._file.truncate()
+        else:
+            self.codec = codec or DEFAULT_CODEC
+            self._file = open(fileName, 'wb')
+            meta = json.dumps({'codec': self.codec, 'columns': self.columns}).encode()
+            self._file.write(MAGIC + struct.pack('<I', len(meta)) + meta)
+            self._index = []
+        self._compress = getCodec(self.codec)[0]
+        self._indexed = False   # Index and trailer are after the file position
+        self._lastTime = self._index[-1][1] if self._index else None
+
+    def writeChunk(self, array):
+        """One chunk of the bars"""
+        if not len(array): return
+        t = array['time']
+        first, last = int(t[0]), int(t[-1])
+        if self._lastTime is not None and first < self._lastTime:
+            raise ValueError(f'{self.fileName}: bars are not in the time order')
+        data = self._compress(_encode(array, self.columns))
+        offset = self._file.tell()
+        if self._indexed:
+            # The flushed index and trailer must not outlive it: a crash before
+            # the next flush would leave the stale trailer pointing into the chunk
+            self._file.truncate()
+            self._indexed = False
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(array), first, last, len(data)))
+        self._file.write(data)
+        self._index.append((first, last, offset, len(array)))
+        self._lastTime = last
+
+    def write(self, array, chunkSize=CHUNK_SIZE):
+        """Bars split into the chunks of `chunkSize`"""
+        for i in range(0, len(array), chunkSize): self.writeChunk(array[i:i + chunkSize])
+
+    def _writeIndex(self):
+        """Index and trailer after the chunks, the file position stays before them"""
+        offset = self._file.tell()
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        self._file.write(index.tobytes())
+        self._file.write(TRAILER.pack(offset, len(index), INDEX_MAGIC))
+        self._file.truncate()
+        self._file.seek(offset)
+        self._indexed = True
+
+    def flush(self, fsync=True):
+        if not self._file: return
+        self._writeIndex()
+        self._file.flush()
+        if fsync: os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file:
+            self.flush(False)
+            self._file.close()
+            self._file = None
+
+def readBars(fileName, start=None, end=None):
+    """Bars of [start, end) epoch seconds from the chunked file"""
+    with ChunkedFile(fileName) as f: return f.read(start, end)
+
+#region Conversion
+#-----------------------------------------------------------------------------
+def loadCsv(fileName):
+    """CsvSink output -> BAR_DTYPE array"""
+    rows = np.loadtxt(fileName, delimiter=',', dtype=str, skiprows=1, ndmin=2)
+    array = np.empty(len(rows), dtype=BAR_DTYPE)
+    if not len(rows): return array
+    # Date, Time, Open, Close, Min, Max, Trades, Volume, Average
+    array['time'] = [barEpoch(f'{date}  {tm}' if tm else date) for date, tm in rows[:, :2]]
+    for i, name in ((2, 'open'), (3, 'close'), (4, 'low'), (5, 'high'), (8, 'average')):
+        array[name] = rows[:, i].astype(np.float64)
+    array['count'] = rows[:, 6].astype(np.int64)
+    array['volume'] = rows[:, 7].astype(np.float64)
+    return array
+
+def loadNpy(dirName):
+    """NpySink output -> BAR_DTYPE array"""
+    columns = {name: np.load(os.path.join(dirName, f'{name}.npy')) for name, _ in BAR_COLUMNS}
+    array = np.empty(len(columns['time']), dtype=BAR_DTYPE)
+    for name, values in columns.items(): array[name] = values
+    return array
+
+def convert(source, target, codec=None, chunkSize=CHUNK_SIZE):
+    """csv or npy output -> chunked file"""
+    array = loadNpy(source) if os.path.isdir(source) else loadCsv(source)
+    writer = ChunkedWriter(target, codec=codec)
+    writer.write(array, chunkSize)
+    writer.close()
+    return len(array)
+#endregion Conversion
+
+#region main
+#-------------------------------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert the bars to the chunked file')
+    parser.add_argument('source', help='csv file or npy directory')
+    parser.add_argument('target', help='chunked file')
+    parser.add_argument('--codec', choices=sorted(CODECS), default=DEFAULT_CODEC)
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='bars per chunk')
+    args = parser.parse_args(args)
+
+    n = convert(args.source, args.target, args.codec, args.chunk)
+    size = os.path.getsize(args.source) if os.path.isfile(args.source) else sum(
+        os.path.getsize(os.path.join(args.source, name)) for name in os.listdir(args.source))
+    print(f'{n} bars: {size} -> {os.path.getsize(args.target)} bytes')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+#endregion main
@@ -18,7 +18,56 @@ config = Config()
 # Logging
 config.logpath = 'log'
 config.loglevel = logging.INFO
+config.logMaxBytes = 100 << 20  # Rotate the log file at this size, 0 - never
+config.logRotateWhen = None     # or by time: 'midnight', 'H'... (TimedRotatingFileHandler)
+config.logBackupCount = 10      # Rotated log files to keep
+config.traceSample = 0          # Log every N-th TWS message, 0 - no trace
 
 # TWS Connection
 config.twsport = 7497
 config.clientId = 0
+
+# Directory for the TWS wire logs (see wirelog.py), None - do not record
+config.recordpath = None
+
+# Contract details and head timestamp cache (see contracts.py), None - no resolution
+config.contractCache = 'contracts.json'
+config.contractMaxAge = 7*24*3600   # Contract details refresh period, seconds
+config.headRetry = 24*3600          # Failed head timestamp lookup retry period, seconds
+
+# Local bar store, None - download everything directly to the output file
+config.storepath = 'store'
+config.resample = True          # Resample the finer stored bars instead of the download
+config.repair = False           # Re-request the bars missing in the store (needs the calendar)
+
+# Corporate action adjustments (see adjust.py): ADJUSTED_LAST bars from the stored
+# TRADES ones, None - always download ADJUSTED_LAST
+config.adjustments = 'adjustments.json'
+config.adjustMaxAge = 7*24*3600     # Adjustment events refresh period, seconds: a new
+                                    # split is not seen until the refresh
+
+# Trading session calendar (see sessions.CALENDARS) for the exact bar counts,
+# None - rough estimations
+config.calendar = 'NYSE'
+
+# Historical data requests
+config.epochDates = True        # formatDate=2 and typed bar arrays instead of BarData
+config.maxInFlight = 50         # Max simultaneous open historical data requests
+config.pacingRequests = 60      # Max requests ...
+config.pacingPeriod = 600       # ... within this period, seconds
+config.pacingIdentical = 15     # Min interval between identical requests, seconds
+config.pacingPerContract = 5    # Max requests for the same contract and tick type ...
+config.pacingContractPeriod = 2 # ... within this period, seconds
+config.pacingBackoff = 60       # Pause after a pacing violation, seconds
+
+# Max progress updates per second sent to the GUI
+config.progressRate = 10
+
+# Metrics dump period, seconds (log, GUI), None - no metrics
+config.metricsInterval = 5
+config.metricsFile = None       # JSON lines file for the metrics dumps
+
+# Background writer
+config.writerThread = True      # Write to disk in the separate thread
+config.writerQueueSize = 256    # Max batches waiting for the writer
+config.writerBatchSize = 4096   # Bars per batch
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Contract resolution and head timestamp cache.
+
+Before the first historical data request for the symbol the contract is
+resolved once with reqContractDetails (conId, primary exchange, trading
+hours) and the earliest available data time is asked with reqHeadTimeStamp.
+Both are kept in the JSON file, so the next runs send the requests with the
+exact conId and never ask for the data before the instrument existed.
+The failed head timestamp lookups are kept too and retried after a while only.
+The pool workers share the file: every save merges in what the others saved.
+'''
+
+#region import
+import os
+import sys
+import json
+import time
+import logging
+
+from ibapi.contract import Contract
+#endregion import
+
+class ContractCache:
+    """
+    Persistent cache:
+        contracts -- 'symbol|secType|currency|exchange' -> contract details dict
+        heads     -- 'conId|barType|useRTH' -> head timestamp, epoch seconds
+        noHeads   -- 'conId|barType|useRTH' -> time of the failed head lookup
+    """
+    def __init__(self, fileName=None, maxAge=7*24*3600, noHeadAge=24*3600):
+        self.fileName = fileName
+        self.maxAge = maxAge
+        self.noHeadAge = noHeadAge
+        data = self._read()
+        self.contracts = data.get('contracts', {})
+        self.heads = data.get('heads', {})
+        self.noHeads = data.get('noHeads', {})
+
+    def _read(self):
+        if not self.fileName or not os.path.exists(self.fileName): return {}
+        try:
+            with open(self.fileName) as f: return json.load(f)
+        except (OSError, ValueError):
+            logging.exception(f'Cannot read the contract cache {self.fileName}')
+            return {}
+
+    @staticmethod
+    def contractKey(contract):
+        return f'{contract.symbol}|{contract.secType}|{contract.currency}|{contract.exchange}'
+
+    @staticmethod
+    def headKey(conId, barType, useRTH):
+        return f'{conId}|{barType}|{int(useRTH)}'
+
+    def contract(self, contract):
+        """Cached details dict of the contract or None if unknown or expired"""
+        details = self.contracts.get(self.contractKey(contract))
+        if details is None or time.time() - details['updated'] > self.maxAge: return None
+        return details
+
+    def head(self, conId, barType, useRTH):
+        return self.heads.get(self.headKey(conId, barType, useRTH))
+
+    def noHead(self, conId, barType, useRTH):
+        """The head lookup failed recently: do not ask again"""
+        failed = self.noHeads.get(self.headKey(conId, barType, useRTH))
+        return failed is not None and time.time() - failed <= self.noHeadAge
+
+    def setContract(self, contract, details):
+        self.contracts[self.contractKey(contract)] = dict(details, updated=time.time())
+        self.save()
+
+    def setHead(self, conId, barType, useRTH, head):
+        key = self.headKey(conId, barType, useRTH)
+        self.heads[key] = head
+        self.noHeads.pop(key, None)
+        self.save()
+
+    def setNoHead(self, conId, barType, useRTH):
+        self.noHeads[self.headKey(conId, barType, useRTH)] = time.time()
+        self.save()
+
+    def _merge(self, data):
+        """Take the entries saved by the other processes since the load"""
+        for key, details in data.get('contracts', {}).items():
+            own = self.contracts.get(key)
+            if own is None or details['updated'] > own['updated']: self.contracts[key] = details
+        for key, head in data.get('heads', {}).items():
+            self.heads.setdefault(key, head)
+        for key, failed in data.get('noHeads', {}).items():
+            if key not in self.heads and failed > self.noHeads.get(key, 0):
+                self.noHeads[key] = failed
+
+    def save(self):
+        if not self.fileName: return
+        dirName = os.path.dirname(self.fileName)
+        if dirName: os.makedirs(dirName, exist_ok=True)
+        self._merge(self._read())
+        # Own temporary file: the processes do not write over each other's
+        tmpName = f'{self.fileName}.{os.getpid()}.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump({'contracts': self.contracts, 'heads': self.heads,
+                       'noHeads': self.noHeads}, f, indent=1)
+        os.replace(tmpName, self.fileName)
+
+def detailsDict(details):
+    """ContractDetails -> the cached fields"""
+    contract = details.contract
+    return {'conId': contract.conId, 'symbol': contract.symbol, 'secType': contract.secType,
+            'currency': contract.currency, 'exchange': contract.exchange,
+            'primaryExchange': contract.primaryExchange, 'longName': details.longName,
+            'timeZoneId': details.timeZoneId, 'tradingHours': details.tradingHours,
+            'liquidHours': details.liquidHours}
+
+def resolvedContract(contract, details):
+    """Copy of the request contract with the resolved conId and primary exchange"""
+    resolved = Contract()
+    resolved.conId = details['conId']
+    resolved.symbol = contract.symbol
+    resolved.secType = contract.secType
+    resolved.currency = contract.currency
+    resolved.exchange = contract.exchange
+    resolved.primaryExchange = details['primaryExchange']
+    return resolved
+
+def parseHeadTimestamp(text):
+    """headTimestamp() string: epoch (formatDate=2) or 'yyyymmdd-hh:mm:ss' -> epoch"""
+    text = text.strip()
+    if text.isdigit(): return int(text)
+    date, _, tm = text.replace('-', ' ').partition(' ')
+    return int(time.mktime(time.strptime(f'{date} {tm.strip() or "00:00:00"}',
+                                         '%Y%m%d %H:%M:%S')))
+
+class _Resolution:
+    """Pending resolution of one contract and bar type: waiters get the same result"""
+    def __init__(self, contract, barType, useRTH):
+        self.contract = contract
+        self.barType = barType
+        self.useRTH = useRTH
+        self.details = []
+        self.resolved = None
+        self.waiters = []
+        self.started = time.monotonic()
+
+class ContractResolver:
+    """
+    resolve(contract, barType, useRTH, callback) -> callback(contract, head)
+    is called with the resolved contract (the original one if it could not be
+    resolved) and the head timestamp (None if unknown). Cached results are
+    returned right away, otherwise the requests are sent to the TWS. The head
+    timestamp which could not be got is not asked again for cache.noHeadAge.
+    """
+    def __init__(self, client, cache, timeout=10.):
+        self.client = client
+        self.cache = cache
+        self.timeout = timeout
+        self._pending = {}  # (contract key, barType, useRTH) -> _Resolution
+        self._byReqId = {}  # reqId -> (_Resolution, 'details'|'head')
+
+    @property
+    def busy(self): return bool(self._pending)
+
+    def resolve(self, contract, barType, useRTH, callback):
+        key = (ContractCache.contractKey(contract), contract.conId, barType, int(useRTH))
+        resolution = self._pending.get(key)
+        if resolution is not None:
+            resolution.waiters.append(callback)
+            return
+
+        if contract.conId:
+            resolved = contract
+        else:
+            details = self.cache.contract(contract)
+            resolved = resolvedContract(contract, details) if details else None
+        if resolved is not None:
+            head = self.cache.head(resolved.conId, barType, useRTH)
+            if head is not None or self.cache.noHead(resolved.conId, barType, useRTH):
+                callback(resolved, head)
+                return
+
+        resolution = self._pending[key] = _Resolution(contract, barType, useRTH)
+        resolution.key = key
+        resolution.waiters.append(callback)
+        if resolved is None:
+            self._send(resolution, 'details')
+        else:
+            resolution.resolved = resolved
+            self._send(resolution, 'head')
+
+    def _send(self, resolution, what):
+        reqId = self.client.nextId
+        self._byReqId[reqId] = (resolution, what)
+        if what == 'details':
+            logging.info(f'Request {reqId}: contract details {resolution.contract.symbol}')
+            self.client.reqContractDetails(reqId, resolution.contract)
+        else:
+            logging.info(f'Request {reqId}: head timestamp {resolution.contract.symbol} '
+                         f'{resolution.barType}')
+            self.client.reqHeadTimeStamp(reqId, resolution.resolved, resolution.barType,
+                                         resolution.useRTH, 2)
+
+    def _done(self, resolution, head=None):
+        self._pending.pop(resolution.key, None)
+        for reqId in [k for k, (r, _) in self._byReqId.items() if r is resolution]:
+            del self._byReqId[reqId]
+        contract = resolution.resolved or resolution.contract
+        for callback in resolution.waiters:
+            # A failing waiter must not leave the others without the result
+            try:
+                callback(contract, head)
+            except Exception:
+                logging.exception(f'{resolution.contract.symbol}: resolution callback failed')
+
+    def _headFailed(self, resolution):
+        self.cache.setNoHead(resolution.resolved.conId, resolution.barType, resolution.useRTH)
+
+    def onContractDetails(self, reqId, details):
+        item = self._byReqId.get(reqId)
+        if item is None: return False
+        item[0].details.append(details)
+        return True
+
+    def onContractDetailsEnd(self, reqId):
+        item = self._byReqId.pop(reqId, None)
+        if item is None: return False
+        resolution = item[0]
+        if not resolution.details:
+            logging.error(f'{resolution.contract.symbol}: no contract details')
+            self._done(resolution)
+            return True
+        if len(resolution.details) > 1:
+            logging.warning(f'{resolution.contract.symbol}: {len(resolution.details)} contracts, '
+                            f'the first one is used')
+        details = detailsDict(resolution.details[0])
+        self.cache.setContract(resolution.contract, details)
+        resolution.resolved = resolvedContract(resolution.contract, details)
+        logging.info(f'{resolution.contract.symbol}: conId {details["conId"]} '
+                     f'{details["primaryExchange"]}')
+
+        head = self.cache.head(details['conId'], resolution.barType, resolution.useRTH)
+        if head is None and not self.cache.noHead(details['conId'], resolution.barType,
+                                                  resolution.useRTH):
+            self._send(resolution, 'head')
+        else: self._done(resolution, head)
+        return True
+
+    def onHeadTimestamp(self, reqId, text):
+        item = self._byReqId.pop(reqId, None)
+        if item is None: return False
+        resolution = item[0]
+        try:
+            head = parseHeadTimestamp(text)
+        except ValueError:
+            logging.error(f'{resolution.contract.symbol}: bad head timestamp {text}')
+            self._headFailed(resolution)
+            head = None
+        else:
+            self.cache.setHead(resolution.resolved.conId, resolution.barType,
+                               resolution.useRTH, head)
+            # One answer is enough, no more updates for the request
+            self.client.cancelHeadTimeStamp(reqId)
+        self._done(resolution, head)
+        return True
+
+    def onError(self, reqId, errorCode, errorString):
+        """Returns True if the error is for the resolver request"""
+        item = self._byReqId.get(reqId)
+        if item is None: return False
+        resolution, what = item
+        logging.warning(f'{resolution.contract.symbol}: {what} failed: {errorCode} {errorString}')
+        if what == 'head': self._headFailed(resolution)
+        # Not resolved - the job goes with the contract as is
+        self._done(resolution)
+        return True
+
+    def tick(self, now=None):
+        """Give up the resolutions without the answer"""
+        if not self._pending: return
+        if now is None: now = time.monotonic()
+        for resolution in list(self._pending.values()):
+            if now - resolution.started > self.timeout:
+                logging.warning(f'{resolution.contract.symbol}: no contract resolution '
+                                f'in {self.timeout}s')
+                self._cancel(resolution)
+                # Resolved: the head timestamp is the one not answered
+                if resolution.resolved is not None: self._headFailed(resolution)
+                self._done(resolution)
+
+    def _cancel(self, resolution):
+        """
+        Cancel the outstanding requests of the resolution. The API has no
+        contract details cancel: the late answer is dropped by the unknown reqId.
+        """
+        for reqId, (r, what) in list(self._byReqId.items()):
+            if r is not resolution or what != 'head': continue
+            try:
+                self.client.cancelHeadTimeStamp(reqId)
+            except Exception:
+                logging.exception(f'Cannot cancel request {reqId}')
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Fake TWS: local stand-in server for the benchmarks.
+
+Speaks enough of the TWS wire protocol for the historical data loader:
+- v100+ handshake, startApi, nextValidId, managedAccounts;
+- reqHistoricalData: `barsPerRequest` synthetic bars ending at the request
+  end date in one message;
+- some requests could be answered with the "no data" error or
+  the pacing violation instead of the bars;
+- keepUpToDate: after the bars historicalDataUpdate with the forming bar
+  is sent every `updateInterval` seconds until the request is cancelled;
+- reqContractDetails: one stock contract per symbol, reqHeadTimeStamp:
+  `headTimestamp` epoch;
+- reqHistoricalTicks: deterministic ticks (0-3 per second, 7 in every 97th)
+  from the start time, the last second is always complete as in the TWS;
+- cancelHistoricalData and reqIds.
+
+Usage: python faketws.py [--port 7497] [--bars 2000] [--latency 0] [--update 1]
+'''
+
+#region import
+import sys
+import time
+import heapq
+import random
+import socket
+import zlib
+import struct
+import argparse
+import threading
+
+from timeutils import parseEndDate, toEpoch, barSizeSeconds, DAY
+#endregion import
+
+SERVER_VERSION = 130  # >= MIN_SERVER_VER_SYNT_REALTIME_BARS: no version field in bars
+
+# Incoming (client -> server) message ids
+REQ_IDS                = 8
+REQ_CONTRACT_DATA      = 9
+REQ_HISTORICAL_DATA    = 20
+CANCEL_HISTORICAL_DATA = 25
+START_API              = 71
+REQ_HEAD_TIMESTAMP     = 87
+REQ_HISTORICAL_TICKS   = 96
+
+# Outgoing (server -> client) message ids
+ERR_MSG         = 4
+NEXT_VALID_ID   = 9
+CONTRACT_DATA   = 10
+MANAGED_ACCTS   = 15
+HISTORICAL_DATA = 17
+CONTRACT_DATA_END = 52
+HEAD_TIMESTAMP  = 88
+HISTORICAL_DATA_UPDATE = 90
+HISTORICAL_TICKS        = 96
+HISTORICAL_TICKS_BID_ASK = 97
+HISTORICAL_TICKS_LAST   = 98
+
+NO_DATA = (162, 'Historical Market Data Service error message:HMDS query returned no data')
+PACING_VIOLATION = (162, 'Historical Market Data Service error message:'
+                         'Historical data request pacing violation')
+
+def makeMsg(*fields):
+    text = ''.join(f'{f}\0' for f in fields).encode()
+    return struct.pack('!I', len(text)) + text
+
+class Connection(threading.Thread):
+    def __init__(self, server, sock):
+        threading.Thread.__init__(self, name='FakeTwsConn', daemon=True)
+        self.server = server
+        self.sock = sock
+        self.random = random.Random(server.seed)
+        self._sendLock = threading.Lock()
+        self._cancelled = set()
+        self._due = []       # (time, seq, reqId, payload)
+        self._dueCond = threading.Condition()
+        self._seq = 0
+        self._closed = False
+
+    def _recv(self, n):
+        buf = b''
+        while len(buf) < n:
+            data = self.sock.recv(n - len(buf))
+            if not data: raise ConnectionError('closed')
+            buf += data
+        return buf
+
+    def _recvMsg(self):
+        size = struct.unpack('!I', self._recv(4))[0]
+        return self._recv(size).split(b'\0')[:-1]
+
+    def send(self, data):
+        with self._sendLock:
+            self.sock.sendall(data)
+
+    def run(self):
+        sender = threading.Thread(target=self._sendDue, name='FakeTwsSend', daemon=True)
+        sender.start()
+        try:
+            if self._recv(4) != b'API\0': return
+            self._recvMsg()  # 'v100..157'
+            self.send(makeMsg(SERVER_VERSION, time.strftime('%Y%m%d %H:%M:%S EST')))
+            while True:
+                fields = self._recvMsg()
+                self.onMessage(int(fields[0]), [f.decode() for f in fields])
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._closed = True
+            with self._dueCond: self._dueCond.notify()
+            self.sock.close()
+
+    def onMessage(self, msgId, fields):
+        if msgId == START_API:
+            self.send(makeMsg(NEXT_VALID_ID, 1, 1) + makeMsg(MANAGED_ACCTS, 1, 'DU000000'))
+        elif msgId == REQ_IDS:
+            self.send(makeMsg(NEXT_VALID_ID, 1, 1))
+        elif msgId == REQ_HISTORICAL_DATA:
+            self.onHistoricalData(fields)
+        elif msgId == CANCEL_HISTORICAL_DATA:
+            self._cancelled.add(int(fields[2]))
+        elif msgId == REQ_CONTRACT_DATA:
+            self.onContractData(int(fields[2]), fields[4])
+        elif msgId == REQ_HISTORICAL_TICKS:
+            self.onHistoricalTicks(fields)
+        elif msgId == REQ_HEAD_TIMESTAMP:
+            self._schedule(int(fields[1]), makeMsg(HEAD_TIMESTAMP, fields[1],
+                                                   self.server.headTimestamp))
+
+    def onContractData(self, reqId, symbol):
+        # Server version 130 layout of the version 8 message
+        conId = zlib.crc32(symbol.encode()) & 0x7fffffff
+        payload = makeMsg(CONTRACT_DATA, 8, reqId, symbol, 'STK', '', 0., '', 'SMART', 'USD',
+                          symbol, 'NMS', 'NMS', conId, 0.01, 100, '', 'LMT,MKT', 'SMART,NYSE', 1,
+                          0, f'{symbol} INC', 'NYSE', '', 'Industry', 'Category', 'Subcategory',
+                          'EST', '20180105:0930-1600', '20180105:0930-1600', '', 0, 0, 1, '', '',
+                          '26')
+        self._schedule(reqId, payload + makeMsg(CONTRACT_DATA_END, 1, reqId))
+
+    def onHistoricalData(self, fields):
+        server = self.server
+        reqId = int(fields[1])
+        end = toEpoch(parseEndDate(fields[15])[0])
+        step = barSizeSeconds(fields[16])
+        formatDate = int(fields[20])
+        keepUpToDate = fields[21] == '1'
+        server.nRequests += 1
+
+        r = self.random.random()
+        if r < server.pacingRate:
+            payload = makeMsg(ERR_MSG, 2, reqId, *PACING_VIOLATION)
+        elif r < server.pacingRate + server.noDataRate:
+            payload = makeMsg(ERR_MSG, 2, reqId, *NO_DATA)
+        else:
+            payload = self._bars(reqId, end, step, formatDate, server.barsPerRequest)
+            if keepUpToDate:
+                threading.Thread(target=self._update, args=(reqId, step, formatDate),
+                                 name='FakeTwsUpdate', daemon=True).start()
+        self._schedule(reqId, payload)
+
+    def onHistoricalTicks(self, fields):
+        server = self.server
+        reqId = int(fields[1])
+        start = toEpoch(parseEndDate(fields[15])[0])
+        n = int(fields[17])
+        whatToShow = fields[18]
+        server.nRequests += 1
+
+        r = self.random.random()
+        if r < server.pacingRate:
+            payload = makeMsg(ERR_MSG, 2, reqId, *PACING_VIOLATION)
+        else:
+            payload = self._ticks(reqId, start, n, whatToShow)
+        self._schedule(reqId, payload)
+
+    def _ticks(self, reqId, start, n, whatToShow):
+        """At least n ticks from start, the same ticks for the same second every time"""
+        width = 4 if whatToShow == 'MIDPOINT' else 6
+        rows = []
+        t = start
+        # No ticks after a day of the silence
+        while len(rows) < n * width and t < start + DAY:
+            count = 7 if t % 97 == 0 else zlib.crc32(str(t).encode()) % 4
+            for i in range(count):
+                price = 100 + (t * 7 + i) % 100 / 100
+                if whatToShow == 'TRADES':
+                    rows += [t, i & 1, price, i + 1, 'NYSE', '']
+                elif whatToShow == 'BID_ASK':
+                    rows += [t, 0, price, round(price + 0.01, 2), i + 1, i + 2]
+                else:
+                    rows += [t, '', price, 0]
+            t += 1
+        msgId = {'TRADES': HISTORICAL_TICKS_LAST,
+                 'BID_ASK': HISTORICAL_TICKS_BID_ASK}.get(whatToShow, HISTORICAL_TICKS)
+        return makeMsg(msgId, reqId, len(rows) // width, *rows, 1)
+
+    def _update(self, reqId, step, formatDate):
+        """historicalDataUpdate with the forming bar until the cancel"""
+        fmt = '%Y%m%d' if step >= DAY else '%Y%m%d  %H:%M:%S'
+        rnd = self.random.random
+        time.sleep(self.server.latency)
+        price = 100.
+        bar = None
+        while not self._closed and reqId not in self._cancelled:
+            t = int(time.time()) // step * step
+            if bar is None or bar[0] != t:
+                bar = [t, price, price, price, 0, 0]  # time, open, high, low, volume, count
+            price = round(price + rnd() - 0.5, 2)
+            bar[2], bar[3] = max(bar[2], price), min(bar[3], price)
+            bar[4] += int(rnd() * 100)
+            bar[5] += 1
+            date = t if formatDate == 2 and step < DAY else time.strftime(fmt, time.localtime(t))
+            try:
+                self.send(makeMsg(HISTORICAL_DATA_UPDATE, reqId, bar[5], date, bar[1], price,
+                                  bar[2], bar[3], round((bar[1] + price) / 2, 3), bar[4]))
+            except OSError:
+                return
+            time.sleep(self.server.updateInterval)
+
+    def _bars(self, reqId, end, step, formatDate, n):
+        """n bars ending at the request end date, random walk prices"""
+        start = end // step * step - n * step
+        price = 100.
+        fmt = '%Y%m%d' if step >= DAY else '%Y%m%d  %H:%M:%S'
+        fields = [HISTORICAL_DATA, reqId,
+                  time.strftime('%Y%m%d  %H:%M:%S', time.localtime(start)),
+                  time.strftime('%Y%m%d  %H:%M:%S', time.localtime(start + n * step)), n]
+        rnd = self.random.random
+        for i in range(n):
+            t = start + i * step
+            date = t if formatDate == 2 and step < DAY else time.strftime(fmt, time.localtime(t))
+            o = price
+            price = round(price + rnd() - 0.5, 2)
+            hi, lo = max(o, price) + 0.01, min(o, price) - 0.01
+            fields += [date, o, hi, lo, price, int(rnd() * 1000), round((o + price) / 2, 3),
+                       int(rnd() * 100)]
+        return makeMsg(*fields)
+
+    def _schedule(self, reqId, payload):
+        with self._dueCond:
+            self._seq += 1
+            heapq.heappush(self._due, (time.monotonic() + self.server.latency,
+                                       self._seq, reqId, payload))
+            self._dueCond.notify()
+
+    def _sendDue(self):
+        while True:
+            with self._dueCond:
+                while not self._closed:
+                    if self._due:
+                        delay = self._due[0][0] - time.monotonic()
+                        if delay <= 0.: break
+                        self._dueCond.wait(delay)
+                    else:
+                        self._dueCond.wait()
+                if self._closed: return
+                _, _, reqId, payload = heapq.heappop(self._due)
+            if reqId in self._cancelled: continue
+            try:
+                self.send(payload)
+            except OSError:
+                return
+
+class FakeTws:
+    def __init__(self, host='127.0.0.1', port=0, barsPerRequest=2000, latency=0.,
+                 noDataRate=0., pacingRate=0., seed=0, updateInterval=1., headTimestamp=0):
+        self.barsPerRequest = barsPerRequest
+        self.updateInterval = updateInterval
+        self.headTimestamp = headTimestamp
+        self.latency = latency
+        self.noDataRate = noDataRate
+        self.pacingRate = pacingRate
+        self.seed = seed
+        self.nRequests = 0
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(16)
+        self.host, self.port = self._sock.getsockname()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve, name='FakeTws', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Connection(self, sock).start()
+
+    def stop(self):
+        self._sock.close()
+
+def serve(port=0, **kwargs):
+    """Run the fake TWS forever, for multiprocessing.Process"""
+    FakeTws(port=port, **kwargs).serve()
+
+#region main
+#-------------------------------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Fake TWS for the benchmarks')
+    parser.add_argument('--port', type=int, default=7497)
+    parser.add_argument('--bars', type=int, default=2000, help='bars per request')
+    parser.add_argument('--latency', type=float, default=0., help='response delay, seconds')
+    parser.add_argument('--noData', type=float, default=0., help='share of "no data" answers')
+    parser.add_argument('--pacing', type=float, default=0., help='share of pacing violations')
+    parser.add_argument('--update', type=float, default=1., help='keepUpToDate update interval')
+    args = parser.parse_args(args)
+
+    server = FakeTws(port=args.port, barsPerRequest=args.bars, latency=args.latency,
+                     noDataRate=args.noData, pacingRate=args.pacing,
+                     updateInterval=args.update)
+    print(f'Fake TWS is listening on {server.host}:{server.port}')
+    server.serve()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+#endregion main
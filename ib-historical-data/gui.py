@@ -9,13 +9,23 @@ Interactive Brokers TWS API -- Historical data loader
 GUI module
 '''
 #region import
+import os
 import sys
 import tkinter as tki
 from tkinter import filedialog
 from tkinter import messagebox
 import tkinter.ttk as ttk
 
+import json
 import queue
+import logging
+
+from config import config
+from logutils import init_logger, stop_logger
+from sinks import FORMATS, APPEND_FORMATS
+from sessions import getCalendar
+from progress import parseProgress
+from metrics import formatMetrics
 #endregion import
 
 def addvar(widget, onChange, default):
@@ -103,7 +113,8 @@ _barsize = dict(secs  = tuple('1 5 10 15 30'.split()),
                 hours = tuple('1 2 3 4 8'.split()),
                 day   = ('1',),
                 week  = ('1',),
-                month = ('1',))
+                month = ('1',),
+                ticks = ('all',))   # reqHistoricalTicks, see ticks.py
 
 _bartype = tuple('TRADES MIDPOINT BID ASK BID_ASK ADJUSTED_LAST HISTORICAL_VOLATILITY'
                 ' OPTION_IMPLIED_VOLATILITY REBATE_RATE FEE_RATE YIELD_BID YIELD_ASK'
@@ -136,14 +147,16 @@ class BarSize:
     def value(self):
         size = self.size.var.get()
         unit = self.units.var.get()
+        if unit == 'ticks': return 'ticks'
         if size == '1' and unit in ('mins', 'hours'):
             return f'1 {unit[:-1]}'
         return f'{size} {unit}'
 
     @property
     def seconds(self):
-        size = int(self.size.var.get())
         unit = self.units.var.get()
+        if unit == 'ticks': return 1
+        size = int(self.size.var.get())
         if unit[:3] == 'min': return size * 60
         return size * _duration2secs[unit[0].upper()]
 
@@ -159,6 +172,26 @@ class BarType:
     @property
     def value(self): return self.units.var.get()
 
+class OutputFormat:
+    def __init__(self, master, row, text, onChange):
+        self.lbl = ttk.Label(master, text=text)
+
+        self.units = addvar(ttk.Combobox(master, values=tuple(FORMATS), state='readonly'),
+                           onChange, 'csv')
+        self.lbl.grid(row=row, column=0, sticky=tki.NW)
+        self.units.grid(row=row, column=1, columnspan=2, sticky=tki.NSEW)
+
+    @property
+    def value(self): return self.units.var.get()
+
+    @property
+    def ext(self): return FORMATS[self.value][1]
+
+    def setChoices(self, values):
+        """Formats to choose from, the first one if the current is not there"""
+        self.units['values'] = values
+        if self.value not in values: self.units.var.set(values[0])
+
 class Gui:
     def __init__(self, gui2tws, tws2gui):
         self.gui2tws = gui2tws
@@ -177,19 +210,34 @@ class Gui:
         self.duration = Duration(root, 4, 'Duration', self._onParamChange)
         self.barSize = BarSize(root, 5, 'Bar size', self._onParamChange)
         self.barType = BarType(root, 6, 'Data Type', self._onParamChange)
+        self.format = OutputFormat(root, 7, 'Format', self._onParamChange)
+
+        var = tki.BooleanVar()
+        self.keepUpToDate = ttk.Checkbutton(root, text='Keep up to date', variable=var,
+                                            command=self._onParamChange)
+        self.keepUpToDate.var = var
+        self.keepUpToDate.grid(row=8, column=0, sticky=tki.NW)
 
         self.save = ttk.Button(root, text='Save', command=self.onSave)
-        self.save.grid(row=7, column=1, sticky=tki.NSEW)
+        self.save.grid(row=8, column=1, sticky=tki.NSEW)
 
         self.quit = ttk.Button(root, text='Quit', command=self.onQuit)
-        self.quit.grid(row=7, column=2, sticky=tki.NSEW)
+        self.quit.grid(row=8, column=2, sticky=tki.NSEW)
 
         var = tki.IntVar()
         self.prgrs = ttk.Progressbar(root, mode='determinate', orient=tki.HORIZONTAL, variable=var)
         self.prgrs.var = var
-        self.prgrs.grid(row=8, column=0, columnspan=3, sticky=tki.NSEW)
+        self.prgrs.grid(row=9, column=0, columnspan=3, sticky=tki.NSEW)
         var.set(0)
 
+        self.status = ttk.Label(root)
+        self.status.grid(row=10, column=0, columnspan=3, sticky=tki.NSEW)
+
+        self.metricsPanel = ttk.LabelFrame(root, text='Metrics')
+        self.metricsPanel.grid(row=11, column=0, columnspan=3, sticky=tki.NSEW)
+        self.metrics = ttk.Label(self.metricsPanel, justify=tki.LEFT, font='TkFixedFont')
+        self.metrics.grid(row=0, column=0, sticky=tki.NW)
+
         self._onParamChange()
 
         root.columnconfigure(0, weight=0)
@@ -201,33 +249,57 @@ class Gui:
         self.checkMsgFromTws()
 
     def _onParamChange(self, *args):
+        # Stream output is appended: only the appendable formats
+        self.format.setChoices(APPEND_FORMATS if self.keepUpToDate.var.get() else tuple(FORMATS))
+        if self.keepUpToDate.var.get():
+            # Stream: the same file is appended after every restart
+            self.file.value = (f'{self.symbol.value}-{self.barSize.value}-'
+                               f'{self.barType.value}{self.format.ext}')
+            self.save['state'] = ('disabled', 'normal')[bool(
+                self.symbol.value and self.prgrs.var.get() == 0)]
+            return
+
         self.file.value = (f'{self.endDate.value}-{self.symbol.value}-'
                            f'{self.duration.value}-{self.barSize.value}-'
-                           f'{self.barType.value}.csv')
+                           f'{self.barType.value}{self.format.ext}')
 
         self.save['state'] = ('disabled', 'normal')[bool(
             self.endDate.value and self.symbol.value and self.prgrs.var.get() == 0)]
 
     def checkMsgFromTws(self):
+        progress = metrics = None
         try:
             while not self.tws2gui.empty():
                 msg = self.tws2gui.get_nowait()
                 if msg.startswith('ERROR'):
                     messagebox.showerror('TWS Error', msg)
-                elif msg.startswith('NEWROW'):
-                    self.prgrs.step()
+                elif msg.startswith('PROGRESS'):
+                    # Only the latest progress matters
+                    progress = msg
+                elif msg.startswith('METRICS'):
+                    metrics = msg
                 elif msg.startswith('END'):
+                    progress = None
                     self.prgrs.var.set(0)
+                    self.status['text'] = ''
                     self._onParamChange()
                 else:
-                    # TODO: Error here?
-                    pass
                     logging.error(f'Unknown GUI message: {msg}')
         except queue.Empty:
             pass
 
+        if progress: self._onProgress(*parseProgress(progress))
+        if metrics: self.metrics['text'] = formatMetrics(json.loads(metrics[8:]))
+
         self.root.after(100, self.checkMsgFromTws)
 
+    def _onProgress(self, name, done, total, rate, eta):
+        self.prgrs['maximum'] = total
+        # Progress var == 0 means 'idle'
+        self.prgrs.var.set(max(done, 1))
+        self.status['text'] = (f'{done}/{total} bars, {rate:.0f} bars/s, '
+                               f'ETA {int(eta) // 60}:{int(eta) % 60:02d}')
+
     def run(self):
         self.init_gui()
         self.root.mainloop()
@@ -239,20 +311,50 @@ class Gui:
             self.root.destroy()
 
     def onSave(self):
-        durSecs = self.duration.seconds
-        barSecs = self.barSize.seconds
-        lines = durSecs/barSecs
-        if durSecs >= _duration2secs['W']: lines = int(lines*5/7)
+        if self.barSize.value == 'ticks':
+            # Tick count is unknown: the progress total comes with the first report
+            self.prgrs['maximum'] = 1
+            self.prgrs.var.set(1)
+            self._onParamChange()
+            fileName = os.path.splitext(self.file.value)[0]
+            self.gui2tws.put(f'TICKS {self.symbol.value}|{self.endDate.value}|{self.duration.value}'
+                           f'|{self.barType.value}|{self.path.value}/{fileName}')
+            return
+
+        calendar = getCalendar(config.calendar)
+        if calendar:
+            # Exact count of the bars in the trading sessions
+            endDate = '' if self.keepUpToDate.var.get() else self.endDate.value
+            if endDate and ' ' not in endDate: endDate += ' 00:00:00'
+            lines = calendar.periodBars(endDate, self.duration.value, self.barSize.value)
+        else:
+            durSecs = self.duration.seconds
+            barSecs = self.barSize.seconds
+            lines = durSecs/barSecs
+            if durSecs >= _duration2secs['W']: lines = int(lines*5/7)
         self.prgrs['maximum'] = lines
         self.prgrs.var.set(1)
         self._onParamChange()
 
+        if self.keepUpToDate.var.get():
+            self.gui2tws.put(f'STREAM {self.symbol.value}|{self.duration.value}'
+                           f'|{self.barSize.value}|{self.barType.value}|{self.path.value}/{self.file.value}'
+                           f'|{self.format.value}')
+            return
+
         self.gui2tws.put(f'SAVE {self.symbol.value}|{self.endDate.value}|{self.duration.value}'
-                       f'|{self.barSize.value}|{self.barType.value}|{self.path.value}/{self.file.value}')
+                       f'|{self.barSize.value}|{self.barType.value}|{self.path.value}/{self.file.value}'
+                       f'|{self.format.value}')
 
 def runGui(gui2tws, tws2gui):
-    gui = Gui(gui2tws, tws2gui)
-    gui.run()
+    # The logger thread of the parent is not forked: the GUI process needs its own
+    init_logger('gui', logpath=config.logpath, loglevel=config.loglevel)
+    try:
+        gui = Gui(gui2tws, tws2gui)
+        gui.run()
+    finally:
+        # The process exits without atexit handlers
+        stop_logger()
 
 #region main
 #-------------------------------------------------------------------------------
@@ -8,60 +8,222 @@ Interactive Brokers TWS API -- Historical data loader
 
 Interactive Brokers Client class.
 
-Client has to check not just messages from the TWS but messages from the GUI as well.
-To do so I just copied the EClient.run() method body from the API code and
-added onLoopIteration() hook call inside the EClient infinite loop.
-I will use this hook to process messages from other sources (GUI), not just TWS.
-
-Uncomment self.onIdle() to create another hook to process something while
-no messages are comming from the TWS.
+Client has to process not just messages from the TWS but commands from other
+sources (GUI) and timers as well.
+To do so I copied the EClient.run() method body from the API code and made
+the TWS reader queue the only wakeup source of the loop:
+- post() puts a command into the same queue the TWS messages come from;
+- addCommandSource() starts a thread forwarding the commands from
+  another queue (e.g. multiprocessing.Queue from the GUI) with post();
+- callLater() posts an empty command (wakeup) after the delay.
+TWS messages could be recorded to the wire log with record() and
+replayed later without the TWS (wirelog.replay()).
+Commands are processed by the onCommand() hook as soon as they arrive,
+the TWS message path does no extra work when there are no commands.
 '''
 
 #region import
+import sys
+import time
 import traceback
 import logging
 import queue
+import threading
+from itertools import islice
 
 from ibapi import (decoder, reader, comm)
 from ibapi.client import EClient
 from ibapi.common import *
-from ibapi.utils import BadMessage
+from ibapi.utils import BadMessage, decode
+from ibapi.server_versions import MIN_SERVER_VER_SYNT_REALTIME_BARS
+
+from bars import parseBars
+from ticks import TICK_WIDTH, parseTicks
 #endregion import
 
+_trace = logging.getLogger('trace')
+
+# Command: the replayed session is over (see wirelog.replay())
+REPLAY_END = object()
+
+class Command:
+    """Not a TWS message: command for the client message loop"""
+    __slots__ = ('msg',)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+class BarDecoder(decoder.Decoder):
+    """
+    Decoder passing the historical bars of the message as one BAR_DTYPE array
+    to wrapper.historicalDataArray(reqId, array) - no BarData per bar.
+    Wrappers without historicalDataArray() get the usual historicalData() calls.
+    Historical ticks go the same way: one TICK_DTYPES array to
+    wrapper.historicalTicksArray(reqId, whatToShow, array, done).
+    """
+    def processHistoricalDataMsg(self, fields):
+        historicalDataArray = getattr(self.wrapper, 'historicalDataArray', None)
+        if historicalDataArray is None:
+            return decoder.Decoder.processHistoricalDataMsg(self, fields)
+
+        next(fields)
+        synthetic = self.serverVersion >= MIN_SERVER_VER_SYNT_REALTIME_BARS
+        if not synthetic: decode(int, fields)
+
+        reqId = decode(int, fields)
+        startDateStr = decode(str, fields)
+        endDateStr = decode(str, fields)
+        itemCount = decode(int, fields)
+        width = 8 if synthetic else 9
+        historicalDataArray(reqId, parseBars(list(islice(fields, itemCount * width)),
+                                             itemCount, width))
+        self.wrapper.historicalDataEnd(reqId, startDateStr, endDateStr)
+
+    def _processTicks(self, fields, whatToShow, fallback):
+        historicalTicksArray = getattr(self.wrapper, 'historicalTicksArray', None)
+        if historicalTicksArray is None: return fallback(self, fields)
+
+        next(fields)
+        reqId = decode(int, fields)
+        tickCount = decode(int, fields)
+        array = parseTicks(whatToShow, list(islice(fields, tickCount * TICK_WIDTH[whatToShow])),
+                           tickCount)
+        historicalTicksArray(reqId, whatToShow, array, decode(bool, fields))
+
+    def processHistoricalTicks(self, fields):
+        self._processTicks(fields, 'MIDPOINT', decoder.Decoder.processHistoricalTicks)
+
+    def processHistoricalTicksBidAsk(self, fields):
+        self._processTicks(fields, 'BID_ASK', decoder.Decoder.processHistoricalTicksBidAsk)
+
+    def processHistoricalTicksLast(self, fields):
+        self._processTicks(fields, 'TRADES', decoder.Decoder.processHistoricalTicksLast)
+
+    msgId2handleInfo = dict(decoder.Decoder.msgId2handleInfo)
+    msgId2handleInfo[decoder.IN.HISTORICAL_DATA] = decoder.HandleInfo(proc=processHistoricalDataMsg)
+    msgId2handleInfo[decoder.IN.HISTORICAL_TICKS] = decoder.HandleInfo(proc=processHistoricalTicks)
+    msgId2handleInfo[decoder.IN.HISTORICAL_TICKS_BID_ASK] = decoder.HandleInfo(
+        proc=processHistoricalTicksBidAsk)
+    msgId2handleInfo[decoder.IN.HISTORICAL_TICKS_LAST] = decoder.HandleInfo(
+        proc=processHistoricalTicksLast)
+
 class IBClient(EClient):
+    # Max time the loop sleeps without checking the connection state
+    idleTimeout = 1.
+    # Decoder of the TWS messages, see BarDecoder
+    decoderClass = decoder.Decoder
+
     def __init__(self, wrapper):
         EClient.__init__(self, wrapper)
+        self.done = False
+        self.recorder = None
+        self.replaying = False
+        self.decodeTime = None  # metrics.Histogram of decoder.interpret() time
+        self.traceSample = 0    # Trace every N-th TWS message to the 'trace' logger
+        self._nTrace = 0
+        self._timer = None
+        self._timerAt = None
+        self._timerCond = threading.Condition()
+
+    def post(self, msg):
+        """Thread safe: process the msg in the message loop thread"""
+        self.msg_queue.put(Command(msg))
+
+    def addCommandSource(self, source):
+        """Forward all the messages from the source queue to the message loop"""
+        def forward():
+            while True:
+                msg = source.get()
+                self.post(msg)
+                if msg == 'EXIT': break
+
+        threading.Thread(target=forward, name='Commands', daemon=True).start()
+
+    def connect(self, host, port, clientId):
+        EClient.connect(self, host, port, clientId)
+        if self.decoder is not None and self.decoderClass is not decoder.Decoder:
+            self.decoder = self.decoderClass(self.wrapper, self.serverVersion())
+
+    def record(self, fileName):
+        """Save all the TWS messages to the wire log (see wirelog.py), call after connect()"""
+        from wirelog import WireLogWriter
+        self.recorder = WireLogWriter(fileName, self.serverVersion(), self.twsConnectionTime())
+
+    def isConnected(self):
+        return self.replaying or EClient.isConnected(self)
+
+    def sendMsg(self, msg):
+        # Replayed session has no TWS to send the requests to
+        if self.conn is None and self.replaying: return
+        EClient.sendMsg(self, msg)
+
+    def callLater(self, delay):
+        """
+        Wake up the message loop (onCommand(None)) after the delay.
+        Only the earliest pending wakeup is kept.
+        """
+        at = time.monotonic() + delay
+        with self._timerCond:
+            if self._timerAt is not None and self._timerAt <= at: return
+            self._timerAt = at
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._timerLoop, name='Timer', daemon=True)
+                self._timer.start()
+            self._timerCond.notify()
+
+    def _timerLoop(self):
+        with self._timerCond:
+            while True:
+                if self._timerAt is None:
+                    self._timerCond.wait()
+                    continue
+                delay = self._timerAt - time.monotonic()
+                if delay > 0.:
+                    self._timerCond.wait(delay)
+                    continue
+                self._timerAt = None
+                self.post(None)
 
     def run(self):
         """
         This is the function that has the message loop.
 
         Extended copy of the EClient run()
-        + onLoopIteration() hook
-        + onIdle() hook
+        + onCommand() hook
         """
         try:
             while not self.done and (self.isConnected()
                         or not self.msg_queue.empty()):
                 try:
                     try:
-                        # Hook to process messages/events from other sources.
-                        self.onLoopIteration()
-                        text = self.msg_queue.get(block=True, timeout=0.2)
+                        text = self.msg_queue.get(block=True, timeout=self.idleTimeout)
+                        if text.__class__ is Command:
+                            # Message from other sources (GUI, timers)
+                            if text.msg is REPLAY_END: self.replaying = False
+                            else: self.onCommand(text.msg)
+                            continue
                         if len(text) > MAX_MSG_LEN:
                             self.wrapper.error(NO_VALID_ID, BAD_LENGTH.code(),
                                 "%s:%d:%s" % (BAD_LENGTH.msg(), len(text), text))
                             self.disconnect()
                             break
                     except queue.Empty:
-                        # Hook to process something while no messages are
-                        # comming from the TWS.
-                        # self.onIdle() 
-                        logging.debug("queue.get: empty")
+                        # Nothing happened - just check the connection state
+                        pass
                     else:
+                        if self.recorder: self.recorder.write(text)
                         fields = comm.read_fields(text)
-                        logging.debug("fields %s", fields)
-                        self.decoder.interpret(fields)
+                        if self.traceSample:
+                            self._nTrace += 1
+                            if self._nTrace >= self.traceSample:
+                                self._nTrace = 0
+                                _trace.info("fields %s", fields)
+                        if self.decodeTime is None:
+                            self.decoder.interpret(fields)
+                        else:
+                            started = time.perf_counter()
+                            self.decoder.interpret(fields)
+                            self.decodeTime.record(time.perf_counter() - started)
                 except (KeyboardInterrupt, SystemExit):
                     logging.info("detected KeyboardInterrupt, SystemExit")
                     self.keyboardInterrupt()
@@ -71,18 +233,16 @@ class IBClient(EClient):
                     self.conn.disconnect()
                 except Exception:
                     logging.error(traceback.format_exc())
-                logging.debug("conn:%d queue.sz:%d",
-                             self.isConnected(),
-                             self.msg_queue.qsize())
         finally:
+            with self._timerCond:
+                self._timerAt = None
+            if self.recorder: self.recorder.close()
             self.disconnect()
 
-    def onLoopIteration(self):
+    def onCommand(self, msg):
+        """msg -- command from post() or None for the callLater() wakeup"""
         pass
 
-#    def onIdle(self):
-#        pass
-
 #region main
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -90,4 +250,3 @@ if __name__ == '__main__':
     print('This is a python library - not standalone application')
     sys.exit(-1)
 #endregion main
- 
\ No newline at end of file
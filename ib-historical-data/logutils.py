@@ -12,7 +12,13 @@ Logging utils
 import os
 import sys
 import time
+import queue
+import atexit
 import logging
+from logging.handlers import (QueueHandler, QueueListener,
+                              RotatingFileHandler, TimedRotatingFileHandler)
+
+from config import config
 #endregion import
 
 #region Utils
@@ -32,23 +38,76 @@ def loglevel_to_int(loglevel):
     if loglevel.isdigit(): return int(loglevel)
     return _logLevel_table[loglevel.upper()]
 
-def init_logger(suffix, logpath='log', loglevel=logging.INFO):
+class _QueueHandler(QueueHandler):
+    """
+    QueueHandler formats the record in the calling thread, this one leaves
+    the formatting to the listener thread as well. Log arguments must not be
+    changed after the call - true for all the calls in this project.
+    """
+    def prepare(self, record):
+        return record
+
+_listener = None
+
+def stop_logger():
+    """Write out the queued records and stop the logger thread"""
+    global _listener
+    if _listener is None: return
+    _listener.stop()
+    _listener = None
+
+def init_logger(suffix, logpath='log', loglevel=logging.INFO,
+                maxBytes=None, backupCount=None, when=None, queued=True):
+    """
+    maxBytes    -- rotate the log file when it grows bigger, 0 - never
+    when        -- rotate the log file by time instead ('midnight', 'H'...),
+                   see TimedRotatingFileHandler
+    backupCount -- number of the rotated files to keep
+    queued      -- format and write the records in the background thread
+    The rotation settings are config.logMaxBytes, logRotateWhen, logBackupCount
+    by default.
+    """
+    global _listener
     loglevel = loglevel_to_int(loglevel)
+    if maxBytes is None: maxBytes = config.logMaxBytes
+    if backupCount is None: backupCount = config.logBackupCount
+    if when is None: when = config.logRotateWhen
 
     if not os.path.exists(logpath): os.makedirs(logpath)
 
     recfmt = '(%(threadName)s) %(asctime)s.%(msecs)03d %(levelname)s %(filename)s:%(lineno)d %(message)s'
     timefmt = '%Y-%m-%d %H:%M:%S'
 
-    logging.basicConfig(filename=time.strftime(f'{logpath}/FS-{suffix}.%Y%m%d_%H%M%S.log'),
-                        filemode="w",
-                        level=loglevel,
-                        format=recfmt, datefmt=timefmt)
+    fileName = time.strftime(f'{logpath}/FS-{suffix}.%Y%m%d_%H%M%S.log')
+    if when:
+        handler = TimedRotatingFileHandler(fileName, when=when, backupCount=backupCount)
+    elif maxBytes:
+        handler = RotatingFileHandler(fileName, maxBytes=maxBytes, backupCount=backupCount)
+    else:
+        handler = logging.FileHandler(fileName, mode='w')
+    handler.setFormatter(logging.Formatter(recfmt, timefmt))
 
-    logger = logging.getLogger()
     console = logging.StreamHandler()
     console.setLevel(logging.ERROR)
-    logger.addHandler(console)
+
+    # The process could be forked from the one with the logger set up already
+    stop_logger()
+    logger = logging.getLogger()
+    for h in logger.handlers[:]: logger.removeHandler(h)
+    logger.setLevel(loglevel)
+
+    if queued:
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, handler, console, respect_handler_level=True)
+        _listener.start()
+        logger.addHandler(_QueueHandler(records))
+        atexit.register(stop_logger)
+    else:
+        logger.addHandler(handler)
+        logger.addHandler(console)
+
+    # ibapi logs every request and callback with INFO - too much for the hot path
+    if loglevel > logging.DEBUG: logging.getLogger('ibapi').setLevel(logging.WARNING)
 
     return logger
 #endregion Utils
@@ -25,18 +25,33 @@ To setup the button IB TWS side app:
 #region import
 import sys
 import multiprocessing as mp
-import queue
 import logging
+from datetime import datetime
 
 from ibapi.wrapper import EWrapper
-from ibapi.contract import Contract
+from ibapi.contract import Contract, ContractDetails
 from ibapi.order import Order
-from ibapi.common import BarData, TickerId
+from ibapi.common import (BarData, TickerId, ListOfHistoricalTick,
+                          ListOfHistoricalTickBidAsk, ListOfHistoricalTickLast)
 
 from config import config
-from gui import runGui
 from logutils import init_logger
-from ibclient import IBClient
+from ibclient import IBClient, BarDecoder
+from pacing import Pacer
+from scheduler import Scheduler
+from backfill import makeJob
+from store import BarStore, makeStoreJob
+from stream import makeStreamJob
+from ticks import TickSink, makeTickJob, ticksToArray
+from sessions import getCalendar, expectBars
+from contracts import ContractCache, ContractResolver
+from adjust import AdjustmentTable
+from timeutils import durationStart, parseEndDate, toEpoch
+from writer import Writer, AsyncSink
+from progress import ProgressReporter
+from metrics import Metrics, MetricsReporter
+from sinks import makeSink
+from wirelog import logName
 #endregion import
 
 def makeSimpleContract(symbol, secType = "STK", currency = "USD", exchange = "SMART"):
@@ -58,12 +73,42 @@ class App(IBClient, EWrapper):
         EWrapper.__init__(self)
         IBClient.__init__(self, wrapper=self)
 
-        self.gui2tws = gui2tws
         self.tws2gui = tws2gui
+        self.traceSample = config.traceSample
+        if config.epochDates: self.decoderClass = BarDecoder
+        if gui2tws is not None: self.addCommandSource(gui2tws)
         self.nKeybInt = 0
         self.started = False
         self._lastId = None
-        self._file = None
+        self.scheduler = Scheduler(self,
+                                   Pacer(config.pacingRequests, config.pacingPeriod,
+                                         config.pacingIdentical, config.pacingPerContract,
+                                         config.pacingContractPeriod),
+                                   maxInFlight=config.maxInFlight,
+                                   backoff=config.pacingBackoff,
+                                   onJobDone=self.onJobDone)
+        self.progress = ProgressReporter(tws2gui, self.scheduler, config.progressRate)
+        self.store = BarStore(config.storepath) if config.storepath else None
+        self.adjustments = None
+        if self.store and config.adjustments:
+            self.adjustments = AdjustmentTable(config.adjustments, config.adjustMaxAge)
+        self.calendar = getCalendar(config.calendar)
+        self.resolver = None
+        if config.contractCache is not None:
+            self.resolver = ContractResolver(self, ContractCache(config.contractCache,
+                                                                 config.contractMaxAge,
+                                                                 config.headRetry))
+        self.writer = None
+        if config.writerThread:
+            self.writer = Writer(config.writerQueueSize)
+            self.writer.start()
+        self.metrics = None
+        if config.metricsInterval:
+            metrics = Metrics(self, self.scheduler, self.writer)
+            self.scheduler.metrics = metrics
+            self.decodeTime = metrics.decode
+            self.metrics = MetricsReporter(metrics, config.metricsInterval,
+                                           config.metricsFile, tws2gui)
 
     @property
     def nextId(self):
@@ -97,12 +142,138 @@ class App(IBClient, EWrapper):
 #region GuiMsgProcessors
 #----------------------------------------------------------------------------
 
+    def save(self, symbol, endDate, duration, barSize, barType, fileName, fmt='csv'):
+        """
+        Download the historical data to the file
+        fmt -- output format: csv, npy or parquet (see sinks.FORMATS)
+        The job is submitted when the contract is resolved
+        """
+        def make(contract, head):
+            return self.makeJob(fileName, contract, endDate, duration, barSize, barType,
+                                makeSink(fileName, fmt), head)
+        self.resolveJob(fileName, makeSimpleContract(symbol), barType, make)
+
+    def stream(self, symbol, duration, barSize, barType, fileName, fmt='csv'):
+        """
+        Download `duration` up to now and keep the file up to date
+        until the exit (keepUpToDate subscription)
+        fmt -- output format: csv or npy (must be appendable)
+        """
+        def make(contract, head):
+            sink = makeSink(fileName, fmt, append=True)
+            if self.writer: sink = AsyncSink(sink, self.writer, config.writerBatchSize)
+            job = makeStreamJob(fileName, contract, duration, barSize, barType,
+                                sink, onLoaded=self.onStreamLoaded,
+                                formatDate=2 if config.epochDates else 1)
+            calendar = self.contractCalendar(contract)
+            if calendar: expectBars(job, calendar)
+            return job
+        self.resolveJob(fileName, makeSimpleContract(symbol), barType, make)
+
+    def ticks(self, symbol, endDate, duration, whatToShow, fileName):
+        """
+        Download the historical ticks (reqHistoricalTicks) of the period
+        to the directory `fileName` (.npy file per column, see ticks.TickSink)
+        whatToShow -- TRADES, BID_ASK or MIDPOINT
+        """
+        def make(contract, head):
+            end = parseEndDate(endDate)[0]
+            start = toEpoch(durationStart(end, duration))
+            if head and start < head:
+                start = min(head, toEpoch(end))
+                logging.info(f'{fileName}: no ticks before {datetime.fromtimestamp(start)}')
+            sink = TickSink(fileName, whatToShow)
+            if self.writer and not self.store:
+                sink = AsyncSink(sink, self.writer, config.writerBatchSize)
+            return makeTickJob(fileName, contract, start, toEpoch(end), whatToShow, sink,
+                               store=self.store, writer=self.writer,
+                               calendar=self.contractCalendar(contract))
+        self.resolveJob(fileName, makeSimpleContract(symbol), whatToShow, make)
+
+    def contractCalendar(self, contract):
+        """
+        The session calendar if the contract trades by it, None otherwise:
+        the closed market periods are stored as covered, the repair and the
+        tick segments follow the sessions - wrong sessions lose the data for good
+        """
+        if self.calendar is None: return None
+        if self.calendar.matches(contract): return self.calendar
+        logging.info(f'{contract.symbol}: not a {self.calendar.name} contract '
+                     f'({contract.secType} {contract.primaryExchange or "unresolved"}), '
+                     f'no session calendar')
+        return None
+
+    def resolveJob(self, name, contract, barType, make):
+        """
+        Submit the job make(contract, head) when the contract is resolved.
+        The job which cannot be made (bad parameters, output) is reported by onJobFailed()
+        """
+        def submit(contract, head):
+            try:
+                job = make(contract, head)
+            except Exception as e:
+                self.onJobFailed(name, e)
+                return
+            self.submit(job)
+        try:
+            self.resolve(contract, barType, submit)
+        except Exception as e:
+            self.onJobFailed(name, e)
+
+    def resolve(self, contract, barType, callback):
+        """
+        callback(contract, head) with the resolved contract and the head timestamp,
+        right away if cached or there is no resolver
+        """
+        if self.resolver: self.resolver.resolve(contract, barType, 1, callback)
+        else: callback(contract, None)
+
+    def submit(self, job):
+        # Before the scheduler: the job without requests is done right away
+        self.onSubmit(job)
+        self.scheduler.submit(job)
+        self.onWakeup()
+
+    def makeJob(self, name, contract, endDate, duration, barSize, barType, sink, head=None):
+        """
+        Job writing the historical data to the sink in the writer thread
+        head -- head timestamp: no requests for the data before it
+        """
+        if ' ' not in endDate: endDate += ' 00:00:00'
+        # Epoch dates: bars go as typed arrays, no date strings to parse
+        formatDate = 2 if config.epochDates else 1
+        start = None
+        if head:
+            end = parseEndDate(endDate)[0]
+            if toEpoch(durationStart(end, duration)) < head:
+                start = min(datetime.fromtimestamp(head), end)
+                logging.info(f'{name}: no data before {start}')
+
+        calendar = self.contractCalendar(contract)
+        if self.store:
+            job = makeStoreJob(name, self.store, contract, endDate, duration,
+                               barSize, barType, sink, writer=self.writer, start=start,
+                               allowResample=config.resample, calendar=calendar,
+                               repair=config.repair, adjustments=self.adjustments,
+                               formatDate=formatDate)
+        else:
+            if self.writer: sink = AsyncSink(sink, self.writer, config.writerBatchSize)
+            job = makeJob(name, contract, endDate, duration, barSize, barType, sink,
+                          start=start, formatDate=formatDate)
+        if calendar: expectBars(job, calendar)
+        return job
+
     def exit(self):
         """
         Exit from the application
         """
         self.done = True
         self._onStop()
+        self.stopWriter()
+
+    def stopWriter(self):
+        """Wait until everything is written to disk"""
+        if self.writer: self.writer.stop()
 
 #endregion GuiMsgProcessors
 
@@ -112,46 +283,79 @@ class App(IBClient, EWrapper):
     def onStart(self):
         logging.info('Main logic started')
 
+    def onSubmit(self, job):
+        """The job is submitted to the scheduler"""
+        pass
+
     def onStop(self):
-        if self._file: self._file.close()
+        self.scheduler.close()
+        if self.metrics: self.metrics.dump()
         logging.info('Main logic stopped')
 
-    def onLoopIteration(self):
-        logging.debug('onLoopIteration()')
-        try:
-            msg = self.gui2tws.get_nowait()
+    def onCommand(self, msg):
+        if callable(msg):
+            # Function posted from another thread
+            msg()
+        elif msg is not None:
             logging.info(f'GUI MESSAGE: {msg}')
             if msg.startswith('SAVE '):
-                if self._file:
-                    logging.error('Previuos work is still in progress.')
                 msg = msg[5:] # Skip 'SAVE '
 
-                symbol, endDate, duartion, barSize, barType, fileName = msg.split('|')
-                if ' ' not in endDate: endDate += ' 00:00:00'
+                self.save(*msg.split('|'))
+            elif msg.startswith('STREAM '):
+                msg = msg[7:] # Skip 'STREAM '
 
-                self._file = open(fileName, 'w')
-                self._write('Date, Time, Open, Close, Min, Max, Trades, Volume, Average')
+                self.stream(*msg.split('|'))
+            elif msg.startswith('TICKS '):
+                msg = msg[6:] # Skip 'TICKS '
 
-                self.reqHistoricalData(self.nextId, makeSimpleContract(symbol),
-                                      endDate, duartion, barSize, barType, 1, 1, False, [])
-
-                # TODO Add message processing here
-                pass
+                self.ticks(*msg.split('|'))
             elif msg == 'EXIT':
                 self.exit()
+                return
             else:
                 logging.error(f'Unknown GUI message: {msg}')
-        except queue.Empty:
-            pass
 
-        self.count = 0
+        self.onWakeup()
 
-    def _write(self, msg):
-        if self._file:
-            self._file.write(msg)
-            self._file.write('\n')
-        else:
-            print(msg)
+    def onWakeup(self):
+        """
+        Send the queued requests, report the progress
+        and schedule the next wakeup if needed
+        """
+        delay = self.scheduler.pump() if self.started else None
+        if self.resolver:
+            self.resolver.tick()
+            if self.resolver.busy: delay = 1. if delay is None else min(delay, 1.)
+        self.progress.tick()
+        if self.metrics: self.metrics.tick()
+        # Streams alone do not need the timer: updates wake the loop up
+        if self.scheduler.nQueued or self.scheduler.nInFlight:
+            interval = self.progress.interval
+            delay = interval if delay is None else min(delay, interval)
+        if delay is not None: self.callLater(delay)
+
+    def onJobDone(self, job):
+        # Job output is closed (and counted by the store jobs) in the writer thread:
+        # the job is finished when the writer is done with everything queued before
+        if self.writer: self.writer.call(self.post, lambda: self.onJobFinished(job))
+        else: self.onJobFinished(job)
+
+    def onJobFinished(self, job):
+        """The job is done and its output is written"""
+        logging.info(f'Job {job.name} done: {job.nBars} bars')
+        self.tws2gui.put(f'END {job.name}')
+
+    def onJobFailed(self, name, error):
+        """The job cannot be made: nothing is requested"""
+        logging.warning(f'Job {name} failed: {error!r}')
+        self.tws2gui.put(f'ERROR {name}: {error}')
+        # The GUI waits for the job end
+        self.tws2gui.put(f'END {name}')
+
+    def onStreamLoaded(self, job):
+        logging.info(f'Stream {job.name}: {job.nBars} initial bars, updating')
+        self.tws2gui.put(f'END {job.name}')
 
     def nextValidId(self, orderId: int):
         """
@@ -164,6 +368,7 @@ class App(IBClient, EWrapper):
 
         self._lastId = orderId - 1
         self._onStart()
+        self.onWakeup()
 
     def historicalData(self, reqId: int, bar: BarData):
         """ returns the requested historical data bars
@@ -180,25 +385,62 @@ class App(IBClient, EWrapper):
         average  - the bar's Weighted Average Price
         hasGaps  - indicates if the data has gaps or not. """
 
-        EWrapper.historicalData(self, reqId, bar)
-        
-        date, time = bar.date.split()
-        self._write(f'{date},{time},{bar.open},{bar.close},{bar.low},{bar.high},{bar.barCount},{bar.volume},{bar.average}')
-        self.tws2gui.put('NEWROW')
+        # No EWrapper.historicalData() call: it only logs, but pays for
+        # inspect.stack() on every bar even with logging off
+        self.scheduler.onBar(reqId, bar)
+
+    def historicalDataArray(self, reqId:int, array):
+        """
+        Callback from BarDecoder: all the bars of the message as BAR_DTYPE array
+        instead of historicalData() per bar
+        """
+        self.scheduler.onArray(reqId, array)
+
+    def historicalTicksArray(self, reqId: int, whatToShow: str, array, done: bool):
+        """Callback from BarDecoder: the historical ticks as TICK_DTYPES array"""
+        self.scheduler.onArray(reqId, array)
+        if done and self.scheduler.onEnd(reqId): self.onWakeup()
+
+    def historicalTicks(self, reqId: int, ticks: ListOfHistoricalTick, done: bool):
+        self.historicalTicksArray(reqId, 'MIDPOINT', ticksToArray('MIDPOINT', ticks), done)
+
+    def historicalTicksBidAsk(self, reqId: int, ticks: ListOfHistoricalTickBidAsk, done: bool):
+        self.historicalTicksArray(reqId, 'BID_ASK', ticksToArray('BID_ASK', ticks), done)
+
+    def historicalTicksLast(self, reqId: int, ticks: ListOfHistoricalTickLast, done: bool):
+        self.historicalTicksArray(reqId, 'TRADES', ticksToArray('TRADES', ticks), done)
+
+    def contractDetails(self, reqId: int, contractDetails: ContractDetails):
+        if self.resolver: self.resolver.onContractDetails(reqId, contractDetails)
+
+    def contractDetailsEnd(self, reqId: int):
+        if self.resolver and self.resolver.onContractDetailsEnd(reqId): self.onWakeup()
+
+    def headTimestamp(self, reqId: int, headTimestamp: str):
+        if self.resolver and self.resolver.onHeadTimestamp(reqId, headTimestamp): self.onWakeup()
+
+    def historicalDataUpdate(self, reqId: int, bar: BarData):
+        """The forming bar of the keepUpToDate request"""
+        self.scheduler.onUpdate(reqId, bar)
 
     def historicalDataEnd(self, reqId:int, start:str, end:str):
         """ Marks the ending of the historical bars reception. """
         EWrapper.historicalDataEnd(self, reqId, start, end)
-        if self._file:
-           self._file.close()
-           self._file = None
-        self.tws2gui.put('END')
+        # The request slot is free now
+        if self.scheduler.onEnd(reqId): self.onWakeup()
 
     def error(self, reqId:TickerId, errorCode:int, errorString:str):
         """This event is called when there is an error with the
         communication or when TWS wants to send a message to the client."""
         EWrapper.error(self, reqId, errorCode, errorString)
 
+        handled = self.scheduler.onError(reqId, errorCode, errorString)
+        # Unresolved contract is not fatal: the job goes with the contract as is
+        if not handled and self.resolver:
+            handled = self.resolver.onError(reqId, errorCode, errorString)
+        self.onWakeup()
+        if handled: return
+
         # Error messages with codes (2104, 2106, 2107, 2108) are not real errors but information messages
         if errorCode not in (2104, 2106, 2107, 2108): self.tws2gui.put(f'ERROR {errorCode}: {errorString}')
 
@@ -207,6 +449,9 @@ class App(IBClient, EWrapper):
 #region main
 #-------------------------------------------------------------------------------
 def main():
+    # Headless mode (batch.py) must not import tkinter
+    from gui import runGui
+
     init_logger('history', logpath=config.logpath, loglevel=config.loglevel)
 
     gui2tws = mp.Queue()
@@ -225,7 +470,9 @@ def main():
     app = App(gui2tws, tws2gui)
     app.connect('127.0.0.1', config.twsport, clientId=config.clientId)
     logging.info(f'Server version: {app.serverVersion()}, Connection time: {app.twsConnectionTime()}')
+    if config.recordpath and app.isConnected(): app.record(logName(config.recordpath, 'history'))
     app.run()
+    app.stopWriter()
 
     gui.join()
 
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Hot path metrics.
+
+- request latency: reqHistoricalData -> first bar and -> historicalDataEnd;
+- decode time: decoder.interpret() of one message including the callbacks;
+- msg_queue depth, sampled on every wakeup;
+- writer lag: time a batch waits in the writer queue;
+- pacing bucket occupancy, requests queued and in flight, bars/sec.
+
+Metrics.snapshot() is a plain dict (JSON-ready), formatMetrics() - its short
+text form. The App dumps the snapshot every config.metricsInterval seconds
+to the log, to the JSON lines file (config.metricsFile) and to the GUI.
+'''
+
+#region import
+import sys
+import time
+import json
+import math
+import logging
+#endregion import
+
+class Histogram:
+    """
+    Log scale histogram: 4 buckets per power of 2 (~19% resolution)
+    starting from `minValue`. Cheap record(), approximate percentiles.
+    """
+    nBuckets = 128
+
+    def __init__(self, minValue=1e-6):
+        self.minValue = minValue
+        self.buckets = [0] * self.nBuckets
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def record(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max: self.max = value
+        if value <= self.minValue:
+            self.buckets[0] += 1
+        else:
+            self.buckets[min(int(math.log2(value / self.minValue) * 4.) + 1,
+                             self.nBuckets - 1)] += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket the p-th percentile falls into"""
+        if not self.count: return 0.
+        rank = p / 100. * self.count
+        n = 0
+        for i, bucketCount in enumerate(self.buckets):
+            n += bucketCount
+            if n >= rank: return min(self.minValue * 2. ** (i / 4.), self.max)
+        return self.max
+
+    def snapshot(self, scale=1.):
+        """dict of the stats, values are multiplied by scale (1000 - ms)"""
+        if not self.count: return {'count': 0}
+        return {'count': self.count,
+                'mean': self.sum / self.count * scale,
+                'p50': self.percentile(50) * scale,
+                'p95': self.percentile(95) * scale,
+                'p99': self.percentile(99) * scale,
+                'max': self.max * scale}
+
+class Metrics:
+    def __init__(self, client, scheduler, writer=None):
+        self.client = client
+        self.scheduler = scheduler
+        self.writer = writer
+
+        self.firstBar = Histogram()
+        self.requestTime = Histogram()
+        self.decode = Histogram()
+        self.queueDepth = Histogram(minValue=1)
+        self.nRequests = 0
+        self.nFailed = 0
+
+        self._started = time.monotonic()
+        self._last = (self._started, 0)  # time, bars
+
+    def onRequestDone(self, request, failed=False):
+        self.nRequests += 1
+        if failed: self.nFailed += 1
+        if request.firstAt is not None: self.firstBar.record(request.firstAt - request.sentAt)
+        self.requestTime.record(request.doneAt - request.sentAt)
+
+    def sample(self):
+        """Cheap gauges sampling, called on every wakeup"""
+        self.queueDepth.record(self.client.msg_queue.qsize())
+
+    def snapshot(self, now=None):
+        if now is None: now = time.monotonic()
+        scheduler = self.scheduler
+        bucket = scheduler.pacer.total
+        used = bucket.capacity - bucket.available(now)
+
+        t, nBars = self._last
+        self._last = now, scheduler.nBars
+        snapshot = {
+            'time': time.time(),
+            'uptime': now - self._started,
+            'bars': scheduler.nBars,
+            'barsPerSec': (scheduler.nBars - nBars) / (now - t) if now > t else 0.,
+            'requests': self.nRequests,
+            'failed': self.nFailed,
+            'coalesced': scheduler.nCoalesced,
+            'queued': scheduler.nQueued,
+            'inFlight': scheduler.nInFlight,
+            'firstBarMs': self.firstBar.snapshot(1000.),
+            'requestMs': self.requestTime.snapshot(1000.),
+            'decodeUs': self.decode.snapshot(1e6),
+            'queueDepth': dict(self.queueDepth.snapshot(), now=self.client.msg_queue.qsize()),
+            'pacing': {'used': used, 'capacity': bucket.capacity,
+                       'occupancy': used / bucket.capacity if bucket.capacity else 0.},
+        }
+        writer = self.writer
+        if writer is not None:
+            snapshot['writer'] = dict(writer.lag.snapshot(1000.), queued=writer.qsize,
+                                      backpressure=writer.nBackpressure)
+        return snapshot
+
+def formatMetrics(snapshot):
+    """Snapshot -> short multiline text"""
+    def stats(h, unit):
+        if not h['count']: return '-'
+        return f'p50 {h["p50"]:.1f}{unit} p95 {h["p95"]:.1f}{unit} max {h["max"]:.1f}{unit}'
+
+    pacing = snapshot['pacing']
+    lines = [
+        f'{snapshot["barsPerSec"]:.0f} bars/s, {snapshot["bars"]} bars, '
+        f'{snapshot["requests"]} requests ({snapshot["failed"]} failed, '
+        f'{snapshot["coalesced"]} coalesced), '
+        f'{snapshot["inFlight"]} in flight, {snapshot["queued"]} queued',
+        f'first bar: {stats(snapshot["firstBarMs"], "ms")}',
+        f'request: {stats(snapshot["requestMs"], "ms")}',
+        f'decode: {stats(snapshot["decodeUs"], "us")}',
+        f'msg queue: {snapshot["queueDepth"]["now"]} now, {stats(snapshot["queueDepth"], "")}',
+        f'pacing: {pacing["used"]}/{pacing["capacity"]} ({pacing["occupancy"]:.0%})',
+    ]
+    writer = snapshot.get('writer')
+    if writer:
+        lines.append(f'writer: {writer["queued"]} queued, lag {stats(writer, "ms")}, '
+                     f'{writer["backpressure"]} backpressure')
+    return '\n'.join(lines)
+
+class MetricsReporter:
+    """Periodic dump of the metrics to the log, JSON lines file and the GUI queue"""
+    def __init__(self, metrics, interval=5., fileName=None, queue=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.fileName = fileName
+        self.queue = queue
+        self._last = time.monotonic()
+
+    def tick(self, now=None):
+        if now is None: now = time.monotonic()
+        self.metrics.sample()
+        if now - self._last < self.interval: return
+        self._last = now
+        self.dump(now)
+
+    def dump(self, now=None):
+        snapshot = self.metrics.snapshot(now)
+        logging.info('Metrics: ' + formatMetrics(snapshot).replace('\n', '; '))
+        text = json.dumps(snapshot)
+        if self.fileName:
+            try:
+                with open(self.fileName, 'a') as f: f.write(text + '\n')
+            except OSError:
+                logging.exception(f'Cannot write metrics to {self.fileName}')
+        if self.queue is not None: self.queue.put(f'METRICS {text}')
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Historical data pacing.
+
+IB pacing rules for the historical data requests:
+- no more than 60 requests within any 10 minutes period;
+- no identical requests within 15 seconds;
+- no six or more requests for the same Contract, Exchange and Tick Type
+  within 2 seconds.
+BID_ASK requests are counted twice.
+
+Every rule is a token bucket. A token spent on a request is returned to the
+bucket exactly `period` seconds later, so the bucket never allows more than
+`capacity` requests inside any sliding window of `period` seconds.
+'''
+
+#region import
+import sys
+import time
+from collections import deque
+#endregion import
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self._spent = deque()
+
+    def _refill(self, now):
+        spent = self._spent
+        while spent and spent[0] <= now: spent.popleft()
+
+    def available(self, now):
+        self._refill(now)
+        return self.capacity - len(self._spent)
+
+    def wait(self, now, tokens=1):
+        """Seconds to wait until `tokens` tokens are available"""
+        self._refill(now)
+        lack = len(self._spent) + tokens - self.capacity
+        if lack <= 0: return 0.
+        return self._spent[lack - 1] - now
+
+    def take(self, now, tokens=1):
+        for _ in range(tokens): self._spent.append(now + self.period)
+
+    def hold(self, until):
+        """Mark the whole bucket as spent until the `until` time"""
+        self._spent = deque([until] * self.capacity)
+
+class Pacer:
+    """
+    Checks the historical data request against all the IB pacing rules
+    """
+    def __init__(self, requests=60, period=600., identical=15.,
+                 perContract=5, contractPeriod=2.):
+        self.total = TokenBucket(requests, period)
+        self.identical = identical
+        self.perContract = perContract
+        self.contractPeriod = contractPeriod
+        self._contracts = {}
+        self._lastSent = {}
+
+    def _contractBucket(self, key):
+        bucket = self._contracts.get(key)
+        if bucket is None:
+            bucket = self._contracts[key] = TokenBucket(self.perContract, self.contractPeriod)
+        return bucket
+
+    def wait(self, request, now=None):
+        """Seconds to wait before the request could be sent, 0 - send now"""
+        if now is None: now = time.monotonic()
+        tokens = request.cost
+        delay = max(self.total.wait(now, tokens),
+                    self._contractBucket(request.contractKey).wait(now, tokens))
+        last = self._lastSent.get(request.key)
+        if last is not None: delay = max(delay, last + self.identical - now)
+        return max(delay, 0.)
+
+    def sent(self, request, now=None):
+        if now is None: now = time.monotonic()
+        tokens = request.cost
+        self.total.take(now, tokens)
+        self._contractBucket(request.contractKey).take(now, tokens)
+        self._lastSent[request.key] = now
+        self._cleanup(now)
+
+    def violation(self, backoff, now=None):
+        """TWS reported a pacing violation - stop sending for a while"""
+        if now is None: now = time.monotonic()
+        self.total.hold(now + backoff)
+
+    def _cleanup(self, now):
+        if len(self._lastSent) > 4 * self.total.capacity:
+            limit = now - self.identical
+            self._lastSent = {k: t for k, t in self._lastSent.items() if t > limit}
+        if len(self._contracts) > 4 * self.total.capacity:
+            self._contracts = {k: b for k, b in self._contracts.items()
+                               if b.available(now) < b.capacity}
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
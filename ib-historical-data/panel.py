@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Panel: time x symbol matrices of one bar size and type for the
+cross-sectional research.
+
+Every field (close, volume...) is the .npy matrix, rows are the shared time
+grid (grid.npy), columns are the symbols (panel.json). The grid is session
+aware: the bar times expected by the session calendar, or all the bar times
+of the symbols without the calendar. Bars off the grid are dropped.
+Matrices are memory-mapped for reading: Panel(path).field('close')[lo:hi]
+is a view, nothing is loaded.
+
+Missing bars (halts, no trades) are filled by the field policy:
+    nan   -- left NaN
+    zero  -- 0 (volume, count)
+    ffill -- the last known value of the field
+    close -- the last known close (open, high, low of the missing bar)
+
+update() appends the grid rows after the panel end: only the new bars are
+read, the fill goes on from the last row, the existing rows are not touched.
+The rows go only up to the time every symbol has its bars for: the store
+coverage end, or the end of the last bar of the file (a symbol which stopped
+trading holds the panel back - drop it from the panel).
+
+    panel = buildPanel('panels/1min', storeSource(store, '1 min', 'TRADES'),
+                       symbols, '1 min', start, end, getCalendar('NYSE'))
+    panel.update(source, now)
+'''
+
+#region import
+import os
+import sys
+import json
+import logging
+
+import numpy as np
+
+from sinks import NpyColumn
+from store import StoreKey
+from sessions import getCalendar
+from timeutils import barSizeSeconds
+#endregion import
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume', 'count', 'average')
+
+DEFAULT_FILL = {'open': 'close', 'high': 'close', 'low': 'close', 'close': 'ffill',
+                'average': 'close', 'volume': 'zero', 'count': 'zero'}
+
+FILL_POLICIES = ('nan', 'zero', 'ffill', 'close')
+
+SYMBOL_BLOCK = 64   # Symbols aligned at once: the memory is grid rows x block x 8 bytes
+
+class StoreSource:
+    """Panel source: bars from the store.BarStore"""
+    def __init__(self, store, barSize, barType):
+        self.store = store
+        self.barSize = barSize
+        self.barType = barType
+
+    def __call__(self, symbol, start, end):
+        return self.store.readArray(StoreKey(symbol, self.barSize, self.barType), start, end)
+
+    def available(self, symbol, start):
+        """End of the period from `start` the store has downloaded for the symbol"""
+        for s, e in self.store.coverage(StoreKey(symbol, self.barSize, self.barType)):
+            if s <= start < e: return e
+        return start
+
+class ReaderSource:
+    """Panel source: bars from the query.BarReader"""
+    def __init__(self, reader, barSize):
+        self.reader = reader
+        self.step = barSizeSeconds(barSize)
+
+    def __call__(self, symbol, start, end):
+        return self.reader.range(symbol, start, end)
+
+    def available(self, symbol, start):
+        """The files have no coverage: up to the end of the last bar"""
+        t = self.reader.range(symbol, start, columns=['time'])['time']
+        return int(t[-1]) + self.step if len(t) else start
+
+def storeSource(store, barSize, barType):
+    """source(symbol, start, end) of the panel: bars from the store.BarStore"""
+    return StoreSource(store, barSize, barType)
+
+def readerSource(reader, barSize):
+    """source(symbol, start, end) of the panel: bars from the query.BarReader"""
+    return ReaderSource(reader, barSize)
+
+def _ffill(values, missing, carry):
+    """Forward fill along the time (axis 0), carry -- the value before the first row"""
+    n = len(values)
+    idx = np.where(missing, -1, np.arange(n)[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    filled = np.take_along_axis(values, np.maximum(idx, 0), axis=0)
+    return np.where(idx < 0, carry, filled)
+
+def align(arrays, grid, fields, fill, carry=None):
+    """
+    Bars of every symbol -> field -> (len(grid), len(arrays)) float64 matrix
+    arrays -- BAR_DTYPE arrays (or dicts of the columns), one per symbol
+    carry  -- field -> the row before the grid (the last panel row) for the fill
+    """
+    shape = (len(grid), len(arrays))
+    matrices = {field: np.full(shape, np.nan) for field in fields}
+    present = np.zeros(shape, dtype=bool)
+    dropped = 0
+    for j, array in enumerate(arrays):
+        t = np.asarray(array['time'])
+        if not len(t): continue
+        idx = np.minimum(np.searchsorted(grid, t), len(grid) - 1)
+        onGrid = grid[idx] == t
+        rows = idx[onGrid]
+        dropped += len(t) - len(rows)
+        present[rows, j] = True
+        for field in fields: matrices[field][rows, j] = np.asarray(array[field])[onGrid]
+    if dropped: logging.debug(f'{dropped} bars off the time grid')
+
+    missing = ~present
+    nan = np.full(len(arrays), np.nan)
+    lastClose = None
+    for field in fields:
+        policy = fill.get(field, 'nan')
+        if policy == 'zero':
+            matrices[field][missing] = 0.
+        elif policy == 'ffill':
+            fieldCarry = carry[field] if carry else nan
+            matrices[field] = _ffill(matrices[field], missing, fieldCarry)
+        elif policy == 'close':
+            if lastClose is None:
+                # Raw close: the close fill could be done already
+                raw = np.where(missing, np.nan, matrices['close'])
+                lastClose = _ffill(raw, missing, carry['close'] if carry else nan)
+            matrices[field] = np.where(missing, lastClose, matrices[field])
+    return matrices
+
+class Panel:
+    """
+    Memory-mapped panel directory
+    grid    -- epoch times of the rows
+    symbols -- the columns
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'panel.json')) as f: meta = json.load(f)
+        self.symbols = meta['symbols']
+        self.barSize = meta['barSize']
+        self.barType = meta['barType']
+        self.fields = meta['fields']
+        self.fill = meta['fill']
+        self.calendar = meta['calendar']
+        self.start = meta['start']
+        self.end = meta['end']
+        self._map()
+
+    def _load(self, name):
+        fileName = os.path.join(self.path, f'{name}.npy')
+        try:
+            return np.load(fileName, mmap_mode='r')
+        except ValueError:
+            # Empty panel: nothing to map
+            return np.load(fileName)
+
+    def _map(self):
+        self.grid = self._load('grid')
+        self._fields = {}
+
+    def field(self, name):
+        """time x symbol matrix of the field, memory-mapped"""
+        matrix = self._fields.get(name)
+        if matrix is None: matrix = self._fields[name] = self._load(name)
+        return matrix
+
+    def rows(self, start=None, end=None):
+        """Row range [lo, hi) of [start, end) epoch seconds"""
+        lo = 0 if start is None else int(np.searchsorted(self.grid, start))
+        hi = len(self.grid) if end is None else int(np.searchsorted(self.grid, end))
+        return lo, max(lo, hi)
+
+    def range(self, start=None, end=None, fields=None):
+        """(grid view, field -> matrix view) of [start, end), no copy"""
+        lo, hi = self.rows(start, end)
+        return self.grid[lo:hi], {name: self.field(name)[lo:hi] for name in fields or self.fields}
+
+    def column(self, symbol):
+        return self.symbols.index(symbol)
+
+    def _saveMeta(self):
+        meta = {'symbols': self.symbols, 'barSize': self.barSize, 'barType': self.barType,
+                'fields': self.fields, 'fill': self.fill, 'calendar': self.calendar,
+                'start': self.start, 'end': self.end}
+        fileName = os.path.join(self.path, 'panel.json')
+        with open(fileName + '.tmp', 'w') as f: json.dump(meta, f)
+        os.replace(fileName + '.tmp', fileName)
+
+    def update(self, source, end):
+        """
+        Append the grid rows of [self.end, end) from the source bars.
+        source -- source(symbol, start, end) -> bars (see storeSource)
+        With source.available(symbol, start) the rows go up to the time all the
+        symbols have their bars for: the bars coming later would be filled
+        for good otherwise.
+        Returns the number of the rows added.
+        """
+        start = self.end
+        available = getattr(source, 'available', None)
+        if available:
+            end = min([end] + [available(symbol, start) for symbol in self.symbols])
+        if end <= start: return 0
+        calendar = getCalendar(self.calendar)
+        arrays = None
+        if calendar:
+            grid = calendar.expectedTimes(start, end, self.barSize)
+        else:
+            arrays = [source(symbol, start, end) for symbol in self.symbols]
+            grid = _unionTimes(arrays)
+
+        old = len(self.grid)
+        carry = None
+        if old:
+            carry = {name: np.array(self.field(name)[-1]) for name in self.fields}
+
+        # The grid goes after the matrices: the rows are not visible until written
+        self._writeRows(source, start, end, grid, old, carry, arrays)
+        gridColumn = NpyColumn(os.path.join(self.path, 'grid.npy'), '<i8', append=True)
+        gridColumn.append(grid)
+        gridColumn.close()
+
+        self.end = end
+        self._saveMeta()
+        self._map()
+        logging.info(f'Panel {self.path}: {len(grid)} rows added, {old + len(grid)} total')
+        return len(grid)
+
+    def _writeRows(self, source, start, end, grid, old, carry, arrays=None):
+        """Aligned bars of the symbols -> rows [old, old + len(grid)) of the matrices"""
+        n = len(self.symbols)
+        columns = {name: NpyColumn(os.path.join(self.path, f'{name}.npy'), '<f8',
+                                   append=True, rowShape=(n,))
+                   for name in self.fields}
+        for column in columns.values(): column.truncate(old + len(grid))
+        for column in columns.values(): column.close()
+        if not len(grid): return
+
+        maps = {name: np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r+')
+                for name in self.fields}
+        fill = self.fill
+        for j0 in range(0, n, SYMBOL_BLOCK):
+            j1 = min(j0 + SYMBOL_BLOCK, n)
+            block = (arrays[j0:j1] if arrays is not None
+                     else [source(symbol, start, end) for symbol in self.symbols[j0:j1]])
+            blockCarry = {name: values[j0:j1] for name, values in carry.items()} if carry else None
+            for name, matrix in align(block, grid, self.fields, fill, blockCarry).items():
+                maps[name][old:, j0:j1] = matrix
+        for matrix in maps.values(): matrix.flush()
+
+def _unionTimes(arrays):
+    times = [np.asarray(array['time']) for array in arrays if len(array['time'])]
+    return np.unique(np.concatenate(times)) if times else np.empty(0, dtype=np.int64)
+
+def buildPanel(path, source, symbols, barSize, start, end, calendar=None, barType='TRADES',
+               fields=FIELDS, fill=None):
+    """
+    New panel of [start, end) epoch seconds in the directory `path`
+    source   -- source(symbol, start, end) -> bars (see storeSource, readerSource)
+    calendar -- sessions.SessionCalendar of the time grid, None - all the bar times
+    fill     -- policy name for all the fields or field -> policy, DEFAULT_FILL by default
+    """
+    if isinstance(fill, str): fill = {field: fill for field in fields}
+    fill = dict(DEFAULT_FILL if fill is None else fill)
+    for field, policy in fill.items():
+        if policy not in FILL_POLICIES: raise ValueError(f'Unknown fill policy: {policy}')
+    if 'close' in (fill.get(field) for field in fields) and 'close' not in fields:
+        raise ValueError("'close' fill policy requires the close field")
+
+    if not os.path.exists(path): os.makedirs(path)
+    meta = {'symbols': list(symbols), 'barSize': barSize, 'barType': barType,
+            'fields': list(fields), 'fill': fill,
+            'calendar': calendar.name if calendar else None, 'start': start, 'end': start}
+    fileName = os.path.join(path, 'panel.json')
+    with open(fileName, 'w') as f: json.dump(meta, f)
+    NpyColumn(os.path.join(path, 'grid.npy'), '<i8').close()
+    for field in fields:
+        NpyColumn(os.path.join(path, f'{field}.npy'), '<f8', rowShape=(len(symbols),)).close()
+
+    panel = Panel(path)
+    panel.update(source, end)
+    return panel
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
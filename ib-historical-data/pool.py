@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Worker pool: headless batch mode with several TWS connections.
+
+Usage: python pool.py jobs.csv --workers N [--host HOST] [--port PORT] [--clientId FIRST_ID]
+
+Every worker is a separate process with its own clientId (FIRST_ID + i),
+App instance and message loop. Jobs are sharded by symbol, so all the jobs for
+a symbol go to the same worker and no two workers ever write the same store
+key. The pacing budget and the in-flight limit are split between the workers.
+'''
+
+#region import
+import sys
+import time
+import zlib
+import queue
+import logging
+import argparse
+import multiprocessing as mp
+
+from config import config
+from logutils import init_logger, stop_logger
+from batch import BatchApp, readJobs, printSummary, summaryOk
+from wirelog import logName
+#endregion import
+
+def shard(jobs, n):
+    """Split the jobs into n lists by symbol"""
+    shards = [[] for _ in range(n)]
+    for job in jobs:
+        shards[zlib.crc32(job['symbol'].encode()) % n].append(job)
+    return shards
+
+def runWorker(i, nWorkers, jobs, host, port, clientId, results):
+    config.pacingRequests = max(1, config.pacingRequests // nWorkers)
+    config.maxInFlight = max(1, config.maxInFlight // nWorkers)
+    init_logger(f'pool{i}', logpath=config.logpath, loglevel=config.loglevel)
+    logging.info(f'Worker {i} started: clientId {clientId}, {len(jobs)} jobs')
+
+    rows = []
+    try:
+        app = BatchApp(jobs)
+        app.connect(host, port, clientId=clientId)
+        if config.recordpath and app.isConnected():
+            app.record(logName(config.recordpath, f'pool{i}'))
+        app.run()
+        app.stopWriter()
+        rows = app.summary()
+    except Exception:
+        logging.exception(f'Worker {i} failed')
+    finally:
+        results.put((i, rows))
+        logging.info(f'Worker {i} stopped')
+        # The process exits without atexit handlers
+        stop_logger()
+
+#region main
+#-------------------------------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(description='IB historical data download with a worker pool')
+    parser.add_argument('jobs', help='job file: .csv or .json')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count())
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=config.twsport)
+    parser.add_argument('--clientId', type=int, default=config.clientId,
+                        help='clientId of the first worker, the next ones get +1, +2...')
+    args = parser.parse_args(args)
+
+    init_logger('pool', logpath=config.logpath, loglevel=config.loglevel)
+
+    jobs = readJobs(args.jobs)
+    shards = [s for s in shard(jobs, max(1, args.workers)) if s]
+    logging.info(f'Pool started: {len(jobs)} jobs, {len(shards)} workers')
+
+    started = time.monotonic()
+    results = mp.Queue()
+    workers = [mp.Process(target=runWorker, name=f'Worker{i}',
+                          args=(i, len(shards), shardJobs, args.host, args.port,
+                                args.clientId + i, results))
+               for i, shardJobs in enumerate(shards)]
+    for worker in workers: worker.start()
+
+    rows = []
+    nResults = 0
+    while nResults < len(workers):
+        try:
+            rows.extend(results.get(timeout=1.)[1])
+            nResults += 1
+        except queue.Empty:
+            # Worker process could die without the results
+            if not any(worker.is_alive() for worker in workers): break
+    for worker in workers: worker.join()
+
+    printSummary(rows, time.monotonic() - started)
+    logging.info('Pool stopped')
+    return 0 if summaryOk(rows, len(jobs)) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
+#endregion main
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Coalesced progress reporting.
+
+Bars are just counted by the jobs. The reporter sends the cumulative count
+of every active job to the GUI not more often than `rate` times per second:
+    PROGRESS <job name>|<bars done>|<bars expected>|<bars/sec>|<ETA, sec>
+The GUI applies only the latest value.
+'''
+
+#region import
+import sys
+import time
+#endregion import
+
+def formatProgress(name, done, total, rate, eta):
+    return f'PROGRESS {name}|{done}|{total}|{rate:.1f}|{eta:.0f}'
+
+def parseProgress(msg):
+    """'PROGRESS ...' -> (name, done, total, rate, eta)"""
+    name, done, total, rate, eta = msg[9:].rsplit('|', 4)
+    return name, int(done), int(total), float(rate), float(eta)
+
+class ProgressReporter:
+    def __init__(self, queue, scheduler, rate=10., smoothing=0.3):
+        self.queue = queue
+        self.scheduler = scheduler
+        self.interval = 1. / rate
+        self.smoothing = smoothing
+        self._last = 0.
+        self._state = {}  # job -> (time, bars done, bars/sec)
+
+    def tick(self, now=None):
+        """Send the progress if the report interval is over"""
+        if now is None: now = time.monotonic()
+        if now - self._last < self.interval: return
+        self._last = now
+
+        state = {}
+        for job in self.scheduler.jobs:
+            done = job.nReceived
+            prev = self._state.get(job)
+            if prev is None:
+                rate = 0.
+            else:
+                t, n, rate = prev
+                if n == done:
+                    state[job] = prev
+                    continue
+                rate += self.smoothing * ((done - n) / (now - t) - rate)
+            state[job] = (now, done, rate)
+            total = max(job.expected, done)
+            eta = (total - done) / rate if rate > 0. else 0.
+            self.queue.put(formatProgress(job.name, done, total, rate, eta))
+        self._state = state
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Read side: range queries over the downloaded bar files.
+
+npy outputs (a directory with .npy file per column, bars or ticks) are
+memory-mapped: [start, end) is found by the binary search over the mapped time
+column, the result is a dict of the column slices - views of the mapped files,
+nothing is copied or read besides the pages touched. Columns are mapped on the
+first use, opening a file costs one header read.
+
+chunked (.ibz) files are read by the time index, only the chunks overlapping
+the range are decompressed - a copy, but not the whole file.
+
+    bars = BarReader({'AAPL': 'data/AAPL-1_min', 'MSFT': 'data/MSFT-1_min'})
+    columns = bars.range('AAPL', start, end)        # {'time': view, 'close': view...}
+    many = bars.query(['AAPL', 'MSFT'], start, end) # symbol -> columns
+'''
+
+#region import
+import os
+import sys
+
+import numpy as np
+
+from chunked import ChunkedFile
+#endregion import
+
+class NpyBars:
+    """Memory-mapped npy output directory"""
+    def __init__(self, path):
+        self.path = path
+        self.names = sorted(name[:-4] for name in os.listdir(path) if name.endswith('.npy'))
+        if 'time' not in self.names: raise ValueError(f'{path}: no time column')
+        self._columns = {}
+        self.time = self.column('time')
+
+    def column(self, name):
+        """Whole column, memory-mapped"""
+        values = self._columns.get(name)
+        if values is None:
+            fileName = os.path.join(self.path, f'{name}.npy')
+            try:
+                values = np.load(fileName, mmap_mode='r')
+            except ValueError:
+                # Empty column: nothing to map
+                values = np.load(fileName)
+            self._columns[name] = values
+        return values
+
+    def __len__(self): return len(self.time)
+
+    def bounds(self, start=None, end=None):
+        """Index range [lo, hi) of the bars of [start, end) epoch seconds"""
+        t = self.time
+        lo = 0 if start is None else int(np.searchsorted(t, start))
+        hi = len(t) if end is None else int(np.searchsorted(t, end))
+        return lo, max(lo, hi)
+
+    def range(self, start=None, end=None, columns=None):
+        """Columns of the bars of [start, end): name -> view, no copy"""
+        lo, hi = self.bounds(start, end)
+        return {name: self.column(name)[lo:hi] for name in columns or self.names}
+
+class ChunkedBars:
+    """Chunked compressed file (see chunked.py)"""
+    def __init__(self, path):
+        self.path = path
+        self._file = ChunkedFile(path)
+        self.names = [name for name, _ in self._file.columns]
+
+    def __len__(self): return len(self._file)
+
+    def range(self, start=None, end=None, columns=None):
+        array = self._file.read(start, end)
+        return {name: array[name] for name in columns or self.names}
+
+def openBars(path):
+    """npy directory or .ibz file -> NpyBars or ChunkedBars"""
+    if os.path.isdir(path): return NpyBars(path)
+    if path.endswith('.ibz'): return ChunkedBars(path)
+    raise ValueError(f'{path}: only npy and chunked outputs could be queried, '
+                     f'convert the file with chunked.py')
+
+class BarReader:
+    """
+    Range queries over many symbols.
+    files -- symbol -> npy directory or .ibz file; opened on the first query
+             and kept open, the next queries cost the binary search only
+    """
+    def __init__(self, files):
+        self.files = dict(files)
+        self._open = {}
+
+    @classmethod
+    def fromDirectory(cls, path, suffix=''):
+        """
+        All the outputs in the directory: <symbol><suffix> entries,
+        e.g. suffix '-1_min' for 'AAPL-1_min', 'MSFT-1_min'...
+        """
+        files = {}
+        for name in os.listdir(path):
+            symbol = os.path.splitext(name)[0] if name.endswith('.ibz') else name
+            if suffix:
+                if not symbol.endswith(suffix): continue
+                symbol = symbol[:-len(suffix)]
+            fullName = os.path.join(path, name)
+            if os.path.isdir(fullName) or name.endswith('.ibz'): files[symbol] = fullName
+        return cls(files)
+
+    def __getitem__(self, symbol):
+        bars = self._open.get(symbol)
+        if bars is None: bars = self._open[symbol] = openBars(self.files[symbol])
+        return bars
+
+    @property
+    def symbols(self): return list(self.files)
+
+    def range(self, symbol, start=None, end=None, columns=None):
+        """Columns of the symbol bars of [start, end): name -> array"""
+        return self[symbol].range(start, end, columns)
+
+    def query(self, symbols=None, start=None, end=None, columns=None):
+        """symbol -> columns of [start, end) for all the symbols (all by default)"""
+        return {symbol: self[symbol].range(start, end, columns)
+                for symbol in (self.symbols if symbols is None else symbols)}
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
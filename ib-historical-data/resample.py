@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Resampling: coarser bars derived from the finer ones, e.g. 5 mins, 1 hour
+and 1 day from one 1 min download.
+
+- open/close - the first/last bar, high/low - max/min;
+- volume and count are summed, average is volume weighted;
+- intraday bins are aligned to the local clock inside the session and never
+  cross the session boundary; the first bin of the session starts at the
+  session open, as the TWS does (1 hour RTH bars: 09:30, 10:00, 11:00...);
+- daily bars are labelled by the local midnight like the 'yyyymmdd' TWS dates,
+  weekly - by the first trading day of the week, monthly - of the month.
+
+Sessions are the local calendar days unless the session start times are given.
+
+Only the trade bars (RESAMPLE_TYPES) are resampled. The other bar types do
+not aggregate this way: BID_ASK open/close are the average bid/ask, high/low
+the max ask/min bid, and MIDPOINT/BID/ASK/BID_ASK volume and count are -1.
+'''
+
+#region import
+import sys
+import time
+
+import numpy as np
+
+from timeutils import barSizeSeconds, DAY, WEEK
+from bars import BAR_DTYPE
+#endregion import
+
+# TWS bar sizes (see gui._barsize)
+BAR_SIZES = ('1 secs', '5 secs', '10 secs', '15 secs', '30 secs',
+             '1 min', '2 mins', '3 mins', '5 mins', '10 mins', '15 mins', '20 mins', '30 mins',
+             '1 hour', '2 hours', '3 hours', '4 hours', '8 hours',
+             '1 day', '1 week', '1 month')
+
+# Bar types with the trade OHLCV bars
+RESAMPLE_TYPES = ('TRADES', 'ADJUSTED_LAST')
+
+def canResample(source, target):
+    """True if `target` bars could be built from the `source` ones"""
+    src, dst = barSizeSeconds(source), barSizeSeconds(target)
+    if src >= dst: return False
+    # Days, weeks and months are calendar bins: any intraday or daily source fits,
+    # weeks do not fit into months
+    if dst >= DAY: return src <= DAY
+    return dst % src == 0
+
+def sources(target):
+    """Bar sizes `target` could be resampled from, the coarsest (cheapest) first"""
+    return [barSize for barSize in reversed(BAR_SIZES) if canResample(barSize, target)]
+
+def localOffsets(t):
+    """UTC offsets of the local time zone for the epoch times, seconds"""
+    if not len(t): return np.zeros(0, dtype=np.int64)
+    # DST changes on the hour boundary: one localtime() per distinct hour
+    hours, inverse = np.unique(t // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(int(h) * 3600).tm_gmtoff for h in hours],
+                       dtype=np.int64)
+    return offsets[inverse]
+
+def _groupStarts(keys):
+    """Start indexes of the runs of equal keys"""
+    starts = np.empty(len(keys), dtype=bool)
+    starts[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=starts[1:])
+    return np.flatnonzero(starts)
+
+def _sessionIds(t, local, sessionStarts):
+    if sessionStarts is None: return local // DAY
+    return np.searchsorted(np.asarray(sessionStarts, dtype=np.int64), t, side='right')
+
+def _binKeys(t, barSize, sessionStarts):
+    """(bin key, bin label epoch) for every bar"""
+    step = barSizeSeconds(barSize)
+    offset = localOffsets(t)
+    local = t + offset
+    day = local // DAY * DAY
+
+    if step < DAY:
+        session = _sessionIds(t, local, sessionStarts)
+        label = day + (local - day) // step * step - offset
+        # The first bin of the session starts at the session open
+        first = _groupStarts(session)
+        opens = np.repeat(t[first], np.diff(np.append(first, len(t))))
+        np.maximum(label, opens, out=label)
+        # Same clock bin in the different sessions is the different bar
+        return session * (DAY // step + 1) + (local - day) // step, label
+
+    if step == DAY:
+        key = day
+    elif step == WEEK:
+        # 1970-01-01 is Thursday: shift to start the weeks on Monday
+        key = (day // DAY + 3) // 7
+    else:
+        days = (day // DAY).astype('datetime64[D]')
+        key = days.astype('datetime64[M]').astype(np.int64)
+    first = _groupStarts(key)
+    labelDays = day[first] - offset[first]
+    return key, np.repeat(labelDays, np.diff(np.append(first, len(t))))
+
+def resample(array, barSize, sessionStarts=None):
+    """
+    BAR_DTYPE array in the time order -> BAR_DTYPE array of the `barSize` bars.
+    sessionStarts -- sorted epoch times of the session opens, the local days by default
+    """
+    if not len(array): return np.empty(0, dtype=BAR_DTYPE)
+    t = array['time']
+    key, label = _binKeys(t, barSize, sessionStarts)
+    starts = _groupStarts(key)
+    ends = np.append(starts[1:], len(array))
+
+    result = np.empty(len(starts), dtype=BAR_DTYPE)
+    result['time'] = label[starts]
+    result['open'] = array['open'][starts]
+    result['close'] = array['close'][ends - 1]
+    result['high'] = np.maximum.reduceat(array['high'], starts)
+    result['low'] = np.minimum.reduceat(array['low'], starts)
+    volume = np.add.reduceat(array['volume'], starts)
+    result['volume'] = volume
+    result['count'] = np.add.reduceat(array['count'], starts)
+
+    # Volume weighted average, plain mean for the bins without volume
+    weighted = np.add.reduceat(array['average'] * array['volume'], starts)
+    mean = np.add.reduceat(array['average'], starts) / (ends - starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['average'] = np.where(volume > 0, weighted / volume, mean)
+    return result
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
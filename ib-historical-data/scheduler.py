@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Historical data requests scheduler.
+
+Keeps many reqHistoricalData requests in flight at once, sends them as fast
+as the IB pacing rules (see pacing.py) allow and routes the TWS callbacks
+by reqId to the job (and its sink) the request belongs to.
+
+Identical requests (same contract and parameters) of the different jobs are
+coalesced: while one is in flight the others are not sent but attached to it,
+its bars fan out to every attached job.
+'''
+
+#region import
+import sys
+import time
+import logging
+from collections import deque
+
+from pacing import Pacer
+from timeutils import estimateBars, barSizeSeconds, DAY, parseEndDate, formatEndDate
+from bars import BarArray
+#endregion import
+
+# TWS error for a historical data request that broke the pacing rules
+PACING_VIOLATION = 162
+
+def contractKey(contract):
+    return (contract.conId, contract.symbol, contract.secType,
+            contract.exchange, contract.currency)
+
+class Request:
+    """
+    Base class of the scheduled request. The subclass sends the TWS call:
+    send(client, reqId), cancel() if it could be cancelled.
+    `key` identifies the identical requests, `contractKey` - the contract
+    and tick type for the pacing
+    """
+    keepUpToDate = False
+
+    def __init__(self, contract, contractKey, key, cost=1):
+        self.contract = contract
+        self.contractKey = contractKey
+        self.key = key
+        self.cost = cost
+
+        self.job = None
+        self.reqId = None
+        self.sentAt = None
+        self.firstAt = None
+        self.doneAt = None
+        self.bars = None  # BarArray of the typed bars received so far
+        self.expected = None  # Exact bar count (session calendar) if known
+        self.followers = []   # Identical requests of the other jobs sharing the result
+
+    def cancel(self, client):
+        pass
+
+    @property
+    def subscribers(self):
+        """The request itself and the coalesced ones"""
+        return [self] + self.followers if self.followers else (self,)
+
+class HistRequest(Request):
+    """One reqHistoricalData call"""
+    def __init__(self, contract, endDate, duration, barSize, barType,
+                 useRTH=1, formatDate=1, keepUpToDate=False):
+        # '20180105' and '20180105 00:00:00' is the same request
+        endKey = formatEndDate(*parseEndDate(endDate)) if endDate else ''
+        key = contractKey(contract) + (barType,)
+        Request.__init__(self, contract, key,
+                         key + (endKey, duration, barSize, useRTH, formatDate),
+                         2 if barType == 'BID_ASK' else 1)
+        self.endDate = endDate
+        self.duration = duration
+        self.barSize = barSize
+        self.barType = barType
+        self.useRTH = useRTH
+        self.formatDate = formatDate
+        self.keepUpToDate = keepUpToDate
+
+    def send(self, client, reqId):
+        client.reqHistoricalData(reqId, self.contract, self.endDate, self.duration,
+                                 self.barSize, self.barType, self.useRTH,
+                                 self.formatDate, self.keepUpToDate, [])
+
+    def cancel(self, client):
+        client.cancelHistoricalData(self.reqId)
+
+    def __str__(self):
+        return (f'{self.contract.symbol} {self.endDate} {self.duration} '
+                f'{self.barSize} {self.barType}')
+
+class Job:
+    """
+    Set of requests which output goes to the same sink
+    """
+    def __init__(self, name, requests, sink):
+        self.name = name
+        self.requests = list(requests)
+        self.sink = sink
+        for request in self.requests: request.job = self
+
+        self.pending = len(self.requests)
+        self.nReceived = 0
+        self.nBars = 0
+        self.errors = []
+        self.submittedAt = None
+        self.doneAt = None
+        self.scheduler = None
+        self.expected = self.estimate()
+
+    @property
+    def done(self): return self.pending == 0
+
+    def estimate(self):
+        """Bars expected from all the requests"""
+        return sum(estimateBars(r.duration, r.barSize) if r.expected is None else r.expected
+                   for r in self.requests)
+
+    def onBar(self, request, bar):
+        self.nBars += 1
+        self.sink.write(bar)
+
+    def onArray(self, request, array):
+        """All the typed bars (BAR_DTYPE array) of the request"""
+        self.nBars += len(array)
+        self.sink.writeArray(array, barSizeSeconds(request.barSize) >= DAY)
+
+    def onUpdate(self, request, bar):
+        """historicalDataUpdate of the keepUpToDate request"""
+        pass
+
+    def onRequestEnd(self, request):
+        # Request is the chunk boundary - make the data durable
+        self.sink.flush()
+
+    def onRequestError(self, request, errorCode, errorString):
+        """Returns True if the error is expected and should not be reported"""
+        self.errors.append((request, errorCode, errorString))
+        return False
+
+    def close(self):
+        self.sink.close()
+
+class Scheduler:
+    def __init__(self, client, pacer=None, maxInFlight=50, backoff=60., onJobDone=None):
+        self.client = client
+        self.pacer = pacer or Pacer()
+        self.maxInFlight = maxInFlight
+        self.backoff = backoff
+        self.onJobDone = onJobDone
+
+        self._queue = deque()
+        self._inFlight = {}
+        self._streams = {}  # reqId -> keepUpToDate request after the initial bars
+        self._byKey = {}    # request key -> the request in flight (coalescing)
+        self._notBefore = 0.
+        self._pumping = False
+        self.jobs = set()
+        self.nBars = 0
+        self.nCoalesced = 0
+        self.metrics = None
+
+    @property
+    def idle(self): return not self._queue and not self._inFlight
+
+    @property
+    def nQueued(self): return len(self._queue)
+
+    @property
+    def nInFlight(self): return len(self._inFlight)
+
+    @property
+    def nStreams(self): return len(self._streams)
+
+    def submit(self, job):
+        job.submittedAt = time.monotonic()
+        job.scheduler = self
+        self.jobs.add(job)
+        if not job.requests:
+            self._jobDone(job)
+            return
+        queued = [request for request in job.requests if not self._attach(request)]
+        self._queue.extend(queued)
+        if queued: self._notBefore = 0.
+
+    def add(self, job, request):
+        """More requests of the running job (e.g. the next page)"""
+        request.job = job
+        job.requests.append(request)
+        job.pending += 1
+        if request.expected is not None: job.expected += request.expected
+        if not self._attach(request):
+            self._queue.append(request)
+            self._notBefore = 0.
+
+    def _attach(self, request):
+        """Attach the request to the identical one in flight, if any"""
+        if request.keepUpToDate: return False
+        leader = self._byKey.get(request.key)
+        if leader is None or leader.job is request.job: return False
+        leader.followers.append(request)
+        # Retried request could have its own followers already
+        leader.followers += request.followers
+        request.followers = []
+        request.reqId = leader.reqId
+        request.sentAt = leader.sentAt
+        request.firstAt = leader.firstAt
+        self.nCoalesced += 1
+        logging.info(f'Request {leader.reqId}: {request.job.name} attached')
+        return True
+
+    def pump(self, now=None):
+        """
+        Send as many queued requests as the pacing rules allow.
+        Returns the number of seconds until the next request could be sent
+        or None if there is nothing to wait for.
+        """
+        queue = self._queue
+        if not queue or len(self._inFlight) >= self.maxInFlight: return None
+        if now is None: now = time.monotonic()
+        if now < self._notBefore: return self._notBefore - now
+        # The request could fail right in the send() (not connected) and
+        # the error callback pumps again
+        if self._pumping: return None
+
+        self._pumping = True
+        try:
+            return self._pump(now)
+        finally:
+            self._pumping = False
+
+    def _pump(self, now):
+        queue = self._queue
+        pacer = self.pacer
+        deferred = []
+        nextTry = None
+        complete = True
+        for _ in range(len(queue)):
+            if len(self._inFlight) >= self.maxInFlight:
+                complete = False
+                break
+            request = queue.popleft()
+            if self._attach(request): continue
+            delay = pacer.wait(request, now)
+            if delay > 0.:
+                deferred.append(request)
+                nextTry = delay if nextTry is None else min(nextTry, delay)
+                # The global budget is exhausted - no reason to check the rest
+                if pacer.total.wait(now, request.cost) > 0.: break
+                continue
+            self._send(request, now)
+        queue.extendleft(reversed(deferred))
+
+        self._notBefore = now + nextTry if complete and nextTry is not None else 0.
+        return nextTry
+
+    def _send(self, request, now):
+        reqId = self.client.nextId
+        request.reqId = reqId
+        request.sentAt = now
+        self._inFlight[reqId] = request
+        if not request.keepUpToDate: self._byKey[request.key] = request
+        self.pacer.sent(request, now)
+        logging.info(f'Request {reqId}: {request}')
+        request.send(self.client, reqId)
+
+    def onBar(self, reqId, bar):
+        request = self._inFlight.get(reqId)
+        if request is None: return False
+        if request.firstAt is None: request.firstAt = time.monotonic()
+        self.nBars += 1
+        for subscriber in request.subscribers:
+            job = subscriber.job
+            job.nReceived += 1
+            job.onBar(subscriber, bar)
+        return True
+
+    def onArray(self, reqId, array):
+        """Typed bars (BAR_DTYPE array) of the request, see ibclient.BarDecoder"""
+        request = self._inFlight.get(reqId)
+        if request is None: return False
+        if request.firstAt is None: request.firstAt = time.monotonic()
+        self.nBars += len(array)
+        for subscriber in request.subscribers: subscriber.job.nReceived += len(array)
+        if request.bars is None: request.bars = BarArray(len(array), array.dtype)
+        request.bars.extend(array)
+        return True
+
+    def onEnd(self, reqId):
+        request = self._inFlight.pop(reqId, None)
+        if request is None: return False
+        self._byKey.pop(request.key, None)
+        request.doneAt = time.monotonic()
+        array = request.bars.array if request.bars is not None else None
+        request.bars = None
+        if request.keepUpToDate:
+            if array is not None: request.job.onArray(request, array)
+            request.job.onRequestEnd(request)
+            # Subscription: no more pacing slot, but not finished
+            self._streams[reqId] = request
+            return True
+
+        for subscriber in request.subscribers:
+            subscriber.firstAt = request.firstAt
+            subscriber.doneAt = request.doneAt
+            # The whole request goes to the job at once, the same array to all the jobs
+            if array is not None: subscriber.job.onArray(subscriber, array)
+            subscriber.job.onRequestEnd(subscriber)
+            self._finish(subscriber)
+        return True
+
+    def onUpdate(self, reqId, bar):
+        request = self._streams.get(reqId)
+        if request is None: return False
+        self.nBars += 1
+        request.job.onUpdate(request, bar)
+        return True
+
+    def onError(self, reqId, errorCode, errorString):
+        """
+        Returns True if the error was handled by the scheduler and
+        should not be reported to the user
+        """
+        request = self._inFlight.pop(reqId, None) or self._streams.pop(reqId, None)
+        if request is None: return False
+        if self._byKey.get(request.key) is request: del self._byKey[request.key]
+
+        if request.doneAt is None and errorCode == PACING_VIOLATION and 'pacing violation' in errorString.lower():
+            logging.warning(f'Request {reqId}: pacing violation, retry in {self.backoff}s')
+            self.pacer.violation(self.backoff)
+            # Attached requests are retried together with this one
+            request.reqId = None
+            request.bars = None
+            self._queue.appendleft(request)
+            self._notBefore = 0.
+            return True
+
+        if request.doneAt is None: request.doneAt = time.monotonic()
+        allQuiet = True
+        for subscriber in request.subscribers:
+            subscriber.doneAt = request.doneAt
+            quiet = subscriber.job.onRequestError(subscriber, errorCode, errorString)
+            (logging.info if quiet else logging.error)(
+                f'Request {reqId} ({subscriber.job.name}) failed: {errorCode} {errorString}')
+            self._finish(subscriber, failed=not quiet)
+            allQuiet = allQuiet and quiet
+        return bool(allQuiet)
+
+    def _finish(self, request, failed=False):
+        if self.metrics: self.metrics.onRequestDone(request, failed)
+        job = request.job
+        job.pending -= 1
+        if job.done: self._jobDone(job)
+
+    def _jobDone(self, job):
+        job.doneAt = time.monotonic()
+        self.jobs.discard(job)
+        job.close()
+        if self.onJobDone: self.onJobDone(job)
+
+    def close(self):
+        """Cancel all the requests and close all the unfinished jobs"""
+        jobs = {id(r.job): r.job for request in self._queue for r in request.subscribers}
+        for request in list(self._inFlight.values()) + list(self._streams.values()):
+            for subscriber in request.subscribers: jobs[id(subscriber.job)] = subscriber.job
+            try:
+                request.cancel(self.client)
+            except Exception:
+                logging.exception(f'Cannot cancel request {request.reqId}')
+        self._queue.clear()
+        self._inFlight.clear()
+        self._streams.clear()
+        self._byKey.clear()
+        self.jobs.clear()
+        for job in jobs.values(): job.close()
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
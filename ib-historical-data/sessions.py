@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Trading session calendar.
+
+Exchange sessions (regular trading hours) with the weekends, holidays and
+half days -> exact bar timestamps expected for any period and bar size:
+- intraday bars start at the session open, then on the exchange clock
+  (1 hour: 09:30, 10:00, 11:00...), the last one is cut by the close;
+- daily bars are dated by the local midnight like the 'yyyymmdd' TWS dates,
+  weekly/monthly - by the first session of the week/month (see resample.py).
+
+The expected timestamps are diffed against the downloaded bars: holes are the
+runs of the missing bars, planRepairs() packs the holes into the fewest
+requests of the max chunk size.
+'''
+
+#region import
+import sys
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from timeutils import DAY, WEEK, barSizeSeconds, durationStart, parseEndDate, toEpoch
+from backfill import maxChunk
+#endregion import
+
+#region Holidays
+#-----------------------------------------------------------------------------
+def easter(year):
+    """Gregorian Easter Sunday (anonymous algorithm)"""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+def nthWeekday(year, month, weekday, n):
+    """n-th (1-based, -1 - the last) weekday (0 - Monday) of the month"""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+def observed(day):
+    """Saturday holiday is observed on Friday, Sunday one - on Monday"""
+    if day.weekday() == 5: return day - timedelta(days=1)
+    if day.weekday() == 6: return day + timedelta(days=1)
+    return day
+
+# Unscheduled full day closures
+_nyseClosures = {date(2001, 9, 11), date(2001, 9, 12), date(2001, 9, 13), date(2001, 9, 14),
+                 date(2004, 6, 11), date(2007, 1, 2), date(2012, 10, 29), date(2012, 10, 30),
+                 date(2018, 12, 5), date(2025, 1, 9)}
+
+def nyseHolidays(year):
+    """(holidays, half days) of the NYSE in the year"""
+    holidays = {
+        nthWeekday(year, 1, 0, 3),          # Martin Luther King Jr. Day
+        nthWeekday(year, 2, 0, 3),          # Washington's Birthday
+        easter(year) - timedelta(days=2),   # Good Friday
+        nthWeekday(year, 5, 0, -1),         # Memorial Day
+        observed(date(year, 7, 4)),         # Independence Day
+        nthWeekday(year, 9, 0, 1),          # Labor Day
+        nthWeekday(year, 11, 3, 4),         # Thanksgiving Day
+        observed(date(year, 12, 25)),       # Christmas
+    }
+    # New Year's Day on Saturday is not observed on Friday Dec 31
+    newYear = date(year, 1, 1)
+    if newYear.weekday() != 5: holidays.add(observed(newYear))
+    if year >= 2022: holidays.add(observed(date(year, 6, 19)))  # Juneteenth
+    holidays.update(day for day in _nyseClosures if day.year == year)
+
+    halfDays = {nthWeekday(year, 11, 3, 4) + timedelta(days=1)}  # Black Friday
+    for day in (date(year, 7, 3), date(year, 12, 24)):
+        if day.weekday() < 5 and day not in holidays: halfDays.add(day)
+    return holidays, halfDays
+#endregion Holidays
+
+class SessionCalendar:
+    """
+    Regular trading sessions of the exchange.
+    tz       -- exchange time zone name
+    open     -- session open, (hour, minute) of the exchange time
+    close    -- session close
+    halfDayClose -- close on the half days
+    holidays -- year -> (set of holiday dates, set of half day dates)
+    exchanges -- primary exchanges of the stocks trading by these sessions
+    """
+    def __init__(self, name, tz, open, close, halfDayClose, holidays, exchanges=()):
+        self.name = name
+        self.exchanges = frozenset(exchanges)
+        self.tz = ZoneInfo(tz)
+        self.open = open
+        self.close = close
+        self.halfDayClose = halfDayClose
+        self._holidays = holidays
+        self._years = {}
+
+    def _yearHolidays(self, year):
+        result = self._years.get(year)
+        if result is None: result = self._years[year] = self._holidays(year)
+        return result
+
+    def matches(self, contract):
+        """
+        The contract trades by these sessions: a stock with the primary exchange of
+        the calendar (known for the resolved contract only, see contracts.py)
+        """
+        return contract.secType == 'STK' and contract.primaryExchange in self.exchanges
+
+    def isTradingDay(self, day):
+        return day.weekday() < 5 and day not in self._yearHolidays(day.year)[0]
+
+    def _epoch(self, day, hm):
+        return int(datetime(day.year, day.month, day.day, *hm, tzinfo=self.tz).timestamp())
+
+    def sessions(self, start, end):
+        """
+        Sessions overlapping [start, end) epoch seconds:
+        (dates, opens, closes) arrays, dates are the local midnight epochs
+        """
+        first = datetime.fromtimestamp(start, self.tz).date()
+        last = datetime.fromtimestamp(end, self.tz).date()
+        dates, opens, closes = [], [], []
+        day = first
+        while day <= last:
+            if self.isTradingDay(day):
+                halfDay = day in self._yearHolidays(day.year)[1]
+                o = self._epoch(day, self.open)
+                c = self._epoch(day, self.halfDayClose if halfDay else self.close)
+                if o < end and c > start:
+                    dates.append(int(time.mktime(day.timetuple())))
+                    opens.append(o)
+                    closes.append(c)
+            day += timedelta(days=1)
+        return (np.array(dates, dtype=np.int64), np.array(opens, dtype=np.int64),
+                np.array(closes, dtype=np.int64))
+
+    def sessionStarts(self, start, end):
+        """Session opens - sessionStarts for resample()"""
+        return self.sessions(start, end)[1]
+
+    def expectedTimes(self, start, end, barSize):
+        """Sorted epoch times of the bars expected in [start, end)"""
+        return self._expected(start, end, barSize)[0]
+
+    def _expected(self, start, end, barSize):
+        """(expected times, session index of every time)"""
+        step = barSizeSeconds(barSize)
+        dates, opens, closes = self.sessions(start, end)
+        if not len(opens): return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        if step >= DAY:
+            if step == DAY:
+                times = dates
+            else:
+                days = (dates // DAY).astype('datetime64[D]')
+                # Monday-based weeks (1970-01-01 is Thursday) or months
+                keys = ((dates // DAY + 3) // 7 if step == WEEK
+                        else days.astype('datetime64[M]').astype(np.int64))
+                first = np.empty(len(keys), dtype=bool)
+                first[0] = True
+                np.not_equal(keys[1:], keys[:-1], out=first[1:])
+                times = dates[first]
+            inRange = (times >= start) & (times < end)
+            # Every coarse bar is on its own
+            return times[inRange], np.arange(len(times))[inRange]
+
+        # Exchange clock alignment: UTC offset of every session
+        offsets = np.array([datetime.fromtimestamp(int(o), self.tz).utcoffset().total_seconds()
+                            for o in opens], dtype=np.int64)
+        aligned = -((-(opens + offsets)) // step) * step - offsets  # First clock bin >= open
+        partial = (aligned > opens).astype(np.int64)
+        counts = partial + np.maximum(0, -((aligned - closes) // step))
+        sessionIdx = np.repeat(np.arange(len(opens)), counts)
+        firstIdx = np.cumsum(counts) - counts
+        i = np.arange(counts.sum()) - firstIdx[sessionIdx]  # Bar index in the session
+        times = aligned[sessionIdx] + (i - partial[sessionIdx]) * step
+        times = np.where((i == 0) & (partial[sessionIdx] == 1), opens[sessionIdx], times)
+        inRange = (times >= start) & (times < end)
+        return times[inRange], sessionIdx[inRange]
+
+    def countBars(self, start, end, barSize):
+        return len(self.expectedTimes(start, end, barSize))
+
+    def periodBars(self, endDate, duration, barSize):
+        """Bars expected in the TWS request period"""
+        end = parseEndDate(endDate)[0]
+        return self.countBars(toEpoch(durationStart(end, duration)), toEpoch(end), barSize)
+
+    def holes(self, times, start, end, barSize):
+        """
+        Runs of the expected bars missing in `times` (sorted epochs) inside
+        one session: list of [start, end) epoch intervals
+        """
+        expected, session = self._expected(start, end, barSize)
+        if not len(expected): return []
+        times = np.asarray(times, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(times, expected), max(len(times) - 1, 0))
+        missing = ~(times[pos] == expected) if len(times) else np.ones(len(expected), dtype=bool)
+        if not missing.any(): return []
+
+        idx = np.flatnonzero(missing)
+        # New run where the missing bars are not neighbours in the expected list
+        # or are in the different sessions: no requests for the closed market
+        breaks = np.flatnonzero((np.diff(idx) > 1) | (np.diff(session[idx]) != 0))
+        runStarts = idx[np.append(0, breaks + 1)]
+        runEnds = idx[np.append(breaks, len(idx) - 1)]
+        step = barSizeSeconds(barSize)
+        return [[int(expected[s]), int(expected[e]) + step] for s, e in zip(runStarts, runEnds)]
+
+def planRepairs(holes, barSize):
+    """
+    Holes -> the fewest request windows: [start, end) intervals, newest first,
+    every window is not longer than the max request chunk for the bar size
+    """
+    step = maxChunk(barSize)[1]
+    holes = [list(hole) for hole in holes]
+    windows = []
+    while holes:
+        end = holes[-1][1]
+        limit = end - step
+        start = end
+        while holes and holes[-1][1] > limit:
+            hole = holes[-1]
+            if hole[0] >= limit:
+                start = hole[0]
+                holes.pop()
+            else:
+                # The rest of the hole goes to the next window
+                start = limit
+                hole[1] = limit
+                break
+        windows.append((start, end))
+    return windows
+
+def expectBars(job, calendar):
+    """Exact progress total of the job: bars expected by the calendar for every request"""
+    for request in job.requests:
+        if request.useRTH:
+            request.expected = calendar.periodBars(request.endDate, request.duration,
+                                                   request.barSize)
+    job.expected = job.estimate()
+
+CALENDARS = {
+    'NYSE': lambda: SessionCalendar('NYSE', 'America/New_York', (9, 30), (16, 0), (13, 0),
+                                    nyseHolidays,
+                                    ('NYSE', 'NASDAQ', 'ISLAND', 'ARCA', 'AMEX', 'BATS', 'IEX')),
+}
+
+_calendars = {}
+
+def getCalendar(name):
+    """Calendar by the name, None for None"""
+    if name is None: return None
+    calendar = _calendars.get(name)
+    if calendar is None:
+        if name not in CALENDARS: raise ValueError(f'Unknown session calendar: {name}')
+        calendar = _calendars[name] = CALENDARS[name]()
+    return calendar
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Output sinks - where the downloaded bars go.
+
+Output formats:
+    csv     - text file, one bar per line
+    npy     - directory with one .npy file per column (see bars.BAR_COLUMNS),
+              every column could be loaded with np.load(..., mmap_mode='r')
+    parquet - Parquet file, requires pyarrow
+    chunked - compressed time-ordered chunks with the time index (see chunked.py),
+              range reads decompress only the chunks needed
+
+csv and npy sinks could be opened to append to the existing output and
+support upsert(): the last bar is overwritten while its time is the same,
+for the streaming updates of the still forming bar.
+'''
+
+#region import
+import os
+import sys
+import ast
+import struct
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from bars import BAR_COLUMNS, BAR_DTYPE, barRow
+from chunked import CHUNK_SIZE, ChunkedWriter
+from timeutils import barEpoch, formatBarDate
+#endregion import
+
+def fsyncFile(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+def _lastCsvLine(fileName):
+    """(offset, text) of the last line of the file"""
+    with open(fileName, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        offset = max(0, size - 4096)
+        f.seek(offset)
+        tail = f.read().rstrip(b'\n')
+    start = tail.rfind(b'\n') + 1
+    return offset + start, tail[start:].decode()
+
+class CsvSink:
+    header = 'Date, Time, Open, Close, Min, Max, Trades, Volume, Average'
+
+    def __init__(self, fileName, bufferSize=1<<20, append=False):
+        self.fileName = fileName
+        self._lastTime = self._lastPos = None
+        if append and os.path.exists(fileName) and os.path.getsize(fileName):
+            pos, line = _lastCsvLine(fileName)
+            if not line.startswith('Date'):
+                date, time = line.split(',')[:2]
+                self._lastTime = barEpoch(f'{date}  {time}' if time else date)
+                self._lastPos = pos
+            self._file = open(fileName, 'a', buffering=bufferSize)
+            return
+        self._file = open(fileName, 'w', buffering=bufferSize)
+        self._file.write(self.header)
+        self._file.write('\n')
+
+    @staticmethod
+    def _line(bar):
+        # Daily and longer bars have no time part
+        date, _, time = bar.date.partition(' ')
+        return (f'{date},{time.strip()},{bar.open},{bar.close},{bar.low},{bar.high},'
+                f'{bar.barCount},{bar.volume},{bar.average}\n')
+
+    def write(self, bar):
+        self._file.write(self._line(bar))
+
+    def writeMany(self, bars):
+        self._file.write(''.join(map(self._line, bars)))
+
+    def writeArray(self, array, daily=False):
+        """BAR_DTYPE array, daily - no time part in the dates"""
+        lines = []
+        for t, o, h, l, c, v, n, a in array.tolist():
+            date, _, time = formatBarDate(t, daily).partition(' ')
+            lines.append(f'{date},{time.strip()},{o},{c},{l},{h},{n},{v},{a}\n')
+        self._file.write(''.join(lines))
+
+    def upsert(self, array, daily=False):
+        """
+        Append the bars newer than the last one, the bar with the same time
+        as the last one replaces it
+        """
+        if self._lastTime is not None:
+            array = array[array['time'] >= self._lastTime]
+            if not len(array): return
+            if array['time'][0] == self._lastTime:
+                self._file.truncate(self._lastPos)
+                self._file.seek(self._lastPos)
+        if len(array) > 1: self.writeArray(array[:-1], daily)
+        self._lastPos = self._file.tell()
+        self._lastTime = int(array['time'][-1])
+        self.writeArray(array[-1:], daily)
+
+    def flush(self, fsync=True):
+        if not self._file: return
+        if fsync: fsyncFile(self._file)
+        else: self._file.flush()
+
+    def close(self):
+        if self._file:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+#region Columnar
+#-----------------------------------------------------------------------------
+_NPY_HEADER_LEN = 128
+
+class NpyColumn:
+    """
+    .npy file written by appending.
+    The header has the fixed length and is rewritten with the final shape on close.
+    rowShape -- shape of every value, e.g. (nSymbols,) for the rows of the matrix
+    """
+    def __init__(self, fileName, dtype, append=False, rowShape=()):
+        self.fileName = fileName
+        self.dtype = np.dtype(dtype)
+        self.rowShape = tuple(rowShape)
+        self.rowSize = self.dtype.itemsize * int(np.prod(self.rowShape, dtype=np.int64))
+        self.count = 0
+        if append and os.path.exists(fileName):
+            self._file = open(fileName, 'r+b')
+            self._readHeader()
+            self.truncate(self.count)
+        else:
+            self._file = open(fileName, 'wb')
+            self._writeHeader()
+
+    def _readHeader(self):
+        header = self._file.read(_NPY_HEADER_LEN)
+        if (header[:8] != b'\x93NUMPY\x01\x00'
+                or struct.unpack('<H', header[8:10])[0] != _NPY_HEADER_LEN - 10):
+            raise ValueError(f'{self.fileName}: not written by NpyColumn, cannot append')
+        descr = ast.literal_eval(header[10:].decode('latin1'))
+        if np.dtype(descr['descr']) != self.dtype:
+            raise ValueError(f'{self.fileName}: {descr["descr"]} column, {self.dtype.str} expected')
+        if tuple(descr['shape'][1:]) != self.rowShape:
+            raise ValueError(f'{self.fileName}: {descr["shape"][1:]} rows, {self.rowShape} expected')
+        self.count = descr['shape'][0]
+
+    def truncate(self, count):
+        """Drop the values after the first `count` ones (or add zeros up to `count`)"""
+        self.count = count
+        self._file.seek(_NPY_HEADER_LEN + count * self.rowSize)
+        self._file.truncate()
+
+    def last(self):
+        """The last value, the file stays positioned at the end"""
+        self._file.seek(_NPY_HEADER_LEN + (self.count - 1) * self.rowSize)
+        return np.frombuffer(self._file.read(self.rowSize), self.dtype).reshape(self.rowShape)[()]
+
+    def _writeHeader(self):
+        header = (f"{{'descr': '{self.dtype.str}', 'fortran_order': False, "
+                  f"'shape': {(self.count,) + self.rowShape}, }}")
+        header = header.ljust(_NPY_HEADER_LEN - 11) + '\n'
+        self._file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header))
+                         + header.encode('latin1'))
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self._file.write(values.tobytes())
+        self.count += len(values)
+
+    def flush(self, fsync=True):
+        if not self._file: return
+        # Keep the header up to date - the file is readable after every flush
+        pos = self._file.tell()
+        self._file.seek(0)
+        self._writeHeader()
+        self._file.seek(pos)
+        if fsync: fsyncFile(self._file)
+        else: self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.seek(0)
+            self._writeHeader()
+            self._file.close()
+            self._file = None
+
+class ColumnarSink:
+    """Base class: collects bars into typed columns chunk by chunk"""
+    def __init__(self, fileName, chunkSize=65536):
+        self.fileName = fileName
+        self.chunkSize = chunkSize
+        self._rows = []     # Bars not packed into the array yet
+        self._arrays = []   # BAR_DTYPE arrays not written yet
+        self._nArrays = 0
+
+    def write(self, bar):
+        self._rows.append(barRow(bar))
+        if len(self._rows) >= self.chunkSize: self._writeRows()
+
+    def writeMany(self, bars):
+        self._rows.extend(map(barRow, bars))
+        if len(self._rows) >= self.chunkSize: self._writeRows()
+
+    def writeArray(self, array, daily=False):
+        self._packRows()
+        self._arrays.append(array)
+        self._nArrays += len(array)
+        if self._nArrays >= self.chunkSize: self._writeRows()
+
+    def _packRows(self):
+        if not self._rows: return
+        self._arrays.append(np.array(self._rows, dtype=BAR_DTYPE))
+        self._nArrays += len(self._rows)
+        self._rows = []
+
+    def _writeRows(self):
+        self._packRows()
+        if not self._arrays: return
+        array = self._arrays[0] if len(self._arrays) == 1 else np.concatenate(self._arrays)
+        self._arrays = []
+        self._nArrays = 0
+        self.writeBars(array)
+
+    def writeBars(self, array):
+        """BAR_DTYPE array out: to the writeColumns() of the subclass by default"""
+        self.writeColumns({name: np.ascontiguousarray(array[name]) for name, _ in BAR_COLUMNS})
+
+    def flush(self, fsync=True):
+        self._writeRows()
+
+    def close(self):
+        self._writeRows()
+
+class NpySink(ColumnarSink):
+    def __init__(self, fileName, chunkSize=65536, append=False):
+        ColumnarSink.__init__(self, fileName, chunkSize)
+        if not os.path.exists(fileName): os.makedirs(fileName)
+        self._columns = {name: NpyColumn(os.path.join(fileName, f'{name}.npy'), dtype, append)
+                         for name, dtype in BAR_COLUMNS}
+        # Columns could be left with the different length by the crash
+        count = min(column.count for column in self._columns.values())
+        for column in self._columns.values():
+            if column.count != count: column.truncate(count)
+        self._lastTime = int(self._columns['time'].last()) if count else None
+
+    def upsert(self, array, daily=False):
+        """Same as CsvSink.upsert()"""
+        self._writeRows()
+        if self._lastTime is not None:
+            array = array[array['time'] >= self._lastTime]
+            if not len(array): return
+            if array['time'][0] == self._lastTime:
+                for column in self._columns.values(): column.truncate(column.count - 1)
+        self._lastTime = int(array['time'][-1])
+        self.writeColumns({name: np.ascontiguousarray(array[name]) for name, _ in BAR_COLUMNS})
+
+    def writeColumns(self, columns):
+        for name, values in columns.items(): self._columns[name].append(values)
+
+    def flush(self, fsync=True):
+        if self._columns is None: return
+        ColumnarSink.flush(self, fsync)
+        for column in self._columns.values(): column.flush(fsync)
+
+    def close(self):
+        if self._columns is None: return
+        ColumnarSink.close(self)
+        for column in self._columns.values(): column.close()
+        self._columns = None
+
+class ParquetSink(ColumnarSink):
+    def __init__(self, fileName, chunkSize=65536):
+        if pq is None: raise RuntimeError('Parquet output requires pyarrow')
+        ColumnarSink.__init__(self, fileName, chunkSize)
+        self._schema = pa.schema([(name, pa.from_numpy_dtype(np.dtype(dtype)))
+                                  for name, dtype in BAR_COLUMNS])
+        self._writer = pq.ParquetWriter(fileName, self._schema)
+
+    def writeColumns(self, columns):
+        self._writer.write_table(pa.Table.from_arrays(
+            [columns[name] for name, _ in BAR_COLUMNS], schema=self._schema))
+
+    def close(self):
+        if self._writer is None: return
+        ColumnarSink.close(self)
+        self._writer.close()
+        self._writer = None
+
+class ChunkedSink(ColumnarSink):
+    """
+    Chunked compressed file: the bars go in the chunks of exactly `chunkSize`,
+    the rest waits for the next bars, only the last chunk could be shorter.
+    flush() makes durable the chunks written so far.
+    """
+    def __init__(self, fileName, chunkSize=CHUNK_SIZE, codec=None):
+        ColumnarSink.__init__(self, fileName, chunkSize)
+        self._writer = ChunkedWriter(fileName, codec=codec)
+        self._tail = None   # Bars short of the full chunk
+
+    def writeBars(self, array):
+        if self._tail is not None:
+            array = np.concatenate((self._tail, array))
+            self._tail = None
+        full = len(array) // self.chunkSize * self.chunkSize
+        if full: self._writer.write(array[:full], self.chunkSize)
+        if full < len(array): self._tail = array[full:]
+
+    def flush(self, fsync=True):
+        if self._writer is None: return
+        ColumnarSink.flush(self, fsync)
+        self._writer.flush(fsync)
+
+    def close(self):
+        if self._writer is None: return
+        ColumnarSink.close(self)
+        if self._tail is not None: self._writer.writeChunk(self._tail)
+        self._tail = None
+        self._writer.close()
+        self._writer = None
+#endregion Columnar
+
+class ArraySink:
+    """
+    In-memory sink: collects bars into the BAR_DTYPE array.
+    onBatch(array) -- called with every `batchSize` new bars and on flush
+    onClose(array) -- called with all the bars on close
+    """
+    def __init__(self, onClose=None, onBatch=None, batchSize=1024):
+        self.onClose = onClose
+        self.onBatch = onBatch
+        self.batchSize = batchSize
+        self.array = None
+        self._rows = []     # Bars not packed into the array yet
+        self._new = []      # Arrays not sent with onBatch yet
+        self._sent = []     # Arrays sent
+        self._nNew = 0
+
+    def write(self, bar):
+        self._rows.append(barRow(bar))
+        self._nNew += 1
+        if self.onBatch and self._nNew >= self.batchSize: self._sendBatch()
+
+    def writeMany(self, bars):
+        self._rows.extend(map(barRow, bars))
+        self._nNew += len(bars)
+        if self.onBatch and self._nNew >= self.batchSize: self._sendBatch()
+
+    def writeArray(self, array, daily=False):
+        self._packRows()
+        self._new.append(array)
+        self._nNew += len(array)
+        if self.onBatch and self._nNew >= self.batchSize: self._sendBatch()
+
+    def _packRows(self):
+        if not self._rows: return
+        self._new.append(np.array(self._rows, dtype=BAR_DTYPE))
+        self._rows = []
+
+    def _newArray(self):
+        self._packRows()
+        array = np.concatenate(self._new) if self._new else np.empty(0, dtype=BAR_DTYPE)
+        self._new = []
+        self._nNew = 0
+        return array
+
+    def _sendBatch(self):
+        if not self._nNew: return
+        batch = self._newArray()
+        self._sent.append(batch)
+        self.onBatch(batch)
+
+    def flush(self, fsync=True):
+        if self.onBatch: self._sendBatch()
+
+    def close(self):
+        if self.array is not None: return
+        if self.onBatch: self._sendBatch()
+        self._sent.append(self._newArray())
+        self.array = np.concatenate(self._sent)
+        self._sent = None
+        if self.onClose: self.onClose(self.array)
+
+# Output format -> (sink class, file name extension)
+FORMATS = {
+    'csv'     : (CsvSink, '.csv'),
+    'npy'     : (NpySink, ''),
+    'parquet' : (ParquetSink, '.parquet'),
+    'chunked' : (ChunkedSink, '.ibz'),
+}
+
+# Formats which could be appended to (streams)
+APPEND_FORMATS = ('csv', 'npy')
+
+def makeSink(fileName, fmt='csv', append=False):
+    """append -- append to the existing output, APPEND_FORMATS only"""
+    if not append: return FORMATS[fmt][0](fileName)
+    if fmt not in APPEND_FORMATS: raise ValueError(f'Cannot append to {fmt} output')
+    return FORMATS[fmt][0](fileName, append=True)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Local bar store.
+
+Bars are stored on disk by (symbol, barSize, barType) key:
+    <root>/<symbol>/<barType>/<barSize>/
+        coverage.json       - sorted list of [start, end) epoch intervals
+                              already downloaded
+        <start>-<end>.csv   - segments: bars downloaded for one interval
+        repaired.json       - intervals re-requested by the repair (see below)
+
+A new request is reduced to the intervals not covered yet,
+so only the missing gaps are requested from the TWS.
+With `resample` a period covered by the finer bars (say 1 min for 1 hour)
+is not requested at all: the bars are resampled from the store.
+With the session calendar no requests are sent for the closed market and
+`repair` re-requests only the bars missing inside the covered intervals,
+once: the bars still missing after the repair (no trades) are not requested
+again.
+With the adjustment table ADJUSTED_LAST bars are the stored TRADES ones
+adjusted on the export, only TRADES are requested (see adjust.py).
+'''
+
+#region import
+import os
+import sys
+import json
+import time
+import heapq
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from ibapi.common import BarData
+
+from timeutils import (barEpoch, barSizeSeconds, durationStart, formatBarDate,
+                       formatEndDate, parseEndDate, toEpoch)
+from backfill import BackfillJob, isNoData, planChunks
+from scheduler import HistRequest
+from sinks import fsyncFile
+from bars import BAR_DTYPE, mergeChunks
+from resample import RESAMPLE_TYPES, resample, sources
+from sessions import planRepairs
+from adjust import adjust
+#endregion import
+
+#region Intervals
+#-----------------------------------------------------------------------------
+def mergeIntervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]: merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+def subtractIntervals(start, end, covered):
+    """Parts of [start, end) not covered by the sorted merged intervals"""
+    gaps = []
+    for s, e in covered:
+        if e <= start: continue
+        if s >= end: break
+        if s > start: gaps.append((start, s))
+        start = max(start, e)
+        if start >= end: break
+    if start < end: gaps.append((start, end))
+    return gaps
+#endregion Intervals
+
+class StoreKey:
+    def __init__(self, symbol, barSize, barType):
+        self.symbol = symbol
+        self.barSize = barSize
+        self.barType = barType
+
+    @property
+    def path(self):
+        return os.path.join(self.symbol, self.barType, self.barSize.replace(' ', '_'))
+
+    def __str__(self): return f'{self.symbol} {self.barSize} {self.barType}'
+
+class SegmentSink:
+    """Writes bars of one interval into the store segment file"""
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._tmpName = fileName + '.tmp'
+        self._file = open(self._tmpName, 'w')
+
+    @staticmethod
+    def _line(bar):
+        return (f'{barEpoch(bar.date)},{bar.open},{bar.high},{bar.low},{bar.close},'
+                f'{bar.volume},{bar.barCount},{bar.average}\n')
+
+    def write(self, bar):
+        self._file.write(self._line(bar))
+
+    def writeMany(self, bars):
+        self._file.write(''.join(map(self._line, bars)))
+
+    def writeArray(self, array, daily=False):
+        self._file.write(''.join(f'{t},{o},{h},{l},{c},{v},{n},{a}\n'
+                                 for t, o, h, l, c, v, n, a in array.tolist()))
+
+    def flush(self, fsync=True):
+        if not self._file: return
+        if fsync: fsyncFile(self._file)
+        else: self._file.flush()
+
+    def close(self):
+        if self._file:
+            fsyncFile(self._file)
+            self._file.close()
+            self._file = None
+            os.replace(self._tmpName, self.fileName)
+
+class BarStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, key):
+        path = os.path.join(self.root, key.path)
+        if not os.path.exists(path): os.makedirs(path)
+        return path
+
+    def _intervals(self, key, name):
+        fileName = os.path.join(self._dir(key), name)
+        if not os.path.exists(fileName): return []
+        with open(fileName) as f: return json.load(f)
+
+    def _addInterval(self, key, name, start, end):
+        if start >= end: return
+        intervals = mergeIntervals(self._intervals(key, name) + [[start, end]])
+        fileName = os.path.join(self._dir(key), name)
+        with open(fileName + '.tmp', 'w') as f: json.dump(intervals, f)
+        os.replace(fileName + '.tmp', fileName)
+
+    def coverage(self, key):
+        return self._intervals(key, 'coverage.json')
+
+    def addCoverage(self, key, start, end):
+        self._addInterval(key, 'coverage.json', start, end)
+
+    def repaired(self, key):
+        """Intervals re-requested by the repair: the bars still missing there do not exist"""
+        return self._intervals(key, 'repaired.json')
+
+    def addRepaired(self, key, start, end):
+        self._addInterval(key, 'repaired.json', start, end)
+
+    def missing(self, key, start, end):
+        """Intervals of [start, end) not in the store yet"""
+        return subtractIntervals(start, end, self.coverage(key))
+
+    def resampleSource(self, key, start, end):
+        """Key of the finer bars covering all of [start, end) or None"""
+        if key.barType not in RESAMPLE_TYPES: return None
+        for barSize in sources(key.barSize):
+            source = StoreKey(key.symbol, barSize, key.barType)
+            if not os.path.exists(os.path.join(self.root, source.path)): continue
+            if not self.missing(source, start, end): return source
+        return None
+
+    def segmentSink(self, key, start, end):
+        return SegmentSink(os.path.join(self._dir(key), f'{start}-{end}.csv'))
+
+    def segments(self, key, start, end):
+        """Segment files overlapping [start, end) ordered by the start time"""
+        path = self._dir(key)
+        result = []
+        for name in os.listdir(path):
+            if not name.endswith('.csv'): continue
+            s, e = map(int, name[:-4].split('-'))
+            if s < end and e > start: result.append((s, os.path.join(path, name)))
+        return [fileName for _, fileName in sorted(result)]
+
+    def _readSegment(self, fileName, start, end):
+        with open(fileName) as f:
+            for line in f:
+                row = line.split(',')
+                t = int(row[0])
+                if t < start: continue
+                if t >= end: break
+                yield t, row
+
+    def readArray(self, key, start, end):
+        """BAR_DTYPE array of [start, end) from the store in the time order"""
+        parts = []
+        for fileName in self.segments(key, start, end):
+            if not os.path.getsize(fileName): continue
+            # The segment columns are in the BAR_DTYPE order
+            part = np.loadtxt(fileName, delimiter=',', dtype=BAR_DTYPE, ndmin=1)
+            t = part['time']
+            parts.append(part[np.searchsorted(t, start):np.searchsorted(t, end)])
+        if not parts: return np.empty(0, dtype=BAR_DTYPE)
+        array = np.concatenate(parts)
+        if len(parts) > 1:
+            # Segments could overlap: the first (older) segment wins
+            array = array[np.argsort(array['time'], kind='stable')]
+            t = array['time']
+            keep = np.empty(len(t), dtype=bool)
+            keep[0] = True
+            np.not_equal(t[1:], t[:-1], out=keep[1:])
+            array = array[keep]
+        return array
+
+    def read(self, key, start, end):
+        """Bars of [start, end) from the store in the time order"""
+        daily = barSizeSeconds(key.barSize) >= barSizeSeconds('1 day')
+        last = None
+        for t, row in heapq.merge(*(self._readSegment(fileName, start, end)
+                                    for fileName in self.segments(key, start, end)),
+                                  key=lambda x: x[0]):
+            if t == last: continue
+            last = t
+            bar = BarData()
+            bar.date = formatBarDate(t, daily)
+            bar.open, bar.high, bar.low, bar.close = map(float, row[1:5])
+            bar.volume, bar.barCount = int(row[5]), int(row[6])
+            bar.average = float(row[7])
+            yield bar
+
+class StoreJob(BackfillJob):
+    """
+    Job which downloads only the gaps missing in the store.
+    When all the gaps are done the whole period is exported
+    from the store to the job sink.
+    With the writer all the disk work is done in the writer thread.
+    """
+    def __init__(self, name, store, key, start, end, gaps, requests, sink, writer=None,
+                 source=None, calendar=None, events=None, adjustments=None, repairs=None):
+        BackfillJob.__init__(self, name, requests, sink)
+        self.store = store
+        self.writer = writer
+        self.key = key
+        self.source = source  # Finer bars key to resample from
+        self.calendar = calendar
+        self.events = events  # Adjustment events: the raw bars are adjusted on the export
+        self.adjustments = adjustments  # ADJUSTED_LAST download: derive the events
+        self.start = start
+        self.end = end
+        self.gaps = gaps
+        self.repairs = len(gaps) if repairs is None else repairs  # First repair window gap
+        self._failed = set()
+        self._pending = [0] * len(gaps)
+        for request in self.requests: self._pending[request.gap] += 1
+
+    def onRequestEnd(self, request):
+        self._pending[request.gap] -= 1
+
+    def onRequestError(self, request, errorCode, errorString):
+        quiet = BackfillJob.onRequestError(self, request, errorCode, errorString)
+        self._pending[request.gap] -= 1
+        if not isNoData(errorCode, errorString): self._failed.add(request.gap)
+        return quiet
+
+    def close(self):
+        if self._chunks is None: return
+        chunks, self._chunks = self._chunks, None
+        if self.writer: self.writer.call(self._close, chunks)
+        else: self._close(chunks)
+
+    def _close(self, chunks):
+        try:
+            self._storeGaps(chunks)
+        except Exception:
+            logging.exception(f'Cannot store {self.key}')
+
+        if self.source:
+            sessionStarts = (self.calendar.sessionStarts(self.start, self.end)
+                             if self.calendar else None)
+            array = resample(self.store.readArray(self.source, self.start, self.end),
+                             self.key.barSize, sessionStarts)
+        else:
+            array = self.store.readArray(self.key, self.start, self.end)
+        if self.events is not None: array = adjust(array, self.events)
+        elif self.adjustments is not None: self._deriveEvents(array)
+        self.nBars = len(array)
+        self.sink.writeArray(array, barSizeSeconds(self.key.barSize) >= barSizeSeconds('1 day'))
+        self.sink.close()
+
+    def _deriveEvents(self, adjusted):
+        """Events from the downloaded ADJUSTED_LAST and the stored TRADES bars"""
+        raw = self.store.readArray(StoreKey(self.key.symbol, self.key.barSize, 'TRADES'),
+                                   self.start, self.end)
+        if not len(raw) or not len(adjusted):
+            logging.info(f'{self.key}: no TRADES bars in the store, no adjustment events')
+            return
+        try:
+            # The events after the period are not told apart: known for the period only
+            self.adjustments.derive(self.key.symbol, raw, adjusted, self.start, self.end)
+        except Exception:
+            logging.exception(f'{self.key}: cannot derive the adjustment events')
+
+    def _storeGaps(self, chunks):
+        # The last bar could be incomplete yet
+        now = int(time.time()) - barSizeSeconds(self.key.barSize)
+        byGap = [[] for _ in self.gaps]
+        for request, chunk in zip(self.requests, chunks):
+            byGap[request.gap].append(chunk)
+
+        for i, ((start, end), chunks) in enumerate(zip(self.gaps, byGap)):
+            # Failed or interrupted gap will be requested again next time
+            if i in self._failed or self._pending[i]: continue
+            end = min(end, now)
+            if start >= end: continue
+            sink = self.store.segmentSink(self.key, start, end)
+            if self._typed:
+                array = mergeChunks(chunks)
+                t = array['time']
+                sink.writeArray(array[np.searchsorted(t, start):np.searchsorted(t, end)])
+            else:
+                last = None
+                for chunk in reversed(chunks):
+                    for bar in chunk:
+                        t = barEpoch(bar.date)
+                        if t < start or t >= end or (last is not None and t <= last): continue
+                        last = t
+                        sink.write(bar)
+            sink.close()
+            self.store.addCoverage(self.key, start, end)
+            if i >= self.repairs: self.store.addRepaired(self.key, start, end)
+
+def repairGaps(store, key, start, end, gaps, calendar):
+    """
+    Request windows for the bars missing in the store inside [start, end)
+    except the `gaps` (requested anyway) and the windows repaired already
+    """
+    times = store.readArray(key, start, end)['time']
+    skip = mergeIntervals([list(gap) for gap in gaps] + store.repaired(key))
+    holes = []
+    for holeStart, holeEnd in calendar.holes(times, start, end, key.barSize):
+        holes += subtractIntervals(holeStart, holeEnd, skip)
+    windows = sorted(planRepairs(holes, key.barSize))
+    if holes:
+        logging.info(f'{key}: {len(holes)} holes, {len(windows)} repair requests')
+    return windows
+
+def makeStoreJob(name, store, contract, endDate, duration, barSize, barType, sink,
+                 writer=None, start=None, allowResample=False, calendar=None, repair=False,
+                 adjustments=None, **kwargs):
+    """
+    Job for the period part missing in the store
+    allowResample -- no requests if the finer bars of the whole period are in the store
+    start    -- datetime, overrides the period start (e.g. the head timestamp)
+    calendar -- SessionCalendar: no requests for the gaps without the trading sessions
+    repair   -- with the calendar: request the bars missing in the covered intervals too
+    adjustments -- adjust.AdjustmentTable: ADJUSTED_LAST from TRADES if the symbol
+                   events are fresh and known from the period start, derive the
+                   events from the download otherwise
+    """
+    end, tz = parseEndDate(endDate)
+    if start is None: start = durationStart(end, duration)
+    startEpoch, endEpoch = toEpoch(start), toEpoch(end)
+    events = None
+    if adjustments is not None and barType == 'ADJUSTED_LAST':
+        events = adjustments.events(contract.symbol, startEpoch)
+        if events is not None:
+            logging.info(f'{contract.symbol}: ADJUSTED_LAST from TRADES, '
+                         f'{len(events)} adjustment events')
+            barType = 'TRADES'
+    key = StoreKey(contract.symbol, barSize, barType)
+    gaps = store.missing(key, startEpoch, endEpoch)
+    source = None
+    if gaps and allowResample:
+        source = store.resampleSource(key, startEpoch, endEpoch)
+        if source:
+            logging.info(f'{key}: resampled from {source.barSize}')
+            gaps = []
+    repairs = len(gaps)
+    if repair and calendar and not source:
+        gaps += repairGaps(store, key, startEpoch, endEpoch, gaps, calendar)
+
+    requests = []
+    for i, (gapStart, gapEnd) in enumerate(gaps):
+        if calendar and not calendar.countBars(gapStart, gapEnd, barSize):
+            # Market closed: nothing to request, the gap is covered as is
+            continue
+        chunks = planChunks(formatEndDate(datetime.fromtimestamp(gapEnd), tz), None, barSize,
+                            start=datetime.fromtimestamp(gapStart))
+        for chunkEnd, chunkDuration in chunks:
+            request = HistRequest(contract, chunkEnd, chunkDuration, barSize, barType, **kwargs)
+            request.gap = i
+            requests.append(request)
+
+    logging.info(f'{key}: {len(gaps)} gaps, {len(requests)} requests')
+    return StoreJob(name, store, key, startEpoch, endEpoch, gaps, requests, sink, writer,
+                    source, calendar, events,
+                    adjustments if barType == 'ADJUSTED_LAST' else None, repairs)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
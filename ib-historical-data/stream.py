@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Streaming: keepUpToDate historical data subscription.
+
+One long-lived request per symbol instead of the repeated full downloads:
+the initial bars come as usual, then TWS sends historicalDataUpdate with the
+still forming last bar every few seconds. The forming bar is upserted in the
+output (overwritten while its time is the same), the completed bars stay
+appended. The output is opened in the append mode, so a restarted stream
+continues the same file.
+'''
+
+#region import
+import sys
+
+from timeutils import barSizeSeconds, DAY
+from scheduler import HistRequest, Job
+from bars import barsToArray
+#endregion import
+
+# TWS does not support keepUpToDate for the shorter bars
+MIN_BAR_SIZE = 5
+
+class StreamJob(Job):
+    """
+    Job of one keepUpToDate request. It is done only when the subscription
+    is cancelled or fails.
+    onLoaded(job) -- called when the initial bars are written
+    """
+    def __init__(self, name, request, sink, onLoaded=None):
+        Job.__init__(self, name, [request], sink)
+        self.onLoaded = onLoaded
+        self.daily = barSizeSeconds(request.barSize) >= DAY
+        self.nUpdates = 0
+        self._initial = []
+        self._lastTime = None
+
+    def onBar(self, request, bar):
+        self._initial.append(bar)
+
+    def onArray(self, request, array):
+        self._upsert(array)
+
+    def onRequestEnd(self, request):
+        if self._initial:
+            self._upsert(barsToArray(self._initial))
+            self._initial = []
+        self.sink.flush()
+        if self.onLoaded: self.onLoaded(self)
+
+    def onUpdate(self, request, bar):
+        self.nUpdates += 1
+        self._upsert(barsToArray([bar]))
+        # Visible to the readers, no fsync for every update
+        self.sink.flush(False)
+
+    def _upsert(self, array):
+        if not len(array): return
+        t = array['time']
+        self.nBars += len(array) if self._lastTime is None else int((t > self._lastTime).sum())
+        self._lastTime = max(int(t[-1]), self._lastTime or 0)
+        self.sink.upsert(array, self.daily)
+
+def makeStreamJob(name, contract, duration, barSize, barType, sink, onLoaded=None, **kwargs):
+    """
+    Job for the keepUpToDate subscription: `duration` of the initial bars
+    up to now, then the live updates
+    """
+    if barSizeSeconds(barSize) < MIN_BAR_SIZE:
+        raise ValueError(f'keepUpToDate is not supported for {barSize} bars')
+    # TWS requires the empty end date for keepUpToDate
+    request = HistRequest(contract, '', duration, barSize, barType, keepUpToDate=True, **kwargs)
+    return StreamJob(name, request, sink, onLoaded)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
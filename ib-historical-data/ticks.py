@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Historical ticks: reqHistoricalTicks paging.
+
+One request returns up to 1000 ticks starting from the given time, the next
+page starts from the last tick time received. The period is split into the
+segments (sessions with the calendar, days without), every segment is paged
+by its own chain of requests - many pages of the same or different symbols
+are in flight at once within the pacing rules.
+
+Ticks are typed arrays (TICK_DTYPES), the output is a directory with
+one .npy file per column like the npy bars format. With the store every
+finished segment goes to <store>/<symbol>/<whatToShow>/ticks/<start>-<end>.npy
+at once, the covered segments are never requested again.
+'''
+
+#region import
+import os
+import sys
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from timeutils import DAY, formatEndDate
+from scheduler import Job, Request, contractKey
+from sinks import NpyColumn, fsyncFile
+from backfill import isNoData
+#endregion import
+
+PAGE_SIZE = 1000
+
+TICK_COLUMNS = {
+    'TRADES': (('time', '<i8'), ('price', '<f8'), ('size', '<i8'), ('mask', '<i4'),
+               ('exchange', 'S8'), ('conditions', 'S8')),
+    'BID_ASK': (('time', '<i8'), ('bidPrice', '<f8'), ('askPrice', '<f8'),
+                ('bidSize', '<i8'), ('askSize', '<i8'), ('mask', '<i4')),
+    'MIDPOINT': (('time', '<i8'), ('price', '<f8')),
+}
+
+TICK_DTYPES = {whatToShow: np.dtype(list(columns)) for whatToShow, columns in TICK_COLUMNS.items()}
+
+# Fields per tick in the HISTORICAL_TICKS* messages
+TICK_WIDTH = {'TRADES': 6, 'BID_ASK': 6, 'MIDPOINT': 4}
+
+def checkWhatToShow(whatToShow):
+    if whatToShow not in TICK_DTYPES:
+        raise ValueError(f'No historical ticks for {whatToShow}, '
+                         f'only {", ".join(TICK_DTYPES)}')
+
+def parseTicks(whatToShow, fields, count):
+    """Raw HISTORICAL_TICKS* message fields (bytes) of `count` ticks -> typed array"""
+    array = np.empty(count, dtype=TICK_DTYPES[whatToShow])
+    if not count: return array
+    width = TICK_WIDTH[whatToShow]
+    raw = np.array(fields, dtype=bytes).reshape(count, width)
+    array['time'] = raw[:, 0].astype(np.int64)
+    if whatToShow == 'TRADES':
+        array['mask'] = raw[:, 1].astype(np.int32)
+        array['price'] = raw[:, 2].astype(np.float64)
+        array['size'] = raw[:, 3].astype(np.float64)
+        array['exchange'] = raw[:, 4]
+        array['conditions'] = raw[:, 5]
+    elif whatToShow == 'BID_ASK':
+        array['mask'] = raw[:, 1].astype(np.int32)
+        for i, name in enumerate(('bidPrice', 'askPrice'), 2):
+            array[name] = raw[:, i].astype(np.float64)
+        for i, name in enumerate(('bidSize', 'askSize'), 4):
+            array[name] = raw[:, i].astype(np.float64)
+    else:
+        # Field 1 is empty, size is always 0
+        array['price'] = raw[:, 2].astype(np.float64)
+    return array
+
+def ticksToArray(whatToShow, ticks):
+    """List of HistoricalTick* objects -> typed array"""
+    if whatToShow == 'TRADES':
+        rows = [(t.time, t.price, t.size,
+                 int(t.tickAttribLast.pastLimit) | int(t.tickAttribLast.unreported) << 1,
+                 t.exchange.encode(), t.specialConditions.encode()) for t in ticks]
+    elif whatToShow == 'BID_ASK':
+        rows = [(t.time, t.priceBid, t.priceAsk, t.sizeBid, t.sizeAsk,
+                 int(t.tickAttribBidAsk.askPastHigh) | int(t.tickAttribBidAsk.bidPastLow) << 1)
+                for t in ticks]
+    else:
+        rows = [(t.time, t.price) for t in ticks]
+    return np.array(rows, dtype=TICK_DTYPES[whatToShow])
+
+class TickRequest(Request):
+    """One reqHistoricalTicks page of the segment"""
+    def __init__(self, contract, segment, start, whatToShow, useRTH=1, pageSize=PAGE_SIZE,
+                 skip=0):
+        key = contractKey(contract) + (whatToShow,)
+        Request.__init__(self, contract, key, key + ('ticks', start, useRTH, pageSize),
+                         2 if whatToShow == 'BID_ASK' else 1)
+        self.segment = segment
+        self.start = start
+        self.whatToShow = whatToShow
+        self.useRTH = useRTH
+        self.pageSize = pageSize
+        self.skip = skip  # Ticks at `start` the previous page already has
+        self.expected = pageSize
+
+    def send(self, client, reqId):
+        start = formatEndDate(datetime.fromtimestamp(self.start))
+        client.reqHistoricalTicks(reqId, self.contract, start, '', self.pageSize,
+                                  self.whatToShow, self.useRTH, True, [])
+
+    def __str__(self):
+        return f'{self.contract.symbol} ticks {self.whatToShow} from {datetime.fromtimestamp(self.start)}'
+
+class TickSink:
+    """Directory with one .npy file per tick column"""
+    def __init__(self, fileName, whatToShow):
+        checkWhatToShow(whatToShow)
+        self.fileName = fileName
+        if not os.path.exists(fileName): os.makedirs(fileName)
+        self._columns = {name: NpyColumn(os.path.join(fileName, f'{name}.npy'), dtype)
+                         for name, dtype in TICK_COLUMNS[whatToShow]}
+
+    def writeArray(self, array, daily=False):
+        for name, column in self._columns.items(): column.append(array[name])
+
+    def flush(self, fsync=True):
+        if self._columns is None: return
+        for column in self._columns.values(): column.flush(fsync)
+
+    def close(self):
+        if self._columns is None: return
+        for column in self._columns.values(): column.close()
+        self._columns = None
+
+class TickStore:
+    """Tick segments of the bar store: one .npy (structured array) per segment"""
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.dtype = TICK_DTYPES[key.barType]
+
+    def missing(self, start, end):
+        return self.store.missing(self.key, start, end)
+
+    def write(self, start, end, array):
+        path = os.path.join(self.store.root, self.key.path, f'{start}-{end}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+            fsyncFile(f)
+        os.replace(path + '.tmp', path)
+        self.store.addCoverage(self.key, start, end)
+
+    def read(self, start, end):
+        """Ticks of [start, end) in the time order"""
+        path = os.path.join(self.store.root, self.key.path)
+        files = []
+        for name in os.listdir(path) if os.path.exists(path) else ():
+            if not name.endswith('.npy'): continue
+            s, e = map(int, name[:-4].split('-'))
+            if s < end and e > start: files.append((s, os.path.join(path, name)))
+        parts = []
+        for _, fileName in sorted(files):
+            part = np.load(fileName)
+            t = part['time']
+            parts.append(part[np.searchsorted(t, start):np.searchsorted(t, end)])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=self.dtype)
+
+class TickJob(Job):
+    """
+    Paged download of the ticks of [start, end).
+    Without the store the finished segments go to the sink in the time order
+    as soon as all the segments before them are finished.
+    """
+    def __init__(self, name, contract, start, end, whatToShow, segments, sink,
+                 store=None, writer=None, useRTH=1, pageSize=PAGE_SIZE):
+        self.segments = segments
+        Job.__init__(self, name, [TickRequest(contract, i, s, whatToShow, useRTH, pageSize)
+                                  for i, (s, _) in enumerate(segments)], sink)
+        self.start = start
+        self.end = end
+        self.whatToShow = whatToShow
+        self.store = store
+        self.writer = writer
+        self._pages = [[] for _ in segments]
+        self._done = [False] * len(segments)
+        self._failed = set()
+        self._next = 0  # Segment to write to the sink next (no store)
+
+    def onArray(self, request, array):
+        request.page = array
+
+    def onRequestEnd(self, request):
+        page = getattr(request, 'page', None)
+        request.page = None
+        i = request.segment
+        segEnd = self.segments[i][1]
+        if page is None or not len(page):
+            self._segmentDone(i)
+            return
+
+        t = page['time']
+        # Ticks at the page start the previous page already has
+        skipped = min(request.skip, int(np.searchsorted(t, request.start, side='right')))
+        inSegment = page[skipped:np.searchsorted(t, segEnd)]
+        if len(inSegment):
+            self._pages[i].append(inSegment)
+            self.nBars += len(inSegment)
+        last = int(t[-1])
+        if len(page) < request.pageSize or last >= segEnd:
+            self._segmentDone(i)
+            return
+
+        # The next page starts at the last tick time, the ticks of that second
+        # this page has are skipped
+        skip = int(len(t) - np.searchsorted(t, last))
+        if last == request.start and skip <= request.skip:
+            logging.warning(f'{self.name}: more than {request.pageSize} ticks at '
+                            f'{datetime.fromtimestamp(last)}, the rest of the second is lost')
+            last, skip = last + 1, 0
+        self.scheduler.add(self, TickRequest(request.contract, i, last, self.whatToShow,
+                                             request.useRTH, request.pageSize, skip))
+
+    def onRequestError(self, request, errorCode, errorString):
+        Job.onRequestError(self, request, errorCode, errorString)
+        noData = isNoData(errorCode, errorString)
+        # No data for the next page is not the end of the segment for sure:
+        # the segment with any error but 'no data' on the first page is not stored
+        firstPage = request.start == self.segments[request.segment][0] and not request.skip
+        if not (noData and firstPage): self._failed.add(request.segment)
+        self._segmentDone(request.segment)
+        return noData
+
+    def _segmentDone(self, i):
+        self._done[i] = True
+        if self.store:
+            if i in self._failed: return
+            start, end = self.segments[i]
+            array = self._segment(i)
+            if self.writer: self.writer.call(self.store.write, start, end, array)
+            else: self.store.write(start, end, array)
+            return
+        while self._next < len(self.segments) and self._done[self._next]:
+            array = self._segment(self._next)
+            if len(array): self.sink.writeArray(array)
+            self._next += 1
+        self.sink.flush(False)
+
+    def _segment(self, i):
+        pages, self._pages[i] = self._pages[i], None
+        if not pages: return np.empty(0, dtype=TICK_DTYPES[self.whatToShow])
+        return pages[0] if len(pages) == 1 else np.concatenate(pages)
+
+    def close(self):
+        if self.store:
+            if self.writer: self.writer.call(self._export)
+            else: self._export()
+        else:
+            self.sink.close()
+
+    def _export(self):
+        array = self.store.read(self.start, self.end)
+        self.nBars = len(array)
+        self.sink.writeArray(array)
+        self.sink.close()
+
+def tickSegments(start, end, calendar=None, useRTH=1):
+    """[start, end) -> sessions (with the calendar and useRTH) or local days"""
+    if calendar and useRTH:
+        _, opens, closes = calendar.sessions(start, end)
+        return [(max(int(o), start), min(int(c), end)) for o, c in zip(opens, closes)]
+    segments = []
+    day = datetime.fromtimestamp(start).replace(hour=0, minute=0, second=0)
+    while True:
+        s = max(int(day.timestamp()), start)
+        day = datetime.fromtimestamp(day.timestamp() + DAY + 3600).replace(hour=0)
+        e = min(int(day.timestamp()), end)
+        if s >= end: break
+        segments.append((s, e))
+    return segments
+
+def makeTickJob(name, contract, start, end, whatToShow, sink, store=None, writer=None,
+                calendar=None, useRTH=1, pageSize=PAGE_SIZE):
+    """
+    Job for the ticks of [start, end) epoch seconds
+    store -- store.BarStore: only the segments missing in the store are requested
+    """
+    checkWhatToShow(whatToShow)
+    tickStore = None
+    gaps = [(start, end)]
+    if store:
+        from store import StoreKey
+        tickStore = TickStore(store, StoreKey(contract.symbol, 'ticks', whatToShow))
+        gaps = tickStore.missing(start, end)
+    segments = [segment for s, e in gaps for segment in tickSegments(s, e, calendar, useRTH)]
+    logging.info(f'{name}: {len(segments)} tick segments')
+    return TickJob(name, contract, start, end, whatToShow, segments, sink,
+                   tickStore, writer, useRTH, pageSize)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
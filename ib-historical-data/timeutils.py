@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Date/time utils for the TWS duration, bar size and date strings.
+'''
+
+#region import
+import sys
+import time
+import calendar
+from datetime import datetime, timedelta
+#endregion import
+
+IB_DATE_FMT = '%Y%m%d %H:%M:%S'
+
+SECOND = 1
+MINUTE = 60
+HOUR = 3600
+DAY = 24*HOUR
+WEEK = 7*DAY
+
+_barUnit2secs = dict(sec=SECOND, min=MINUTE, hour=HOUR, day=DAY, week=WEEK, month=30*DAY)
+
+def parseDuration(duration):
+    """'3 W' -> (3, 'W')"""
+    n, unit = duration.split()
+    return int(n), unit[0].upper()
+
+def barSizeSeconds(barSize):
+    """'5 mins' -> 300"""
+    n, unit = barSize.split()
+    unit = unit.rstrip('s')
+    if unit == 'sec': return int(n)
+    return int(n) * _barUnit2secs[unit]
+
+# Seconds in the duration unit: calendar and trading (6.5 hours trading day)
+_durationSecs = dict(S=1, D=DAY, W=WEEK, M=30*DAY, Y=365*DAY)
+_tradingSecs = dict(S=1, D=6.5*HOUR, W=5*6.5*HOUR, M=22*6.5*HOUR, Y=252*6.5*HOUR)
+
+def estimateBars(duration, barSize):
+    """Rough estimation of the number of bars in the duration"""
+    n, unit = parseDuration(duration)
+    secs = barSizeSeconds(barSize)
+    if secs > DAY: return max(1, int(n * _durationSecs[unit] / secs))
+    if secs == DAY: return max(1, int(n * _tradingSecs[unit] / _tradingSecs['D']))
+    return max(1, int(n * _tradingSecs[unit] / secs))
+
+def addMonths(dt, months):
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+def durationStart(end, duration):
+    """Start datetime of the `duration` period ending at `end`"""
+    n, unit = parseDuration(duration)
+    if unit == 'S': return end - timedelta(seconds=n)
+    if unit == 'D': return end - timedelta(days=n)
+    if unit == 'W': return end - timedelta(weeks=n)
+    if unit == 'M': return addMonths(end, -n)
+    if unit == 'Y': return addMonths(end, -12*n)
+    raise ValueError(f'Unknown duration: {duration}')
+
+def parseEndDate(endDate):
+    """
+    'yyyymmdd hh:mm:ss [tz]' -> (datetime, tz)
+    Empty end date means 'now'.
+    """
+    if not endDate: return datetime.now().replace(microsecond=0), ''
+    date, _, rest = endDate.strip().partition(' ')
+    tm, _, tz = rest.strip().partition(' ')
+    return datetime.strptime(f'{date} {tm or "00:00:00"}', IB_DATE_FMT), tz.strip()
+
+def formatEndDate(dt, tz=''):
+    s = dt.strftime(IB_DATE_FMT)
+    return f'{s} {tz}' if tz else s
+
+def toEpoch(dt):
+    """Naive local datetime -> epoch seconds"""
+    return int(dt.timestamp())
+
+def barEpoch(date):
+    """
+    Bar date -> epoch seconds.
+    'yyyymmdd  hh:mm:ss' and 'yyyymmdd' are local time, digits only - epoch already.
+    """
+    if date.isdigit():
+        if len(date) > 8: return int(date)
+        return int(time.mktime(time.strptime(date, '%Y%m%d')))
+    return int(time.mktime(time.strptime(' '.join(date.split()[:2]), IB_DATE_FMT)))
+
+def formatBarDate(epoch, daily=False):
+    """Epoch seconds -> bar date string in the TWS formatDate=1 format"""
+    if daily: return time.strftime('%Y%m%d', time.localtime(epoch))
+    return time.strftime('%Y%m%d  %H:%M:%S', time.localtime(epoch))
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main
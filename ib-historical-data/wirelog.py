@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Wire log: raw TWS messages recorded with the timestamps for the offline replay.
+
+Usage:
+    python wirelog.py info session.wlog
+    python wirelog.py decode session.wlog [--speed X] [--profile]
+    python wirelog.py replay session.wlog jobs.csv [--speed X] [--profile]
+
+decode - feeds every message straight into decoder.interpret() with a
+         do-nothing wrapper: the raw decode cost;
+replay - runs the batch mode (batch.py) over the recorded session instead of
+         the TWS: the full callback path down to the output files.
+         The job file must be the same as in the recorded session.
+--speed 0 (default) - as fast as possible, 1 - original speed, 2 - twice as fast...
+
+File format (little endian):
+    header: b'IBWL', u16 format version, u16 server version,
+            u16 length + TWS connection time
+    record: f64 seconds since the recording start, u32 length, message text
+'''
+
+#region import
+import os
+import sys
+import time
+import struct
+import logging
+import argparse
+import threading
+
+from ibapi import comm, decoder
+from ibapi.wrapper import EWrapper
+
+from ibclient import Command, REPLAY_END
+#endregion import
+
+MAGIC = b'IBWL'
+VERSION = 1
+
+_header = struct.Struct('<4sHHH')
+_record = struct.Struct('<dI')
+
+def logName(path, suffix):
+    return time.strftime(f'{path}/{suffix}.%Y%m%d_%H%M%S.wlog')
+
+class WireLogWriter:
+    def __init__(self, fileName, serverVersion, connTime, bufferSize=1<<20):
+        dirName = os.path.dirname(fileName)
+        if dirName: os.makedirs(dirName, exist_ok=True)
+        self.fileName = fileName
+        self.nMessages = 0
+        self._file = open(fileName, 'wb', buffering=bufferSize)
+        connTime = connTime or b''
+        if isinstance(connTime, str): connTime = connTime.encode()
+        self._file.write(_header.pack(MAGIC, VERSION, serverVersion, len(connTime)) + connTime)
+        self._started = time.monotonic()
+
+    def write(self, text):
+        self.nMessages += 1
+        self._file.write(_record.pack(time.monotonic() - self._started, len(text)))
+        self._file.write(text)
+
+    def close(self):
+        if self._file is None: return
+        self._file.close()
+        self._file = None
+        logging.info(f'Wire log {self.fileName}: {self.nMessages} messages')
+
+class WireLog:
+    """Recorded session: serverVersion, connTime and the (time, text) messages"""
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            magic, version, self.serverVersion, size = _header.unpack(f.read(_header.size))
+            if magic != MAGIC: raise ValueError(f'{fileName}: not a wire log')
+            if version != VERSION: raise ValueError(f'{fileName}: unknown version {version}')
+            self.connTime = f.read(size)
+            self._offset = f.tell()
+
+    def __iter__(self):
+        """(seconds since the recording start, message text)"""
+        with open(self.fileName, 'rb', buffering=1<<20) as f:
+            f.seek(self._offset)
+            read = f.read
+            unpack = _record.unpack
+            size = _record.size
+            while True:
+                head = read(size)
+                if len(head) < size: return
+                t, length = unpack(head)
+                text = read(length)
+                if len(text) < length: return  # Truncated by the crash
+                yield t, text
+
+def paced(messages, speed=0.):
+    """Sleep between the messages to keep the recorded timing (speed > 0)"""
+    if speed <= 0.:
+        yield from messages
+        return
+    started = time.monotonic()
+    for t, text in messages:
+        delay = started + t / speed - time.monotonic()
+        if delay > 0.: time.sleep(delay)
+        yield t, text
+
+def decode(fileName, wrapper=None, speed=0.):
+    """Feed the recorded messages straight into decoder.interpret()"""
+    log = WireLog(fileName)
+    dec = decoder.Decoder(wrapper or EWrapper(), log.serverVersion)
+    n = 0
+    for _, text in paced(log, speed):
+        dec.interpret(comm.read_fields(text))
+        n += 1
+    return n
+
+def replay(client, fileName, speed=0.):
+    """
+    Make the client (not connected IBClient) replay the recorded session:
+    messages are put into the client queue by the feeder thread as if they come
+    from the TWS, the client requests go nowhere.
+    Connection is 'closed' when the loop gets to the end of the log.
+    """
+    log = WireLog(fileName)
+    client.serverVersion_ = log.serverVersion
+    client.connTime = log.connTime
+    client.decoder = client.decoderClass(client.wrapper, log.serverVersion)
+    client.replaying = True
+
+    def feed():
+        for _, text in paced(log, speed):
+            client.msg_queue.put(text)
+        client.msg_queue.put(Command(REPLAY_END))
+
+    threading.Thread(target=feed, name='Replay', daemon=True).start()
+
+#region main
+#-------------------------------------------------------------------------------
+def _profiled(profile, fn, *args):
+    if not profile: return fn(*args)
+    import cProfile, pstats
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn, *args)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    return result
+
+def _replayBatch(fileName, jobsFile, speed):
+    from config import config
+    from logutils import init_logger
+    from batch import BatchApp, readJobs, printSummary
+
+    init_logger('replay', logpath=config.logpath, loglevel=config.loglevel)
+    # Request ids must be the same as in the recording: no contract resolution
+    config.contractCache = None
+    # ... and the same requests: no ADJUSTED_LAST from TRADES
+    config.adjustments = None
+    # Recorded answers come as they come, no reason to hold the requests
+    config.pacingRequests = 1 << 30
+    config.pacingIdentical = 0
+    config.pacingPerContract = 1 << 30
+
+    started = time.monotonic()
+    app = BatchApp(readJobs(jobsFile))
+    replay(app, fileName, speed)
+    app.run()
+    app.stopWriter()
+    printSummary(app.summary(), time.monotonic() - started)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='TWS wire log tools')
+    parser.add_argument('command', choices=('info', 'decode', 'replay'))
+    parser.add_argument('log', help='wire log file')
+    parser.add_argument('jobs', nargs='?', help='job file of the recorded session (replay)')
+    parser.add_argument('--speed', type=float, default=0., help='0 - max, 1 - original')
+    parser.add_argument('--profile', action='store_true', help='print cProfile stats')
+    args = parser.parse_args(args)
+
+    if args.command == 'info':
+        log = WireLog(args.log)
+        n = size = 0
+        last = 0.
+        for last, text in log:
+            n += 1
+            size += len(text)
+        print(f'Server version {log.serverVersion}, connected {log.connTime.decode()}: '
+              f'{n} messages, {size} bytes, {last:.1f}s')
+    elif args.command == 'decode':
+        started = time.monotonic()
+        n = _profiled(args.profile, decode, args.log, None, args.speed)
+        elapsed = time.monotonic() - started
+        print(f'{n} messages decoded in {elapsed:.2f}s ({n / max(elapsed, 1e-9):,.0f} msg/s)')
+    else:
+        if not args.jobs: parser.error('replay needs the job file')
+        _profiled(args.profile, _replayBatch, args.log, args.jobs, args.speed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+#endregion main
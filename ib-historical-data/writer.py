@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Author: Sergey Ishin (Prograsaur) (c) 2018
+#-----------------------------------------------------------------------------
+
+'''
+Interactive Brokers TWS API -- Historical data loader
+
+Background writer.
+
+Disk writes are done by the separate thread, so a slow disk or network share
+does not stall the TWS message loop. Bars are sent to the writer in batches
+through the bounded queue. When the queue is full the message loop blocks
+(backpressure) and the event is reported.
+'''
+
+#region import
+import sys
+import time
+import queue
+import logging
+import threading
+
+from metrics import Histogram
+#endregion import
+
+class Writer(threading.Thread):
+    def __init__(self, maxsize=256, onBackpressure=None):
+        threading.Thread.__init__(self, name='Writer', daemon=True)
+        self._queue = queue.Queue(maxsize)
+        self.onBackpressure = onBackpressure
+        self.nBackpressure = 0
+        self.lag = Histogram()  # Time in the queue, seconds
+        self._lastReport = 0.
+
+    def call(self, fn, *args):
+        """Run fn(*args) in the writer thread"""
+        item = (time.monotonic(), fn, args)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._backpressure()
+            self._queue.put(item)
+
+    def _backpressure(self):
+        self.nBackpressure += 1
+        now = time.monotonic()
+        if now - self._lastReport >= 1.:
+            self._lastReport = now
+            logging.warning(f'Writer queue is full ({self._queue.maxsize}), '
+                            f'backpressure events: {self.nBackpressure}')
+            if self.onBackpressure: self.onBackpressure(self.nBackpressure)
+
+    @property
+    def qsize(self): return self._queue.qsize()
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None: break
+            queued, fn, args = item
+            self.lag.record(time.monotonic() - queued)
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('Writer error')
+
+    def stop(self):
+        """Write everything queued and stop the thread"""
+        if not self.is_alive(): return
+        self._queue.put(None)
+        self.join()
+
+class AsyncSink:
+    """
+    Sink proxy: collects bars into batches and passes them
+    to the real sink in the writer thread
+    """
+    def __init__(self, sink, writer, batchSize=4096):
+        self.sink = sink
+        self.writer = writer
+        self.batchSize = batchSize
+        self._batch = []
+
+    def write(self, bar):
+        batch = self._batch
+        batch.append(bar)
+        if len(batch) >= self.batchSize:
+            self.writer.call(self.sink.writeMany, batch)
+            self._batch = []
+
+    def writeMany(self, bars):
+        self._batch.extend(bars)
+        if len(self._batch) >= self.batchSize:
+            self.writer.call(self.sink.writeMany, self._batch)
+            self._batch = []
+
+    def writeArray(self, array, daily=False):
+        # Already a batch - just keep the order with the single bars
+        self._send()
+        self.writer.call(self.sink.writeArray, array, daily)
+
+    def upsert(self, array, daily=False):
+        self._send()
+        self.writer.call(self.sink.upsert, array, daily)
+
+    def _send(self):
+        if self._batch:
+            self.writer.call(self.sink.writeMany, self._batch)
+            self._batch = []
+
+    def flush(self, fsync=True):
+        self._send()
+        self.writer.call(self.sink.flush, fsync)
+
+    def close(self):
+        self._send()
+        self.writer.call(self.sink.close)
+
+#region main
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print(__doc__)
+    print('This is a python library - not standalone application')
+    sys.exit(-1)
+#endregion main